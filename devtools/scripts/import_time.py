@@ -0,0 +1,33 @@
+"""
+Benchmark how long importing fragmenter takes in a fresh interpreter.
+
+Compares `import fragmenter` (submodules load on first use) with importing the modules that used to be imported
+eagerly by fragmenter/__init__.py.
+
+    python devtools/scripts/import_time.py -n 10
+"""
+import argparse
+import subprocess as sp
+import sys
+
+STATEMENTS = {
+    'import fragmenter': 'import fragmenter',
+    'import fragmenter + version': 'import fragmenter; fragmenter.__version__',
+    'eager (all submodules)': 'import fragmenter; from fragmenter import fragment, torsions, workflow_api, utils, chemi; '
+                              'fragmenter.__version__',
+}
+
+TIMER = ('import time; t = time.perf_counter(); exec({!r}); '
+         'import sys; sys.stdout.write(repr(time.perf_counter() - t))')
+
+parser = argparse.ArgumentParser(description='Time importing fragmenter in fresh Python processes.')
+parser.add_argument('-n', '--repeat', type=int, default=5, help='number of processes per statement')
+args = parser.parse_args()
+
+for name, statement in STATEMENTS.items():
+    times = []
+    for _ in range(args.repeat):
+        output = sp.run([sys.executable, '-c', TIMER.format(statement)], stdout=sp.PIPE, check=True).stdout
+        times.append(float(output))
+    times.sort()
+    print('{:<30} best {:8.1f} ms   median {:8.1f} ms'.format(name, 1000 * times[0], 1000 * times[len(times) // 2]))
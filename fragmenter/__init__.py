@@ -3,17 +3,31 @@ fragmenter
 Fragment molecules for quantum mechanics torison scans.
 """
 
-# Make Python 2 and 3 imports work the same
-# Safe to remove with Python 3-only code
+# Submodules (and the toolkits they import: OpenEye, RDKit, cmiles, qcfractal) are imported on first attribute access
+# so importing fragmenter is fast for short lived worker processes and command line tools.
 
-# Add imports here
+import importlib
 
-from . import fragment, torsions, workflow_api, utils, chemi
-from .workflow_api import WorkFlow
+_submodules = {'fragment', 'torsions', 'workflow_api', 'utils', 'chemi', 'cache', 'stats'}
+_attributes = {'WorkFlow': 'workflow_api'}
 
-# Handle versioneer
-from ._version import get_versions
-versions = get_versions()
-__version__ = versions['version']
-__git_revision__ = versions['full-revisionid']
-del get_versions, versions
+__all__ = sorted(_submodules) + sorted(_attributes) + ['__version__', '__git_revision__']
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('.' + name, __name__)
+    if name in _attributes:
+        return getattr(importlib.import_module('.' + _attributes[name], __name__), name)
+    if name in ('__version__', '__git_revision__'):
+        # Handle versioneer
+        from ._version import get_versions
+        versions = get_versions()
+        globals()['__version__'] = versions['version']
+        globals()['__git_revision__'] = versions['full-revisionid']
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,216 @@
+"""
+Content addressed result caches. Results are stored as JSON in an in-memory LRU tier backed by an optional sqlite
+file so expensive results (charges, Wiberg bond orders, enumerated states) survive between runs.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from collections import OrderedDict
+
+from .utils import logger
+
+
+def cache_key(*parts):
+    """
+    Hash the JSON representation of parts into a key. Dictionaries are serialized with sorted keys so the key does
+    not depend on the order options were given in.
+
+    Parameters
+    ----------
+    parts: JSON serializable objects
+
+    Returns
+    -------
+    key: str
+        sha256 hex digest
+    """
+    serialized = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+
+    def __init__(self, filename=None, namespace='results', max_memory_items=1024, max_disk_bytes=None):
+        """
+        Two tier cache of JSON serializable results.
+
+        Parameters
+        ----------
+        filename: str, optional, default None
+            Path to sqlite file. If None, only the in-memory tier is used.
+        namespace: str, optional, default 'results'
+            Name of the table results are stored in. Different kinds of results can share a file.
+        max_memory_items: int, optional, default 1024
+            Number of results kept in memory. The least recently used result is dropped first.
+        max_disk_bytes: int, optional, default None
+            Maximum total size of stored values in the sqlite file. When exceeded, the least recently used results
+            are deleted. If None, the file grows without bound.
+        """
+        self.filename = filename
+        self.namespace = namespace
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._connection = None
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # sqlite connections cannot be sent to worker processes. Workers open their own connection on first use.
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_memory'] = OrderedDict()
+        return state
+
+    def __len__(self):
+        if self._db is None:
+            return len(self._memory)
+        return self._db.execute('SELECT COUNT(*) FROM {}'.format(self.namespace)).fetchone()[0]
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    @property
+    def _db(self):
+        if self.filename is None:
+            return None
+        if self._connection is None:
+            dirname = os.path.dirname(os.path.abspath(self.filename))
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self._connection = sqlite3.connect(self.filename, timeout=60)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT, '
+                                     'size INTEGER, accessed REAL)'.format(self.namespace))
+            self._connection.commit()
+        return self._connection
+
+    @property
+    def stats(self):
+        """
+        Hit and miss counters. hit_rate is the fraction of lookups that were found in either tier.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'memory_hits': self.memory_hits, 'disk_hits': self.hits - self.memory_hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+    def get(self, key, count=True):
+        """
+        Look up result for key. Returns None if the key is not in the cache.
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            if count:
+                self.hits += 1
+                self.memory_hits += 1
+            return self._memory[key]
+
+        value = None
+        if self._db is not None:
+            row = self._db.execute('SELECT value FROM {} WHERE key=?'.format(self.namespace), (key,)).fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+                self._db.execute('UPDATE {} SET accessed=? WHERE key=?'.format(self.namespace), (time.time(), key))
+                self._db.commit()
+                self._remember(key, value)
+
+        if count:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def get_many(self, keys):
+        """
+        Look up many keys with one query per 500 keys.
+
+        Returns
+        -------
+        found: dict
+            maps keys that were in the cache to their results. Missing keys are left out.
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                found[key] = self._memory[key]
+                self.hits += 1
+                self.memory_hits += 1
+            else:
+                missing.append(key)
+
+        if self._db is not None:
+            now = time.time()
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i+500]
+                query = 'SELECT key, value FROM {} WHERE key IN ({})'.format(self.namespace,
+                                                                           ','.join('?' * len(chunk)))
+                for key, value in self._db.execute(query, chunk):
+                    found[key] = json.loads(value)
+                    self._remember(key, found[key])
+                    self.hits += 1
+                self._db.executemany('UPDATE {} SET accessed=? WHERE key=?'.format(self.namespace),
+                                     [(now, key) for key in chunk if key in found])
+            self._db.commit()
+
+        self.misses += len([key for key in missing if key not in found])
+        return found
+
+    def put(self, key, value):
+        """
+        Store JSON serializable value under key
+        """
+        self._remember(key, value)
+        if self._db is None:
+            return
+        serialized = json.dumps(value)
+        self._db.execute('INSERT OR REPLACE INTO {} (key, value, size, accessed) VALUES (?, ?, ?, ?)'.format(
+            self.namespace), (key, serialized, len(serialized), time.time()))
+        self._db.commit()
+        if self.max_disk_bytes is not None:
+            self._evict()
+
+    def clear(self):
+        """
+        Remove all results from both tiers
+        """
+        self._memory.clear()
+        if self._db is not None:
+            self._db.execute('DELETE FROM {}'.format(self.namespace))
+            self._db.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM {}'.format(self.namespace)).fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        rows = self._db.execute('SELECT key, size FROM {} ORDER BY accessed ASC'.format(self.namespace))
+        to_delete = []
+        for key, size in rows:
+            if total <= self.max_disk_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        self._db.executemany('DELETE FROM {} WHERE key=?'.format(self.namespace), to_delete)
+        self._db.commit()
+        for (key,) in to_delete:
+            self._memory.pop(key, None)
+        self.evictions += len(to_delete)
+        logger().debug('Evicted {} results from {}'.format(len(to_delete), self.filename))
@@ -1,6 +1,7 @@
 """functions to manipulate, read and write OpenEye and Psi4 molecules"""
 
 try:
+    import openeye
     from openeye import oechem, oeomega, oeiupac, oedepict, oequacpac, oeszybki
 except ImportError:
     raise Warning("Need license for OpenEye!")
@@ -8,13 +9,15 @@ from rdkit import Chem
 
 import cmiles
 from .utils import logger, ANGSROM_2_BOHR, BOHR_2_ANGSTROM
+from .stats import NULL_STATS
 
 import os
 import numpy as np
 import time
 import itertools
 import copy
-from math import radians
+import hashlib
+import collections
 
 """
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -23,9 +26,12 @@ manipulate OpenEye molecules
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 """
 
+OPENEYE_VERSION = openeye.__name__ + '-v' + openeye.__version__
+
 
 def get_charges(molecule, max_confs=800, strict_stereo=True,
-                normalize=True, keep_confs=None, legacy=True):
+                normalize=True, keep_confs=None, legacy=True, cache=None, stats=None, conformer_budget=None,
+                wbo_tolerance=0.01, naming=None):
     """Generate charges for an OpenEye OEMol molecule.
     Parameters
     ----------
@@ -51,10 +57,27 @@ def get_charges(molecule, max_confs=800, strict_stereo=True,
     legacy : bool, default=True
         If False, uses the new OpenEye charging engine.
         See https://docs.eyesopen.com/toolkits/python/quacpactk/OEProtonFunctions/OEAssignCharges.html#
+    cache : fragmenter.cache.ResultCache, optional, default=None
+        If provided, partial charges and Wiberg bond orders are looked up in the cache by canonical isomeric explicit
+        hydrogen SMILES, charging options and OpenEye version. On a hit, only the conformers that are returned are
+        generated and AM1BCC is skipped. On a miss, the results are stored in the cache.
+    stats : fragmenter.stats.ParentStats, optional, default=None
+        If provided, time spent in the omega, am1bcc and charge_cache stages is recorded.
+    conformer_budget : str, optional, default=None
+        How many conformers to charge with. If None, up to max_confs conformers are generated.
+        If 'scale', the number of conformers scales with the number of rotatable bonds and heavy atoms (see
+        scaled_conformer_budget), up to max_confs.
+        If 'converge', charges are calculated with more and more conformers (doubling every time, up to max_confs)
+        until no Wiberg bond order changes by more than wbo_tolerance.
+    wbo_tolerance : float, optional, default=0.01
+        Convergence threshold for conformer_budget='converge'
+    naming : str, optional, default=None
+        How the normalized molecule is named. See normalize_molecule
     Returns
     -------
     charged_copy : OEMol
-        A molecule with OpenEye's recommended AM1BCC charge selection scheme.
+        A molecule with OpenEye's recommended AM1BCC charge selection scheme. The number of conformers used to
+        calculate the charges is stored on the molecule as 'n_charge_conformers' data.
     Notes
     -----
     Roughly follows
@@ -67,23 +90,56 @@ def get_charges(molecule, max_confs=800, strict_stereo=True,
 
     if not oechem.OEChemIsLicensed(): raise(ImportError("Need License for OEChem!"))
     if not oequacpac.OEQuacPacIsLicensed(): raise(ImportError("Need License for oequacpac!"))
+    if stats is None:
+        stats = NULL_STATS
+    if conformer_budget not in (None, 'scale', 'converge'):
+        raise ValueError("conformer_budget must be None, 'scale' or 'converge'")
 
     if normalize:
-        molecule = normalize_molecule(molecule)
+        molecule = normalize_molecule(molecule, naming=naming)
     else:
         molecule = oechem.OEMol(molecule)
 
-    charged_copy = generate_conformers(molecule, max_confs=max_confs, strict_stereo=strict_stereo)  # Generate up to max_confs conformers
-
-    if not legacy:
-        # 2017.2.1 OEToolkits new charging function
-        status = oequacpac.OEAssignCharges(charged_copy, oequacpac.OEAM1BCCCharges())
-        if not status: raise(RuntimeError("OEAssignCharges failed."))
+    cached = None
+    if cache is not None:
+        with stats.stage('charge_cache'):
+            options = {'max_confs': max_confs, 'strict_stereo': strict_stereo, 'legacy': legacy}
+            if conformer_budget is not None:
+                options['conformer_budget'] = conformer_budget
+                if conformer_budget == 'converge':
+                    options['wbo_tolerance'] = wbo_tolerance
+            key, atom_map = charge_cache_key(molecule, **options)
+            cached = cache.get(key)
+
+    if cached is not None:
+        stats.count('charge_cache_hits')
+        # Only generate the conformers that will be returned
+        n_confs = max_confs if keep_confs == -1 else max(keep_confs or 1, 1)
+        with stats.stage('omega'):
+            charged_copy = generate_conformers(molecule, max_confs=n_confs, strict_stereo=strict_stereo)
+        _set_cached_charges(charged_copy, cached, atom_map)
+        n_charge_confs = cached.get('n_conformers', max_confs)
     else:
-        # AM1BCCSym recommended by Chris Bayly to KAB+JDC, Oct. 20 2014.
-        status = oequacpac.OEAssignPartialCharges(charged_copy, oequacpac.OECharges_AM1BCCSym)
-        if not status: raise(RuntimeError("OEAssignPartialCharges returned error code %d" % status))
-
+        if conformer_budget == 'converge':
+            charged_copy = _charge_until_converged(molecule, max_confs=max_confs, strict_stereo=strict_stereo,
+                                                   legacy=legacy, wbo_tolerance=wbo_tolerance, stats=stats)
+        else:
+            n_confs = max_confs
+            if conformer_budget == 'scale':
+                n_confs = scaled_conformer_budget(molecule, max_confs=max_confs)
+            with stats.stage('omega'):
+                charged_copy = generate_conformers(molecule, max_confs=n_confs, strict_stereo=strict_stereo)  # Generate up to n_confs conformers
+            with stats.stage('am1bcc'):
+                _assign_am1bcc(charged_copy, legacy=legacy)
+        n_charge_confs = charged_copy.NumConfs()
+
+        if cache is not None:
+            with stats.stage('charge_cache'):
+                cached = _get_cached_charges(charged_copy, atom_map)
+                cached['n_conformers'] = n_charge_confs
+                cache.put(key, cached)
+    stats.count('conformers', n_charge_confs)
+    logger().debug('Charged {} with {} conformers'.format(molecule.GetTitle(), n_charge_confs))
 
 
     #Determine conformations to return
@@ -110,9 +166,140 @@ def get_charges(molecule, max_confs=800, strict_stereo=True,
         #Not a valid option to keep_confs
         raise(ValueError('Not a valid option to keep_confs in get_charges.'))
 
+    charged_copy.SetData(oechem.OEGetTag('n_charge_conformers'), n_charge_confs)
     return charged_copy
 
 
+def _assign_am1bcc(molecule, legacy=True):
+    """
+    Assign AM1BCC charges to all conformers of molecule in place. See get_charges
+    """
+    if not legacy:
+        # 2017.2.1 OEToolkits new charging function
+        status = oequacpac.OEAssignCharges(molecule, oequacpac.OEAM1BCCCharges())
+        if not status: raise(RuntimeError("OEAssignCharges failed."))
+    else:
+        # AM1BCCSym recommended by Chris Bayly to KAB+JDC, Oct. 20 2014.
+        status = oequacpac.OEAssignPartialCharges(molecule, oequacpac.OECharges_AM1BCCSym)
+        if not status: raise(RuntimeError("OEAssignPartialCharges returned error code %d" % status))
+
+
+def scaled_conformer_budget(molecule, max_confs=800, min_confs=10, confs_per_rotor=30, heavy_atoms_per_scale=20):
+    """
+    Number of conformers to charge a molecule with, scaled by its flexibility and size. Rigid molecules get min_confs
+    conformers. Each rotatable bond adds confs_per_rotor conformers, multiplied by the number of heavy atoms over
+    heavy_atoms_per_scale for larger molecules.
+
+    Parameters
+    ----------
+    molecule : OEMol
+    max_confs : int, optional, default=800
+        upper limit
+    min_confs : int, optional, default=10
+    confs_per_rotor : int, optional, default=30
+    heavy_atoms_per_scale : int, optional, default=20
+
+    Returns
+    -------
+    n_confs : int
+    """
+    n_rotors = sum(bond.IsRotor() for bond in molecule.GetBonds())
+    n_heavy = sum(atom.GetAtomicNum() > 1 for atom in molecule.GetAtoms())
+    n_confs = min_confs + confs_per_rotor * n_rotors * max(1.0, float(n_heavy) / heavy_atoms_per_scale)
+    return int(min(max_confs, n_confs))
+
+
+def _charge_until_converged(molecule, max_confs=800, strict_stereo=True, legacy=True, wbo_tolerance=0.01,
+                            min_confs=10, stats=None):
+    """
+    Charge molecule with min_confs conformers and keep doubling the number of conformers (up to max_confs) until no
+    Wiberg bond order (or partial charge if bond orders were not calculated) changes by more than wbo_tolerance.
+
+    Returns
+    -------
+    charged : OEMol
+        charged molecule with the conformers used for the last round of charging
+    """
+    if stats is None:
+        stats = NULL_STATS
+    n_confs = min(min_confs, max_confs)
+    previous = None
+    while True:
+        with stats.stage('omega'):
+            charged = generate_conformers(molecule, max_confs=n_confs, strict_stereo=strict_stereo)
+        with stats.stage('am1bcc'):
+            _assign_am1bcc(charged, legacy=legacy)
+        if all(bond.HasData('WibergBondOrder') for bond in charged.GetBonds()):
+            values = np.array([bond.GetData('WibergBondOrder') for bond in charged.GetBonds()])
+        else:
+            values = np.array([atom.GetPartialCharge() for atom in charged.GetAtoms()])
+        if previous is not None and np.max(np.abs(values - previous), initial=0.0) <= wbo_tolerance:
+            break
+        # Stop if omega could not generate more conformers
+        if n_confs >= max_confs or charged.NumConfs() < n_confs:
+            break
+        previous = values
+        n_confs = min(2 * n_confs, max_confs)
+    logger().debug('Charges of {} converged with {} conformers'.format(molecule.GetTitle(), charged.NumConfs()))
+    return charged
+
+
+def charge_cache_key(molecule, **options):
+    """
+    Generate the charge cache key for a molecule and the map from canonical atom order to atom index in molecule.
+
+    Parameters
+    ----------
+    molecule: OEMol
+        Molecule with explicit hydrogens
+    options: charging options that change the result
+
+    Returns
+    -------
+    key: str
+    atom_map: dict
+        maps canonical map index (1 based) to atom index in molecule
+    """
+    from .cache import cache_key
+    # Work on a copy without map indices so the map is the canonical order
+    mol = oechem.OEMol(molecule)
+    for atom in mol.GetAtoms():
+        atom.SetMapIdx(0)
+    smiles = cmiles.utils.mol_to_smiles(mol, isomeric=True, explicit_hydrogen=True, mapped=False)
+    mapped_smiles = cmiles.utils.mol_to_smiles(mol, isomeric=True, explicit_hydrogen=True, mapped=True)
+    atom_map = cmiles.utils.get_atom_map(mol, mapped_smiles)
+    return cache_key(smiles, options, OPENEYE_VERSION), atom_map
+
+
+def _get_cached_charges(molecule, atom_map):
+    """
+    Partial charges in canonical atom order and Wiberg bond orders keyed by canonical atom pair.
+    """
+    inv_map = dict(zip(atom_map.values(), atom_map.keys()))
+    charges = [molecule.GetAtom(oechem.OEHasAtomIdx(atom_map[i])).GetPartialCharge()
+               for i in range(1, len(atom_map) + 1)]
+    wbos = []
+    for bond in molecule.GetBonds():
+        if not bond.HasData('WibergBondOrder'):
+            continue
+        i, j = sorted((inv_map[bond.GetBgnIdx()], inv_map[bond.GetEndIdx()]))
+        wbos.append([i, j, bond.GetData('WibergBondOrder')])
+    return {'partial_charges': charges, 'wiberg_bond_orders': wbos}
+
+
+def _set_cached_charges(molecule, cached, atom_map):
+    """
+    Set partial charges and Wiberg bond orders from cache on molecule
+    """
+    for i, charge in enumerate(cached['partial_charges']):
+        molecule.GetAtom(oechem.OEHasAtomIdx(atom_map[i+1])).SetPartialCharge(charge)
+    tag = oechem.OEGetTag('WibergBondOrder')
+    for i, j, wbo in cached['wiberg_bond_orders']:
+        bond = molecule.GetBond(molecule.GetAtom(oechem.OEHasAtomIdx(atom_map[i])),
+                                molecule.GetAtom(oechem.OEHasAtomIdx(atom_map[j])))
+        bond.SetData(tag, wbo)
+
+
 def generate_conformers(molecule, max_confs=800, dense=False, strict_stereo=True, ewindow=15.0, rms_threshold=1.0, strict_types=True,
                         can_order=True, copy=True):
     """Generate conformations for the supplied molecule
@@ -175,7 +362,8 @@ def generate_conformers(molecule, max_confs=800, dense=False, strict_stereo=True
     return molcopy
 
 
-def generate_grid_conformers(molecule, dihedrals, intervals, max_rotation=360, copy_mol=True):
+def generate_grid_conformers(molecule, dihedrals, intervals, max_rotation=360, copy_mol=True, clash_threshold=None,
+                             return_coordinates=False):
     """
     Generate conformers using torsion angle grids.
 
@@ -184,9 +372,18 @@ def generate_grid_conformers(molecule, dihedrals, intervals, max_rotation=360, c
     molecule: OEMol
     dihedrals: list of
     intervals
+    clash_threshold: float, optional, default None
+        If given, grid points where two atoms that are not bonded and not bonded to the same atom are closer than this
+        (in Angstrom) are left out. See torsion_grid
+    return_coordinates: bool, optional, default False
+        If True, no OE conformers are created. The molecule with one conformer and the grid coordinates are returned.
 
     Returns
     -------
+    conf_mol: OEMol
+        molecule with one conformer for every grid point
+    coordinates: np.ndarray
+        (n_grid, max_atom_idx, 3) coordinates of the grid if return_coordinates
 
     """
     # molecule must be mapped
@@ -200,27 +397,278 @@ def generate_grid_conformers(molecule, dihedrals, intervals, max_rotation=360, c
     # Check length of dihedrals match length of intervals
 
     conf_mol = generate_conformers(molecule, max_confs=1)
-    conf = conf_mol.GetConfs().next()
-    coords = oechem.OEFloatArray(conf.GetMaxAtomIdx()*3)
-    conf.GetCoords(coords)
-
-    torsions = [[conf_mol.GetAtom(oechem.OEHasMapIdx(i+1)) for i in dih] for dih in dihedrals]
-
-    for i, tor in enumerate(torsions):
-        copy_conf_mol = copy.deepcopy(conf_mol)
-        conf_mol.DeleteConfs()
-        for conf in copy_conf_mol.GetConfs():
-            coords = oechem.OEFloatArray(conf.GetMaxAtomIdx()*3)
-            conf.GetCoords(coords)
-            for angle in range(5, max_rotation+5, intervals[i]):
-                newconf = conf_mol.NewConf(coords)
-                oechem.OESetTorsion(newconf, tor[0], tor[1], tor[2], tor[3], radians(angle))
+
+    torsions = [[conf_mol.GetAtom(oechem.OEHasMapIdx(i+1)).GetIdx() for i in dih] for dih in dihedrals]
+    angles = [np.arange(5, max_rotation+5, interval) for interval in intervals]
+    bonds = [(bond.GetBgnIdx(), bond.GetEndIdx()) for bond in conf_mol.GetBonds()]
+    coordinates, grid_angles = torsion_grid(get_coordinates(conf_mol)[0], bonds, torsions, angles,
+                                            clash_threshold=clash_threshold)
 
     restore_map(conf_mol)
+    if return_coordinates:
+        return conf_mol, coordinates
+    set_coordinates(conf_mol, coordinates, new_conformers=True)
     return conf_mol
 
 
-def resolve_clashes(mol):
+def torsion_grid(coordinates, bonds, dihedrals, angles, clash_threshold=None):
+    """
+    Generate the coordinates of a grid of torsion angles. The atoms on the side of each rotatable bond that holds the
+    last atom of the dihedral are rotated for all grid points at once. Dihedrals are set in order so the first
+    dihedral changes slowest along the grid (like itertools.product).
+
+    Parameters
+    ----------
+    coordinates: array-like
+        (n_atoms, 3) starting coordinates in Angstrom
+    bonds: array-like
+        (n_bonds, 2) atom indices of bonds
+    dihedrals: array-like
+        (n_dihedrals, 4) atom indices of the dihedrals to drive. Dihedrals about ring bonds cannot be rotated. They
+        are logged and kept at their starting angle on all grid points.
+    angles: list of array-like
+        angles in degrees to set every dihedral to
+    clash_threshold: float, optional, default None
+        If given, grid points where atoms that are moved relative to each other, are not bonded and are not bonded to
+        the same atom are closer than this (in Angstrom) are left out.
+
+    Returns
+    -------
+    grid: np.ndarray
+        (n_grid, n_atoms, 3) coordinates
+    grid_angles: np.ndarray
+        (n_grid, n_dihedrals) dihedral angles of every grid point
+    """
+    from .torsions import measure_dihedral_angles
+    coordinates = np.asarray(coordinates, dtype=float)
+    n_atoms = len(coordinates)
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    dihedrals = np.asarray(dihedrals, dtype=int).reshape(-1, 4)
+    neighbors = _neighbor_lists(n_atoms, bonds)
+    moving = []
+    for dihedral in dihedrals:
+        moving_atoms = _moving_atoms(neighbors, dihedral[1], dihedral[2])
+        if moving_atoms is None:
+            logger().warning("Dihedral {} is about a ring bond and will not be rotated".format(dihedral.tolist()))
+            moving_atoms = []
+        moving.append(moving_atoms)
+
+    grid = coordinates[np.newaxis].copy()
+    grid_angles = np.zeros((1, 0))
+    for dihedral, moving_atoms, targets in zip(dihedrals, moving, angles):
+        targets = np.asarray(targets, dtype=float)
+        n_points = len(targets)
+        grid = np.repeat(grid, n_points, axis=0)
+        targets = np.tile(targets, len(grid_angles))
+        current = measure_dihedral_angles(dihedral, grid, bohr=False)[:, 0]
+        if not len(moving_atoms):
+            targets = current
+        grid_angles = np.hstack([np.repeat(grid_angles, n_points, axis=0), targets[:, np.newaxis]])
+        delta = np.radians(targets - current)
+        grid[:, moving_atoms] = _rotate_about_bond(grid[:, moving_atoms], grid[:, dihedral[1]], grid[:, dihedral[2]],
+                                                   delta)
+
+    if clash_threshold is not None and len(dihedrals):
+        # Only atoms that move relative to each other can clash on some grid points and not on others
+        moves = np.zeros((len(dihedrals), n_atoms), dtype=bool)
+        for i, moving_atoms in enumerate(moving):
+            moves[i, moving_atoms] = True
+        pairs = nonbonded_pairs(n_atoms, bonds)
+        pairs = pairs[(moves[:, pairs[:, 0]] != moves[:, pairs[:, 1]]).any(axis=0)]
+        keep = min_pair_distances(grid, pairs) >= clash_threshold
+        logger().debug("{} of {} grid points clash".format(len(grid) - keep.sum(), len(grid)))
+        grid, grid_angles = grid[keep], grid_angles[keep]
+    return grid, grid_angles
+
+
+def _neighbor_lists(n_atoms, bonds):
+    neighbors = [[] for _ in range(n_atoms)]
+    for i, j in bonds:
+        neighbors[i].append(j)
+        neighbors[j].append(i)
+    return neighbors
+
+
+def _moving_atoms(neighbors, b, c):
+    """
+    Atoms on the c side of bond b-c or None if the bond is in a ring
+    """
+    moving = {c}
+    stack = [c]
+    while stack:
+        atom = stack.pop()
+        for nbr in neighbors[atom]:
+            if atom == c and nbr == b:
+                continue
+            if nbr == b:
+                return None
+            if nbr not in moving:
+                moving.add(nbr)
+                stack.append(nbr)
+    return sorted(moving)
+
+
+def _rotate_about_bond(points, b, c, theta):
+    """
+    Rotate (n, n_points, 3) points about the axes from b to c (n, 3) by theta (n,) radians (Rodrigues' formula)
+    """
+    axis = c - b
+    axis = (axis / np.linalg.norm(axis, axis=-1, keepdims=True))[:, np.newaxis]
+    p = points - c[:, np.newaxis]
+    cos = np.cos(theta)[:, np.newaxis, np.newaxis]
+    sin = np.sin(theta)[:, np.newaxis, np.newaxis]
+    return (p * cos + np.cross(axis, p) * sin + axis * np.sum(p * axis, axis=-1, keepdims=True) * (1 - cos)
+            + c[:, np.newaxis])
+
+
+def nonbonded_pairs(n_atoms, bonds):
+    """
+    Atom pairs that are not bonded (1-2) and not bonded to the same atom (1-3)
+
+    Parameters
+    ----------
+    n_atoms: int
+    bonds: array-like
+        (n_bonds, 2) atom indices of bonds
+
+    Returns
+    -------
+    pairs: np.ndarray
+        (n_pairs, 2) atom indices with i < j
+    """
+    adjacency = np.zeros((n_atoms, n_atoms), dtype=int)
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    adjacency[bonds[:, 0], bonds[:, 1]] = 1
+    adjacency[bonds[:, 1], bonds[:, 0]] = 1
+    excluded = (adjacency > 0) | (adjacency.dot(adjacency) > 0) | np.eye(n_atoms, dtype=bool)
+    return np.argwhere(np.triu(~excluded, 1))
+
+
+def min_pair_distances(coordinates, pairs, chunk_size=1024):
+    """
+    Shortest distance between the atom pairs in every conformer
+
+    Parameters
+    ----------
+    coordinates: array-like
+        (n_confs, n_atoms, 3) coordinates
+    pairs: array-like
+        (n_pairs, 2) atom indices, for example from nonbonded_pairs
+    chunk_size: int, optional, default 1024
+        number of conformers to calculate distances for at a time
+
+    Returns
+    -------
+    distances: np.ndarray
+        (n_confs,) shortest distance of every conformer. inf if there are no pairs.
+    """
+    coordinates = np.asarray(coordinates, dtype=float)
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    distances = np.full(len(coordinates), np.inf)
+    if not len(pairs):
+        return distances
+    for start in range(0, len(coordinates), chunk_size):
+        chunk = coordinates[start:start + chunk_size]
+        diff = chunk[:, pairs[:, 0]] - chunk[:, pairs[:, 1]]
+        distances[start:start + chunk_size] = np.sqrt(np.min(np.einsum('ijk,ijk->ij', diff, diff), axis=1))
+    return distances
+
+
+def pair_clashes(coordinates, pairs, cutoffs, chunk_size=1024):
+    """
+    Find conformers where any atom pair is closer than its cutoff
+
+    Parameters
+    ----------
+    coordinates: array-like
+        (n_confs, n_atoms, 3) coordinates
+    pairs: array-like
+        (n_pairs, 2) atom indices, for example from nonbonded_pairs
+    cutoffs: float or array-like
+        distance below which a pair clashes. One for all pairs or one per pair.
+    chunk_size: int, optional, default 1024
+        number of conformers to calculate distances for at a time
+
+    Returns
+    -------
+    clashes: np.ndarray
+        (n_confs,) True for conformers with a clash
+    """
+    coordinates = np.asarray(coordinates, dtype=float)
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    clashes = np.zeros(len(coordinates), dtype=bool)
+    if not len(pairs):
+        return clashes
+    squared_cutoffs = np.broadcast_to(np.asarray(cutoffs, dtype=float) ** 2, (len(pairs),))
+    for start in range(0, len(coordinates), chunk_size):
+        chunk = coordinates[start:start + chunk_size]
+        diff = chunk[:, pairs[:, 0]] - chunk[:, pairs[:, 1]]
+        clashes[start:start + chunk_size] = (np.einsum('ijk,ijk->ij', diff, diff) < squared_cutoffs).any(axis=1)
+    return clashes
+
+
+def find_clashes(molecule, scale=0.7):
+    """
+    Find conformers with severe steric overlaps: atoms that are not bonded and not bonded to the same atom that are
+    closer than scale times the sum of their Bondi van der Waals radii. This is a fast check for conformers that need
+    to be minimized with resolve_clashes.
+
+    Parameters
+    ----------
+    molecule: OEMol or conformer
+    scale: float, optional, default 0.7
+        fraction of the sum of van der Waals radii below which atoms overlap
+
+    Returns
+    -------
+    clashes: np.ndarray
+        (n_confs,) True for conformers with overlapping atoms
+    """
+    n_atoms = molecule.GetMaxAtomIdx()
+    radii = np.zeros(n_atoms)
+    exists = np.zeros(n_atoms, dtype=bool)
+    for atom in molecule.GetAtoms():
+        radii[atom.GetIdx()] = oechem.OEGetBondiVdWRadius(atom.GetAtomicNum())
+        exists[atom.GetIdx()] = True
+    bonds = [(bond.GetBgnIdx(), bond.GetEndIdx()) for bond in molecule.GetBonds()]
+    pairs = nonbonded_pairs(n_atoms, bonds)
+    pairs = pairs[exists[pairs[:, 0]] & exists[pairs[:, 1]]]
+    return pair_clashes(get_coordinates(molecule), pairs, scale * (radii[pairs[:, 0]] + radii[pairs[:, 1]]))
+
+
+_SZYBKI_ENGINES = {}
+
+
+def _szybki_engines():
+    """
+    Szybki MMFF94S engines for single points and restrained minimization. Engines are set up once per process and
+    reused for all conformers and molecules.
+    """
+    if not _SZYBKI_ENGINES:
+        # set general energy options along with the single-point specification
+        spSzybki = oeszybki.OESzybkiOptions()
+        spSzybki.SetForceFieldType(oeszybki.OEForceFieldType_MMFF94S)
+        spSzybki.SetSolventModel(oeszybki.OESolventModel_Sheffield)
+        spSzybki.SetRunType(oeszybki.OERunType_SinglePoint)
+
+        # generate the szybki MMFF94 engine for single points
+        _SZYBKI_ENGINES['single_point'] = oeszybki.OESzybki(spSzybki)
+
+        # construct minimiz options from single-points options to get general optns
+        optSzybki = oeszybki.OESzybkiOptions(spSzybki)
+
+        # now reset the option for minimization
+        optSzybki.SetRunType(oeszybki.OERunType_CartesiansOpt)
+
+        # generate szybki MMFF94 engine for minimization
+        szOpt = oeszybki.OESzybki(optSzybki)
+        # add strong harmonic restraints to nonHs
+        szOpt.SetHarmonicConstraints(10.0)
+        _SZYBKI_ENGINES['minimize'] = szOpt
+    return _SZYBKI_ENGINES['single_point'], _SZYBKI_ENGINES['minimize']
+
+
+def resolve_clashes(mol, prefilter=False):
     """
     Taken from quanformer (https://github.com/MobleyLab/quanformer/blob/master/quanformer/initialize_confs.py#L54
     Minimize conformers with severe steric interaction.
@@ -229,32 +677,19 @@ def resolve_clashes(mol):
     mol : single OEChem molecule (single conformer)
     clashfile : string
         name of file to write output
+    prefilter : bool, optional, default False
+        If True, conformers without overlapping atoms (see find_clashes) are not passed to Szybki and do not get the
+        'MM Szybki Single Point Energy' SD data. The geometric check can miss conformers with many moderate contacts
+        that Szybki would minimize (MMFF vdW > 35 kcal/mol).
     Returns
     -------
     boolean
         True if completed successfully, False otherwise.
     """
+    if prefilter and not find_clashes(mol).any():
+        return True
 
-    # set general energy options along with the single-point specification
-    spSzybki = oeszybki.OESzybkiOptions()
-    spSzybki.SetForceFieldType(oeszybki.OEForceFieldType_MMFF94S)
-    spSzybki.SetSolventModel(oeszybki.OESolventModel_Sheffield)
-    spSzybki.SetRunType(oeszybki.OERunType_SinglePoint)
-
-    # generate the szybki MMFF94 engine for single points
-    szSP = oeszybki.OESzybki(spSzybki)
-
-    # construct minimiz options from single-points options to get general optns
-    optSzybki = oeszybki.OESzybkiOptions(spSzybki)
-
-    # now reset the option for minimization
-    optSzybki.SetRunType(oeszybki.OERunType_CartesiansOpt)
-
-    # generate szybki MMFF94 engine for minimization
-    szOpt = oeszybki.OESzybki(optSzybki)
-    # add strong harmonic restraints to nonHs
-
-    szOpt.SetHarmonicConstraints(10.0)
+    szSP, szOpt = _szybki_engines()
     # construct a results object to contain the results of a szybki calculation
 
     szResults = oeszybki.OESzybkiResults()
@@ -281,14 +716,55 @@ def resolve_clashes(mol):
     return True
 
 
-def remove_clash(multi_conformer, in_place=True):
+def remove_clash(multi_conformer, in_place=True, prefilter=False, n_workers=1, executor=None):
+    """
+    Resolve clashes of all conformers with resolve_clashes and remove conformers Szybki failed on.
+
+    Parameters
+    ----------
+    multi_conformer: OEMol
+    in_place: bool, optional, default True
+        If False, a copy is returned
+    prefilter: bool, optional, default False
+        If True, only conformers with overlapping atoms (see find_clashes) are passed to Szybki. See resolve_clashes
+    n_workers: int, optional, default 1
+        Number of processes to minimize conformers in. If 1 (and no executor is given), conformers are minimized in
+        this process.
+    executor: concurrent.futures.Executor, optional, default None
+        If provided, conformers are minimized in this executor. The caller owns the executor.
+    """
     # resolve clashes
     if not in_place:
         multi_conformer = copy.deepcopy(multi_conformer)
-    confs_to_remove = []
-    for conf in multi_conformer.GetConfs():
-        if not resolve_clashes(conf):
-            confs_to_remove.append(conf)
+    confs = list(multi_conformer.GetConfs())
+    if prefilter:
+        flagged = find_clashes(multi_conformer)
+        confs = [conf for conf, clash in zip(confs, flagged) if clash]
+        logger().debug('{} of {} conformers of {} have clashes'.format(len(confs), len(flagged),
+                                                                       multi_conformer.GetTitle()))
+
+    pool = None
+    if executor is None and n_workers > 1 and len(confs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = executor = ProcessPoolExecutor(max_workers=n_workers)
+    try:
+        if executor is None:
+            resolved = [resolve_clashes(conf, prefilter=False) for conf in confs]
+        else:
+            futures = [executor.submit(_resolve_clashes_oeb, to_oeb_bytes(oechem.OEMol(conf))) for conf in confs]
+            resolved = []
+            for conf, future in zip(confs, futures):
+                success, oeb = future.result()
+                if success:
+                    minimized = from_oeb_bytes(oeb)
+                    conf.SetCoords(minimized.GetCoords())
+                    oechem.OECopySDData(conf, minimized)
+                resolved.append(success)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    confs_to_remove = [conf for conf, success in zip(confs, resolved) if not success]
     for i in confs_to_remove:
         multi_conformer.DeleteConf(i)
 
@@ -296,7 +772,81 @@ def remove_clash(multi_conformer, in_place=True):
         return multi_conformer
 
 
-def normalize_molecule(molecule, title=''):
+def _resolve_clashes_oeb(oeb):
+    """
+    Worker entry point for remove_clash. Resolves clashes of a conformer sent as OEB bytes and sends it back.
+    """
+    mol = from_oeb_bytes(oeb)
+    success = resolve_clashes(mol, prefilter=False)
+    return success, to_oeb_bytes(mol)
+
+
+NAMING_POLICIES = ('none', 'hash', 'iupac')
+_naming_policy = 'iupac'
+_NAMES = collections.OrderedDict()
+_MAX_NAMES = 10000
+
+
+def set_naming_policy(policy):
+    """
+    Set how molecules without a title are named by normalize_molecule (and everything that normalizes molecules, such as
+    smiles_to_oemol and get_charges) when no naming policy is given. Naming with IUPAC names is slow for large molecules,
+    so bulk pipelines that do not use the names can skip it with set_naming_policy('none').
+
+    Parameters
+    ----------
+    policy: str
+        'none' (empty title), 'hash' (id from the hash of the canonical SMILES) or 'iupac' (IUPAC name, default)
+
+    Returns
+    -------
+    previous: str
+        the policy that was set before
+    """
+    global _naming_policy
+    if policy not in NAMING_POLICIES:
+        raise ValueError("naming policy must be one of {}".format(NAMING_POLICIES))
+    previous = _naming_policy
+    _naming_policy = policy
+    return previous
+
+
+def molecule_name(molecule, naming=None):
+    """
+    Generate a name for a molecule. Names are memoized by canonical isomeric SMILES so every molecule is only named once
+    per process.
+
+    Parameters
+    ----------
+    molecule: OEMol
+    naming: str, optional, default None
+        'none', 'hash' or 'iupac'. If None, the policy set with set_naming_policy is used.
+
+    Returns
+    -------
+    name: str
+    """
+    if naming is None:
+        naming = _naming_policy
+    if naming not in NAMING_POLICIES:
+        raise ValueError("naming policy must be one of {}".format(NAMING_POLICIES))
+    if naming == 'none':
+        return ''
+    smiles = oechem.OECreateIsoSmiString(molecule)
+    if naming == 'hash':
+        return 'mol_' + hashlib.sha1(smiles.encode('utf-8')).hexdigest()[:16]
+    name = _NAMES.get(smiles)
+    if name is None:
+        name = oeiupac.OECreateIUPACName(molecule)
+        _NAMES[smiles] = name
+        if len(_NAMES) > _MAX_NAMES:
+            _NAMES.popitem(last=False)
+    else:
+        _NAMES.move_to_end(smiles)
+    return name
+
+
+def normalize_molecule(molecule, title='', naming=None):
     """Normalize a copy of the molecule by checking aromaticity, adding explicit hydrogens and renaming by IUPAC name
     or given title
 
@@ -305,7 +855,10 @@ def normalize_molecule(molecule, title=''):
     molecule: OEMol
         The molecule to be normalized:
     title: str
-        Name of molecule. If the string is empty, will use IUPAC name
+        Name of molecule. If the string is empty, the molecule is named according to naming
+    naming: str, optional, default None
+        'none', 'hash' or 'iupac'. If None, the policy set with set_naming_policy is used (IUPAC names by default).
+        See molecule_name
 
     Returns
     -------
@@ -321,10 +874,11 @@ def normalize_molecule(molecule, title=''):
     # Add hydrogens.
     oechem.OEAddExplicitHydrogens(molcopy)
 
-    # Set title to IUPAC name.
+    # Set title to generated name.
     name = title
     if not name:
-        name = oeiupac.OECreateIUPACName(molcopy)
+        name = molecule_name(molcopy, naming)
+        molcopy.SetData(oechem.OEGetTag('generated_title'), True)
     molcopy.SetTitle(name)
 
     # Check for any missing atom names, if found reassign all of them.
@@ -333,6 +887,98 @@ def normalize_molecule(molecule, title=''):
     return molcopy
 
 
+_FLOAT_ARRAY_PATH = []
+
+
+def _float_array_to_numpy(array, n):
+    """
+    Copy an OEFloatArray into a float64 NumPy array. If the toolkit's OEFloatArray supports the buffer protocol, this is
+    a single bulk copy. Otherwise it falls back to np.fromiter, which goes through the SWIG iterator one element at a
+    time from Python. Which path is used is logged once per process.
+    """
+    try:
+        coordinates = np.frombuffer(array, dtype=np.float32, count=n).astype(float)
+        path = 'buffer'
+    except (TypeError, ValueError, BufferError):
+        coordinates = np.fromiter(array, dtype=float, count=n)
+        path = 'per element iteration'
+    if not _FLOAT_ARRAY_PATH:
+        _FLOAT_ARRAY_PATH.append(path)
+        logger().debug('Copying OEFloatArray coordinates to NumPy with {}'.format(path))
+    return coordinates
+
+
+def to_float_array(coordinates):
+    """
+    Convert (n_atoms, 3) coordinates to an OEFloatArray for OEConfBase.SetCoords and OEMol.NewConf. The coordinates
+    are converted to a Python list first since OEFloatArray is constructed from a sequence, so this is not a bulk copy.
+
+    Parameters
+    ----------
+    coordinates: array-like
+        coordinates in Angstrom in atom index order
+
+    Returns
+    -------
+    coords: OEFloatArray
+    """
+    return oechem.OEFloatArray(np.asarray(coordinates, dtype=float).ravel().tolist())
+
+
+def get_coordinates(molecule):
+    """
+    Coordinates of all conformers as a NumPy array. Each conformer is fetched with one toolkit call instead of a call
+    per atom so geometry checks can be vectorized. See _float_array_to_numpy for how the toolkit array is copied.
+
+    Parameters
+    ----------
+    molecule: OEMol, OEConfBase or OEGraphMol
+        A single conformer or molecule without conformers gives an array with one conformer
+
+    Returns
+    -------
+    coordinates: np.ndarray
+        (n_confs, max_atom_idx, 3) coordinates in Angstrom. The second axis is indexed by atom index.
+    """
+    n_atoms = molecule.GetMaxAtomIdx()
+    confs = list(molecule.GetConfs()) if hasattr(molecule, 'GetConfs') else [molecule]
+    coordinates = np.empty((len(confs), n_atoms, 3))
+    array = oechem.OEFloatArray(n_atoms * 3)
+    for k, conf in enumerate(confs):
+        conf.GetCoords(array)
+        coordinates[k] = _float_array_to_numpy(array, n_atoms * 3).reshape(n_atoms, 3)
+    return coordinates
+
+
+def set_coordinates(molecule, coordinates, new_conformers=False):
+    """
+    Set the coordinates of all conformers from a NumPy array
+
+    Parameters
+    ----------
+    molecule: OEMol
+    coordinates: array-like
+        (n_confs, max_atom_idx, 3) coordinates in Angstrom in atom index order
+    new_conformers: bool, optional, default False
+        If True, the conformers of the molecule are replaced by one new conformer per set of coordinates. Otherwise the
+        number of conformers must match and the coordinates of the existing conformers are set in order.
+    """
+    coordinates = np.asarray(coordinates, dtype=float)
+    if coordinates.ndim != 3 or coordinates.shape[1:] != (molecule.GetMaxAtomIdx(), 3):
+        raise ValueError("coordinates must have shape (n_confs, {}, 3)".format(molecule.GetMaxAtomIdx()))
+    if new_conformers:
+        molecule.DeleteConfs()
+        for frame in coordinates:
+            molecule.NewConf(to_float_array(frame))
+        return
+    confs = list(molecule.GetConfs())
+    if len(confs) != len(coordinates):
+        raise ValueError("Molecule has {} conformers but {} sets of coordinates were given".format(len(confs),
+                                                                                                   len(coordinates)))
+    for conf, frame in zip(confs, coordinates):
+        conf.SetCoords(to_float_array(frame))
+
+
 def has_conformer(molecule, check_two_dimension=False):
     """
     Check if conformer exists for molecule. Return True or False
@@ -347,32 +993,19 @@ def has_conformer(molecule, check_two_dimension=False):
     -------
 
     """
-    conformer_bool = True
     try:
-        if molecule.NumConfs() <= 1:
-            # Check if xyz coordinates are not zero
-            for conf in molecule.GetConfs():
-                # print(conf.GetCoords().__len__())
-                # coords = molecule.GetCoords()
-                # values = np.asarray(list(coords.values()))
-                # print(values)
-                # print(values.all())
-                # if not values.all():
-                #     conformer_bool = False
-                #for i in range(conf.GetCoords().__len__()):
-                values = np.asarray([conf.GetCoords().__getitem__(i) == (0.0, 0.0, 0.0) for i in
-                                    conf.GetCoords()])
-            if values.all():
-                conformer_bool = False
+        coordinates = get_coordinates(molecule)
+        n_confs = molecule.NumConfs()
     except AttributeError:
-        conformer_bool = False
-
-    if conformer_bool and check_two_dimension:
-        for conf in molecule.GetConfs():
-            values = np.asarray([conf.GetCoords().__getitem__(i)[-1] == 0.0 for i in conf.GetCoords()])
-            if values.all():
-                conformer_bool = False
-    return conformer_bool
+        return False
+    if not len(coordinates):
+        return False
+    # Check if xyz coordinates are not zero
+    if n_confs <= 1 and not coordinates[-1].any():
+        return False
+    if check_two_dimension and (coordinates[:, :, 2] == 0.0).all(axis=1).any():
+        return False
+    return True
 
 
 # def mol_to_graph(molecule):
@@ -580,6 +1213,72 @@ def new_output_stream(outname):
     return ofs
 
 
+def to_oeb_bytes(molecule):
+    """
+    Serialize a molecule to OEB bytes. This is used to send molecules to worker processes since OpenEye molecules
+    cannot be pickled.
+
+    Parameters
+    ----------
+    molecule: OEMol
+
+    Returns
+    -------
+    oeb: bytes
+    """
+    ofs = oechem.oemolostream()
+    ofs.SetFormat(oechem.OEFormat_OEB)
+    ofs.openstring()
+    oechem.OEWriteMolecule(ofs, molecule)
+    return ofs.GetString()
+
+
+def from_oeb_bytes(oeb):
+    """
+    Deserialize a molecule from OEB bytes generated with to_oeb_bytes
+
+    Parameters
+    ----------
+    oeb: bytes
+
+    Returns
+    -------
+    molecule: OEMol
+    """
+    ifs = oechem.oemolistream()
+    ifs.SetFormat(oechem.OEFormat_OEB)
+    ifs.openstring(oeb)
+    molecule = oechem.OEMol()
+    if not oechem.OEReadMolecule(ifs, molecule):
+        raise ValueError("Could not read molecule from OEB bytes")
+    return molecule
+
+
+# Compiled substructure searches keyed by SMARTS. Filled once per process (and once per worker process).
+_SUBSEARCHES = {}
+
+
+def get_subsearch(smarts):
+    """
+    Compiled OESubSearch for a SMARTS pattern. Patterns are parsed once per process and reused.
+
+    Parameters
+    ----------
+    smarts: str
+        SMARTS pattern
+
+    Returns
+    -------
+    ss: OESubSearch
+    """
+    if smarts not in _SUBSEARCHES:
+        qmol = oechem.OEQMol()
+        if not oechem.OEParseSmarts(qmol, smarts):
+            logger().warning('OEParseSmarts failed for {}'.format(smarts))
+        _SUBSEARCHES[smarts] = oechem.OESubSearch(qmol)
+    return _SUBSEARCHES[smarts]
+
+
 def file_to_oemols(filename, title=True, verbose=False):
     """Create OEMol from file. If more than one mol in file, return list of OEMols.
 
@@ -666,12 +1365,16 @@ def smifile_to_rdmols(filename):
     return rd_mols
 
 
-def smiles_to_oemol(smiles, name='', normalize=True):
+def smiles_to_oemol(smiles, name='', normalize=True, naming=None):
     """Create a OEMolBuilder from a smiles string.
     Parameters
     ----------
     smiles : str
         SMILES representation of desired molecule.
+    name : str, optional, default ''
+        title of the molecule. If empty, the molecule is named according to naming
+    naming : str, optional, default None
+        See normalize_molecule
     Returns
     -------
     molecule : OEMol
@@ -683,7 +1386,7 @@ def smiles_to_oemol(smiles, name='', normalize=True):
         raise ValueError("The supplied SMILES '%s' could not be parsed." % smiles)
 
     if normalize:
-        molecule = normalize_molecule(molecule, name)
+        molecule = normalize_molecule(molecule, name, naming=naming)
 
     return molecule
 
@@ -837,29 +1540,29 @@ def to_mapped_xyz(molecule, atom_map=None, conformer=None, xyz_format=True, file
         raise ValueError("If molecule does not have atom map, you must provide an atom map")
     if not has_conformer(molecule, check_two_dimension=True):
         raise ValueError("Molecule must have conformers")
+    # Atom indices and symbols in map order are the same for all conformers
+    indices = []
+    symbols = []
+    for mapping in range(1, molecule.NumAtoms()+1):
+        if not atom_map:
+            atom = molecule.GetAtom(oechem.OEHasMapIdx(mapping))
+        else:
+            atom = molecule.GetAtom(oechem.OEHasAtomIdx(atom_map[mapping]))
+        indices.append(atom.GetIdx())
+        symbols.append(oechem.OEGetAtomicSymbol(atom.GetAtomicNum()))
+    coordinates = get_coordinates(molecule)[:, indices]
+
     xyz = ""
     for k, mol in enumerate(molecule.GetConfs()):
         if k == conformer or conformer is None:
             if xyz_format:
                 xyz += "{}\n".format(mol.GetMaxAtomIdx())
                 xyz += "{}\n".format(mol.GetTitle())
-            coords = oechem.OEFloatArray(mol.GetMaxAtomIdx() * 3)
-            mol.GetCoords(coords)
             if k != 0 and not xyz_format:
                     xyz += "*"
 
-            for mapping in range(1, molecule.NumAtoms()+1):
-                if not atom_map:
-                    atom = molecule.GetAtom(oechem.OEHasMapIdx(mapping))
-                    idx = atom.GetIdx()
-                else:
-                    idx = atom_map[mapping]
-                    atom = mol.GetAtom(oechem.OEHasAtomIdx(idx))
-                syb = oechem.OEGetAtomicSymbol(atom.GetAtomicNum())
-                xyz += "  {}      {:05.3f}   {:05.3f}   {:05.3f}\n".format(syb,
-                                                                           coords[idx * 3],
-                                                                           coords[idx * 3 + 1],
-                                                                           coords[idx * 3 + 2])
+            for syb, (x, y, z) in zip(symbols, coordinates[k]):
+                xyz += "  {}      {:05.3f}   {:05.3f}   {:05.3f}\n".format(syb, x, y, z)
 
     if filename:
         file = open("{}.xyz".format(filename), 'w')
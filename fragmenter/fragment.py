@@ -1,25 +1,27 @@
 from itertools import combinations
-import openeye as oe
-from openeye import oechem, oedepict, oegrapheme, oequacpac, oeomega, oeiupac
+from openeye import oechem, oedepict, oegrapheme, oequacpac, oeomega
 from cmiles.utils import mol_to_smiles, has_stereo_defined
 
 import yaml
 import os
 from pkg_resources import resource_filename
-import copy
 import itertools
 import json
+import time
+import hashlib
+import collections
+import numpy as np
 
 from .utils import logger, make_python_identifier
-from .chemi import to_smi, normalize_molecule, get_charges
-
-
-OPENEYE_VERSION = oe.__name__ + '-v' + oe.__version__
+from .chemi import (to_smi, normalize_molecule, get_charges, to_oeb_bytes, from_oeb_bytes, get_subsearch,
+                    smiles_to_oemol, OPENEYE_VERSION)
+from .stats import NULL_STATS, ParentStats
+from .cache import cache_key
 
 
 def expand_states(molecule, protonation=True, tautomers=False, stereoisomers=True, max_states=200, level=0, reasonable=True,
                   carbon_hybridization=True, suppress_hydrogen=True, verbose=True, filename=None,
-                  return_smiles_list=False, return_molecules=False):
+                  return_smiles_list=False, return_molecules=False, n_workers=1, executor=None, cache=None):
     """
     Expand molecule states (choice of protonation, tautomers and/or stereoisomers).
     Protonation states expands molecules to protonation of protonation sites (Some states might only be reasonable in
@@ -40,8 +42,8 @@ def expand_states(molecule, protonation=True, tautomers=False, stereoisomers=Tru
         which ins't needed for torsion scans
     stereoisomers: Bool, optional, default=True
         If True will enumerate stereoisomers (cis/trans and R/S).
-    max_states: int, optional, default=True
-        maximum states enumeration should find
+    max_states: int, optional, default=200
+        maximum states enumeration should find. Enumeration stops once this many unique states were found.
     level: int, optional, Defualt=0
         The level for enumerating tautomers. It can go up until 7. The higher the level, the more tautomers will be
         generated but they will also be less reasonable.
@@ -59,6 +61,15 @@ def expand_states(molecule, protonation=True, tautomers=False, stereoisomers=Tru
         smi file of all molecules processed with a unique numbered name for each state.
     return_molecules: bool, optional, default=False
         If true, will return list of OEMolecules instead of SMILES
+    n_workers: int, optional, default=1
+        Number of processes to enumerate states with. If 1 (and no executor is given), states are enumerated in this
+        process.
+    executor: concurrent.futures.Executor, optional, default=None
+        If provided, the states of every molecule are enumerated in this executor. The caller owns the executor and is
+        responsible for shutting it down.
+    cache: fragmenter.cache.ResultCache, optional, default=None
+        Cache for enumerated states. If provided, molecules that were already enumerated with the same options are not
+        enumerated again. Not used with return_molecules. See states_cache_key
 
     Returns
     -------
@@ -67,21 +78,128 @@ def expand_states(molecule, protonation=True, tautomers=False, stereoisomers=Tru
     """
     title = molecule.GetTitle()
     states = set()
-    molecules = [molecule]
     if verbose:
         logger().info("Enumerating states for {}".format(title))
+
+    key = cached = None
+    if cache is not None and not return_molecules:
+        key = states_cache_key(molecule, protonation=protonation, tautomers=tautomers, stereoisomers=stereoisomers,
+                               max_states=max_states, level=level, reasonable=reasonable,
+                               carbon_hybridization=carbon_hybridization, suppress_hydrogen=suppress_hydrogen)
+        cached = cache.get(key)
+    if cached is not None:
+        states = set(cached['states'])
+        logger().info("{} states were found in cache for {}".format(len(states), title))
+    else:
+        states = _enumerate_state_smiles(molecule, protonation=protonation, tautomers=tautomers,
+                                         stereoisomers=stereoisomers, max_states=max_states, level=level,
+                                         reasonable=reasonable, carbon_hybridization=carbon_hybridization,
+                                         suppress_hydrogen=suppress_hydrogen, verbose=verbose, n_workers=n_workers,
+                                         executor=executor, return_molecules=return_molecules)
+        if return_molecules:
+            states, molecules = states
+        if key is not None:
+            cache.put(key, {'states': sorted(states)})
+
+    if filename:
+        count = 0
+        smiles_list = []
+        for molecule in states:
+            molecule = molecule + ' ' + title + '_' + str(count)
+            count += 1
+            smiles_list.append(molecule)
+        to_smi(smiles_list, filename)
+
+    if return_smiles_list:
+        return smiles_list
+
+    if return_molecules:
+        return molecules
+
+    return states
+
+
+# Options of expand_states that change the enumerated states
+_STATE_KEY_OPTIONS = ('protonation', 'tautomers', 'stereoisomers', 'max_states', 'level', 'reasonable',
+                      'carbon_hybridization', 'suppress_hydrogen')
+
+
+def states_cache_key(molecule, **options):
+    """
+    Generate the state cache key for a molecule from its canonical isomeric SMILES, the enumeration options and the
+    OpenEye version.
+
+    Parameters
+    ----------
+    molecule: OEMol
+    options: enumeration options of expand_states that change the result
+
+    Returns
+    -------
+    key: str
+    """
+    return cache_key(oechem.OEMolToSmiles(molecule), options, OPENEYE_VERSION)
+
+
+def expand_states_many(molecules, cache=None, **options):
+    """
+    Expand states of many molecules. If a cache is given, all molecules are looked up at once and only molecules that
+    are not in the cache are enumerated.
+
+    Parameters
+    ----------
+    molecules: list of OEMol
+    cache: fragmenter.cache.ResultCache, optional, default=None
+    options:
+        keyword options for expand_states (except filename, return_smiles_list and return_molecules)
+
+    Returns
+    -------
+    states: list of sets of SMILES
+        states of every molecule in input order
+    """
+    molecules = list(molecules)
+    if cache is None:
+        return [expand_states(molecule, **options) for molecule in molecules]
+
+    import inspect
+    parameters = inspect.signature(expand_states).parameters
+    key_options = {name: options.get(name, parameters[name].default) for name in _STATE_KEY_OPTIONS}
+    keys = [states_cache_key(molecule, **key_options) for molecule in molecules]
+    found = cache.get_many(keys)
+    results = []
+    for molecule, key in zip(molecules, keys):
+        if key in found:
+            results.append(set(found[key]['states']))
+        else:
+            results.append(expand_states(molecule, cache=cache, **options))
+    return results
+
+
+def _enumerate_state_smiles(molecule, protonation=True, tautomers=False, stereoisomers=True, max_states=200, level=0,
+                            reasonable=True, carbon_hybridization=True, suppress_hydrogen=True, verbose=True,
+                            n_workers=1, executor=None, return_molecules=False):
+    """
+    Enumerate states and return their SMILES (and molecules if return_molecules). See expand_states
+    """
+    title = molecule.GetTitle()
+    states = set()
+    stages = []
     if protonation:
-        logger().info("Enumerating protonation states for {}".format(title))
-        molecules.extend(_expand_states(molecules, enumerate='protonation', max_states=max_states, verbose=verbose,
-                                        level=level, suppress_hydrogen=suppress_hydrogen))
+        stages.append(('protonation', {'max_states': max_states, 'verbose': verbose, 'level': level,
+                                       'suppress_hydrogen': suppress_hydrogen}))
     if tautomers:
-        logger().info("Enumerating tautomers for {}".format(title))
-        molecules.extend(_expand_states(molecules, enumerate='tautomers', max_states=max_states, reasonable=reasonable,
-                                        carbon_hybridization=carbon_hybridization, verbose=verbose, level=level,
-                                        suppress_hydrogen=suppress_hydrogen))
+        stages.append(('tautomers', {'max_states': max_states, 'reasonable': reasonable,
+                                     'carbon_hybridization': carbon_hybridization, 'verbose': verbose, 'level': level,
+                                     'suppress_hydrogen': suppress_hydrogen}))
     if stereoisomers:
-        logger().info("Enumerating stereoisomers for {}".format(title))
-        molecules.extend(_expand_states(molecules, enumerate='stereoisomers', max_states=max_states, verbose=verbose))
+        stages.append(('stereoisomers', {'max_states': max_states, 'verbose': verbose}))
+    if suppress_hydrogen and (protonation or tautomers):
+        # Protonation states and tautomers are enumerated without explicit hydrogens. Suppress them on a copy of the
+        # input too so it is deduplicated against its own states, whether enumerated here or in a worker.
+        molecule = oechem.OEMol(molecule)
+        oechem.OESuppressHydrogens(molecule)
+    molecules = _enumerate_states(molecule, stages, max_states=max_states, n_workers=n_workers, executor=executor)
 
     for molecule in molecules:
         #states.add(fragmenter.utils.create_mapped_smiles(molecule, tagged=False, explicit_hydrogen=False))
@@ -91,29 +209,96 @@ def expand_states(molecule, protonation=True, tautomers=False, stereoisomers=Tru
          states.add(mol_to_smiles(molecule, isomeric=True, mapped=False, explicit_hydrogen=False))
         except ValueError:
             logger().warn("Tautomer or protonation state has a chiral center. Expanding stereoisomers")
-            stereo_states = _expand_states(molecule, enumerate='steroisomers')
+            stereo_states = _expand_states(molecule, enumerate='stereoisomers')
             for state in stereo_states:
-                states.add(mol_to_smiles(molecule, isomeric=True, mapped=False, explicit_hydrogen=False))
+                states.add(mol_to_smiles(state, isomeric=True, mapped=False, explicit_hydrogen=False))
 
 
-    logger().info("{} states were generated for {}".format(len(states), oechem.OEMolToSmiles(molecule)))
+    logger().info("{} states were generated for {}".format(len(states), title))
 
-    if filename:
-        count = 0
-        smiles_list = []
-        for molecule in states:
-            molecule = molecule + ' ' + title + '_' + str(count)
-            count += 1
-            smiles_list.append(molecule)
-        to_smi(smiles_list, filename)
+    if return_molecules:
+        return states, molecules
+    return states
 
-    if return_smiles_list:
-        return smiles_list
 
-    if return_molecules:
-        return molecules
+def _enumerate_states(molecule, stages, max_states=200, n_workers=1, executor=None):
+    """
+    Run state enumeration stages. Every stage enumerates the states of the unique molecules found so far (the input
+    molecule and the states of the previous stages). States are deduplicated by canonical isomeric SMILES as they are
+    found so duplicates are not fed into the next stage, and enumeration stops once max_states unique molecules were
+    found.
 
-    return states
+    Parameters
+    ----------
+    molecule: OEMol
+    stages: list of (str, dict)
+        kind of state to enumerate and keyword options for _expand_states
+    max_states: int, optional, default=200
+    n_workers: int, optional, default=1
+    executor: concurrent.futures.Executor, optional, default=None
+
+    Returns
+    -------
+    molecules: list of OEMol
+        the input molecule and its unique states
+    """
+    molecules = [molecule]
+    seen = {oechem.OEMolToSmiles(molecule)}
+    pool = None
+    if executor is None and n_workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = executor = ProcessPoolExecutor(max_workers=n_workers)
+    try:
+        for enumerate, options in stages:
+            if len(molecules) >= max_states:
+                break
+            states = _imap_expand_states(molecules, enumerate, options, executor)
+            new_states = []
+            try:
+                for state in states:
+                    key = oechem.OEMolToSmiles(state)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    new_states.append(state)
+                    if len(molecules) + len(new_states) >= max_states:
+                        logger().info("Reached {} states. Stopping enumeration".format(max_states))
+                        break
+            finally:
+                states.close()
+            molecules.extend(new_states)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return molecules
+
+
+def _imap_expand_states(molecules, enumerate, options, executor=None):
+    """
+    Yield the states of every molecule in order. If executor is given, molecules are sent to it as OEB bytes. Pending
+    molecules are cancelled when the generator is closed.
+    """
+    if executor is None:
+        for molecule in molecules:
+            for state in _expand_states(molecule, enumerate=enumerate, **options):
+                yield state
+        return
+    futures = [executor.submit(_expand_states_oeb, to_oeb_bytes(molecule), enumerate, options)
+               for molecule in molecules]
+    try:
+        for future in futures:
+            for oeb in future.result():
+                yield from_oeb_bytes(oeb)
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _expand_states_oeb(oeb, enumerate, options):
+    """
+    Worker entry point for _imap_expand_states. Returns the states as OEB bytes.
+    """
+    return [to_oeb_bytes(state) for state in _expand_states(from_oeb_bytes(oeb), enumerate=enumerate, **options)]
 
 
 def _expand_states(molecules, enumerate='protonation', max_states=200, suppress_hydrogen=True, reasonable=True,
@@ -147,9 +332,6 @@ def _expand_states(molecules, enumerate='protonation', max_states=200, suppress_
 
     states = list()
     for molecule in molecules:
-        ostream = oechem.oemolostream()
-        ostream.openstring()
-        ostream.SetFormat(oechem.OEFormat_SDF)
         states_enumerated = 0
         if suppress_hydrogen:
             oechem.OESuppressHydrogens(molecule)
@@ -161,8 +343,7 @@ def _expand_states(molecules, enumerate='protonation', max_states=200, suppress_
                 logger().debug("Enumerating protonation states...")
             for protonation_state in oequacpac.OEEnumerateFormalCharges(molecule, formal_charge_options):
                 states_enumerated += 1
-                oechem.OEWriteMolecule(ostream, protonation_state)
-                states.append(protonation_state)
+                states.append(oechem.OEMol(protonation_state))
         if enumerate == 'tautomers':
             #max_zone_size = molecule.GetMaxAtomIdx()
             tautomer_options = oequacpac.OETautomerOptions()
@@ -176,21 +357,22 @@ def _expand_states(molecules, enumerate='protonation', max_states=200, suppress_
                 logger().debug("Enumerating tautomers...")
             for tautomer in oequacpac.OEEnumerateTautomers(molecule, tautomer_options):
                 states_enumerated += 1
-                states.append(tautomer)
+                states.append(oechem.OEMol(tautomer))
         if enumerate == 'stereoisomers':
             if verbose:
                 logger().debug("Enumerating stereoisomers...")
             for enantiomer in oeomega.OEFlipper(molecule, max_states, True):
                 states_enumerated += 1
                 enantiomer = oechem.OEMol(enantiomer)
-                oechem.OEWriteMolecule(ostream, enantiomer)
                 states.append(enantiomer)
 
     return states
 
 
 def generate_fragments(molecule, generate_visualization=False, strict_stereo=False, combinatorial=True, MAX_ROTORS=2,
-                       remove_map=True, json_filename=None):
+                       remove_map=True, json_filename=None, n_workers=1, executor=None, charge_cache=None,
+                       wbo_threshold=1.2, stats=None, timeout=None, max_memory=None, conformer_budget=None,
+                       naming=None):
     """
     This function generates fragments from molecules. The output is a dictionary that maps SMILES of molecules to SMILES
      for fragments. The default SMILES are generated with openeye.oechem.OEMolToSmiles. These SMILES strings are canonical
@@ -202,7 +384,8 @@ def generate_fragments(molecule, generate_visualization=False, strict_stereo=Fal
     molecule: OEMol to fragment
     generate_visualization: bool
         If true, visualization of the fragments will be written to pdf files. The pdf will be writtten in the directory
-        where this function is run from.
+        where this function is run from. PDFs are rendered in the background (see RenderQueue) while the next
+        parents are fragmented and are all written when this function returns.
     combinatorial: bool
         If true, find all connected fragments from fragments and add all new fragments that have less than MAX_ROTORS
     MAX_ROTORS: int
@@ -214,6 +397,34 @@ def generate_fragments(molecule, generate_visualization=False, strict_stereo=Fal
         If True, the index tags will be removed. This will remove duplicate fragments. Defualt True
     json_filename: str
         filenmae for JSON. If provided, will save the returned dictionary to a JSON file. Default is None
+    n_workers: int, optional, default 1
+        Number of processes to fragment parent molecules with. If 1 (and no executor is given), molecules are
+        fragmented serially in this process.
+    executor: concurrent.futures.Executor, optional, default None
+        If provided, parent molecules are submitted to this executor instead of a new process pool. The caller owns
+        the executor and is responsible for shutting it down.
+    charge_cache: fragmenter.cache.ResultCache, optional, default None
+        Cache for partial charges and Wiberg bond orders. If provided, parents that were already charged with the same
+        options are not charged again. See chemi.get_charges
+    wbo_threshold: float, optional, default 1.2
+        Fragments are grown past bonds with Wiberg bond order above this threshold and rings and functional groups
+        bonded with a bond above this threshold are not separated.
+    stats: fragmenter.stats.FragmenterStats, optional, default None
+        If provided, wall and CPU time of every stage (normalize, omega, am1bcc, tagging, growth, combinations, smiles)
+        and counters are recorded for every parent and added to stats.
+    timeout: float, optional, default None
+        Wall clock budget in seconds for each parent. If timeout or max_memory is given, every parent is fragmented in
+        its own child process (up to n_workers at a time) that is terminated when it runs over the budget. Parents
+        over budget are skipped and the rest of the batch continues. Use iter_fragments to see why they were skipped.
+        Cannot be used with executor.
+    max_memory: int, optional, default None
+        Memory budget in bytes (address space limit) for each parent. See timeout.
+    conformer_budget: str, optional, default None
+        Number of conformers parents are charged with. None (up to 800), 'scale' (scaled by rotatable bonds and heavy
+        atoms) or 'converge' (more conformers until the Wiberg bond orders converge). See chemi.get_charges
+    naming: str, optional, default None
+        How parents without a title are named: 'none', 'hash' or 'iupac'. If None, the policy set with
+        chemi.set_naming_policy is used. Use 'none' to skip naming in bulk runs. See chemi.normalize_molecule
 
     Returns
     -------
@@ -226,40 +437,17 @@ def generate_fragments(molecule, generate_visualization=False, strict_stereo=Fal
         molecules = list(molecule)
     except TypeError:
         molecules = [molecule]
-    for molecule in molecules:
-        # normalize molecule
-        molecule = normalize_molecule(molecule, molecule.GetTitle())
-        if remove_map:
-            # Remove tags from smiles. This is done to make it easier to find duplicate fragments
-            for a in molecule.GetAtoms():
-                a.SetMapIdx(0)
-        frags = _generate_fragments(molecule, strict_stereo=strict_stereo)
-        if not frags:
-            logger().warning('Skipping {}, SMILES: {}'.format(molecule.GetTitle(), oechem.OECreateSmiString(molecule)))
-            continue
-        charged = frags[0]
-        frags = frags[-1]
-        frag_list = list(frags.values())
-        if combinatorial:
-            smiles = smiles_with_combined(frag_list, charged, MAX_ROTORS)
-        else:
-            smiles = frag_to_smiles(frag_list, charged)
 
-        parent_smiles = mol_to_smiles(molecule, isomeric=True, explicit_hydrogen=False, mapped=False)
-        if smiles:
-            fragments[parent_smiles] = list(smiles.keys())
-        else:
-            # Add molecule where no fragments were found for terminal torsions and / or rings and non rotatable bonds
-            fragments[parent_smiles] = [mol_to_smiles(molecule, isomeric=True, explicit_hydrogen=True, mapped=False)]
-
-        if generate_visualization:
-            IUPAC = oeiupac.OECreateIUPACName(molecule)
-            name = molecule.GetTitle()
-            if IUPAC == name:
-                name = make_python_identifier(oechem.OEMolToSmiles(molecule))[0]
-            oname = '{}.pdf'.format(name)
-            ToPdf(charged, oname, frags)
-        del charged, frags
+    results = iter_fragments(molecules, generate_visualization=generate_visualization, strict_stereo=strict_stereo,
+                             combinatorial=combinatorial, MAX_ROTORS=MAX_ROTORS, remove_map=remove_map,
+                             n_workers=n_workers, executor=executor, charge_cache=charge_cache,
+                             wbo_threshold=wbo_threshold, stats=stats, timeout=timeout, max_memory=max_memory,
+                             conformer_budget=conformer_budget, naming=naming)
+    # Results come back in input order so the merged mapping does not depend on which worker finished first
+    for parent_smiles, frags, diagnostics in results:
+        if diagnostics['status'] == 'fragmented':
+            fragments[parent_smiles] = frags
+
     if json_filename:
         f = open(json_filename, 'w')
         j = json.dump(fragments, f, indent=2, sort_keys=True)
@@ -268,7 +456,389 @@ def generate_fragments(molecule, generate_visualization=False, strict_stereo=Fal
     return fragments
 
 
-def _generate_fragments(mol, strict_stereo=True):
+def iter_fragments(molecule_stream, generate_visualization=False, strict_stereo=False, combinatorial=True,
+                   MAX_ROTORS=2, remove_map=True, n_workers=1, executor=None, charge_cache=None, sink=None,
+                   max_pending=None, wbo_threshold=1.2, stats=None, timeout=None, max_memory=None,
+                   conformer_budget=None, naming=None, renderer=None):
+    """
+    Fragment molecules from an iterable one parent at a time. Molecules are only read from molecule_stream as they are
+    needed and results are yielded (and written to sink) as soon as they are done so memory does not grow with the
+    size of the input and finished results are kept if the run stops halfway.
+
+    Parameters
+    ----------
+    molecule_stream: iterable of OEMols
+        For example ifs.GetOEMols(). Each molecule is fragmented or serialized before the next one is read, so
+        streams that reuse the same molecule object are fine.
+    generate_visualization, strict_stereo, combinatorial, MAX_ROTORS, remove_map, n_workers, executor, charge_cache,
+    wbo_threshold, stats, timeout, max_memory, conformer_budget, naming:
+        see generate_fragments
+    sink: str or file like object, optional, default None
+        If provided, one JSON line with the parent SMILES, fragment SMILES and diagnostics is written and flushed for
+        every parent. If a str, the file is opened for writing and closed when the generator finishes.
+    max_pending: int, optional, default None
+        Maximum number of parents submitted to workers at a time. Default is 4 times the number of workers.
+    renderer: RenderQueue, optional, default None
+        Queue that renders PDFs if generate_visualization is True. The caller owns the queue and is responsible for
+        closing it. If None, PDFs are rendered in the worker pool if fragmenting in parallel or in a background
+        thread otherwise, and all PDFs are written when the generator finishes.
+
+    Yields
+    ------
+    parent_smiles: str
+        canonical isomeric SMILES of the parent. If the parent could not be fragmented, this is the SMILES of the
+        input molecule.
+    fragments: list
+        SMILES of the fragments. Empty if the parent could not be fragmented.
+    diagnostics: dict
+        title of the parent, status ('fragmented', 'skipped' if no fragments could be generated, 'failed' if an
+        exception was raised, 'timeout' or 'out_of_memory' if the parent was over budget), error message, the stage
+        the parent stopped in if it failed or was over budget (when known), number of fragments and wall time in
+        seconds. If stats is provided, also the stage times and counters of the parent (see
+        fragmenter.stats.ParentStats).
+    """
+    options = {'generate_visualization': generate_visualization, 'strict_stereo': strict_stereo,
+               'combinatorial': combinatorial, 'MAX_ROTORS': MAX_ROTORS, 'remove_map': remove_map,
+               'charge_cache': charge_cache, 'wbo_threshold': wbo_threshold, 'conformer_budget': conformer_budget,
+               'naming': naming}
+
+    budget = timeout is not None or max_memory is not None
+    if budget and executor is not None:
+        raise ValueError("timeout and max_memory are enforced in child processes and cannot be used with executor")
+
+    close_sink = isinstance(sink, str)
+    if close_sink:
+        sink = open(sink, 'w')
+    pool = None
+    close_renderer = False
+    try:
+        if budget:
+            results = _imap_budgeted_parents(molecule_stream, options, max(n_workers, 1), timeout, max_memory,
+                                             stats is not None)
+        elif executor is not None or n_workers > 1:
+            if executor is None:
+                from concurrent.futures import ProcessPoolExecutor
+                pool = executor = ProcessPoolExecutor(max_workers=n_workers)
+            if max_pending is None:
+                max_pending = 4 * (n_workers if n_workers > 1 else (os.cpu_count() or 1))
+            results = _imap_fragment_parents(executor, molecule_stream, options, max_pending, stats is not None)
+        else:
+            results = (_fragment_parent_diagnostics(molecule, options, stats is not None)
+                       for molecule in molecule_stream)
+
+        if generate_visualization and renderer is None:
+            # Render in the worker pool if there is one. Otherwise a background thread is enough to keep depiction
+            # from holding up fragmentation without starting processes.
+            close_renderer = True
+            renderer = RenderQueue(executor=executor) if executor is not None else RenderQueue(processes=False)
+
+        for parent_smiles, fragments, diagnostics in results:
+            job = diagnostics.pop('render_job', None)
+            if job is not None:
+                renderer.submit_job(*job)
+            if stats is not None and 'stats' in diagnostics:
+                stats.add(dict(diagnostics['stats'], status=diagnostics['status'], stage=diagnostics['stage'],
+                               wall_time=diagnostics['wall_time']))
+            if sink is not None:
+                sink.write(json.dumps({'parent': parent_smiles, 'fragments': fragments,
+                                       'diagnostics': diagnostics}) + '\n')
+                sink.flush()
+            yield parent_smiles, fragments, diagnostics
+    finally:
+        # Wait for PDFs before shutting down the pool they may be rendered in
+        if close_renderer:
+            renderer.close()
+        if pool is not None:
+            pool.shutdown()
+        if close_sink:
+            sink.close()
+
+
+def _imap_fragment_parents(executor, molecules, options, max_pending, collect_stats=False):
+    """
+    Submit parent molecules to an executor as OEB bytes and yield the results in input order. At most max_pending
+    molecules are submitted at a time.
+
+    Parameters
+    ----------
+    executor: concurrent.futures.Executor
+    molecules: iterable of OEMol
+    options: dict
+        keyword options for _fragment_parent
+    max_pending: int
+    collect_stats: bool, optional, default False
+        If True, workers record stage times and counters
+
+    Yields
+    ------
+    parent_smiles, fragments, diagnostics: see iter_fragments
+    """
+    pending = collections.deque()
+
+    def _next_result():
+        smiles, title, future = pending.popleft()
+        try:
+            return future.result()
+        except Exception as e:
+            logger().warning('Fragmenting {} failed with {}: {}. SMILES: {}'.format(title, type(e).__name__, e, smiles))
+            return smiles, [], _diagnostics(title, 'failed', error='{}: {}'.format(type(e).__name__, e))
+
+    for molecule in molecules:
+        pending.append((oechem.OEMolToSmiles(molecule), molecule.GetTitle(),
+                        executor.submit(_fragment_parent_oeb, to_oeb_bytes(molecule), options, collect_stats)))
+        if len(pending) >= max_pending:
+            yield _next_result()
+    while pending:
+        yield _next_result()
+
+
+def _fragment_parent_oeb(oeb, options, collect_stats=False):
+    """
+    Worker entry point for _imap_fragment_parents. Deserializes the parent molecule from OEB bytes and fragments it.
+    """
+    return _fragment_parent_diagnostics(from_oeb_bytes(oeb), options, collect_stats)
+
+
+def _diagnostics(title, status, error=None, n_fragments=0, wall_time=0.0, stage=None, stats=None):
+    diagnostics = {'title': title, 'status': status, 'error': error, 'stage': stage, 'n_fragments': n_fragments,
+                   'wall_time': wall_time}
+    if stats is not None:
+        diagnostics['stats'] = stats.to_dict()
+    return diagnostics
+
+
+def _fragment_parent_diagnostics(molecule, options, collect_stats=False, on_stage=None):
+    """
+    Fragment one parent molecule with _fragment_parent and record what happened.
+
+    Parameters
+    ----------
+    molecule: OEMol
+    options: dict
+        keyword options for _fragment_parent
+    collect_stats: bool, optional, default False
+        If True, include stage times and counters in diagnostics
+    on_stage: function, optional, default None
+        called with the name of every stage when it starts (see fragmenter.stats.ParentStats)
+
+    Returns
+    -------
+    parent_smiles, fragments, diagnostics: see iter_fragments
+    """
+    smiles = oechem.OEMolToSmiles(molecule)
+    title = molecule.GetTitle()
+    stats = ParentStats(title, smiles, on_stage=on_stage) if collect_stats or on_stage is not None else None
+    # PDFs are rendered by the RenderQueue of iter_fragments so depiction does not hold up fragmentation
+    render_jobs = []
+    start = time.time()
+    try:
+        result = _fragment_parent(molecule, stats=stats, render=lambda *job: render_jobs.append(render_job(*job)),
+                                  **options)
+    except Exception as e:
+        logger().warning('Fragmenting {} failed with {}: {}. SMILES: {}'.format(title, type(e).__name__, e, smiles))
+        status = 'out_of_memory' if isinstance(e, MemoryError) else 'failed'
+        return smiles, [], _diagnostics(title, status, error='{}: {}'.format(type(e).__name__, e),
+                                        wall_time=time.time() - start,
+                                        stage=stats.current_stage if stats is not None else None,
+                                        stats=stats if collect_stats else None)
+    if not result:
+        return smiles, [], _diagnostics(title, 'skipped', error='Could not generate fragments',
+                                        wall_time=time.time() - start, stats=stats if collect_stats else None)
+    parent_smiles, fragments = result
+    diagnostics = _diagnostics(title, 'fragmented', n_fragments=len(fragments), wall_time=time.time() - start,
+                               stats=stats if collect_stats else None)
+    if render_jobs:
+        diagnostics['render_job'] = render_jobs[0]
+    return parent_smiles, fragments, diagnostics
+
+
+def _imap_budgeted_parents(molecules, options, n_workers, timeout, max_memory, collect_stats=False):
+    """
+    Fragment every parent molecule in its own child process with a wall clock and memory budget and yield the results
+    in input order. Up to n_workers children run at a time. Children that run over timeout are terminated.
+
+    Parameters
+    ----------
+    molecules: iterable of OEMol
+    options: dict
+        keyword options for _fragment_parent
+    n_workers: int
+    timeout: float or None
+        wall clock budget in seconds
+    max_memory: int or None
+        address space limit in bytes
+    collect_stats: bool, optional, default False
+
+    Yields
+    ------
+    parent_smiles, fragments, diagnostics: see iter_fragments
+    """
+    import pickle
+    import multiprocessing
+
+    # Pickle options so the children get their own copy of the charge cache without its sqlite connection
+    options = pickle.dumps(options)
+    running = collections.deque()
+
+    def _start(molecule):
+        stage = multiprocessing.Array('c', 64)
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_fragment_parent_budgeted,
+                                          args=(to_oeb_bytes(molecule), options, collect_stats, max_memory, sender,
+                                                stage))
+        process.daemon = True
+        process.start()
+        sender.close()
+        running.append((oechem.OEMolToSmiles(molecule), molecule.GetTitle(), process, receiver, stage, time.time()))
+
+    def _finish():
+        smiles, title, process, receiver, stage, start = running.popleft()
+        remaining = None if timeout is None else max(start + timeout - time.time(), 0)
+        exited = False
+        try:
+            if receiver.poll(remaining):
+                result = receiver.recv()
+                receiver.close()
+                process.join()
+                return result
+        except EOFError:
+            # Child exited without sending a result
+            exited = True
+        receiver.close()
+
+        if exited:
+            process.join()
+            status = 'failed'
+            error = 'Child process exited with code {}'.format(process.exitcode)
+            if max_memory is not None and process.exitcode < 0:
+                # Killed by a signal, most likely an abort from a failed allocation
+                status = 'out_of_memory'
+                error += ' (memory budget is {} bytes)'.format(max_memory)
+        else:
+            process.terminate()
+            process.join()
+            status = 'timeout'
+            error = 'Exceeded time budget of {} s'.format(timeout)
+        stage_name = stage.value.decode() or None
+        logger().warning('Skipping {}: {} in stage {}. SMILES: {}'.format(title, error, stage_name, smiles))
+        # The child's stage times are lost with it. Record the parent so over budget parents still show up in stats.
+        return smiles, [], _diagnostics(title, status, error=error, wall_time=time.time() - start, stage=stage_name,
+                                        stats=ParentStats(title, smiles) if collect_stats else None)
+
+    try:
+        for molecule in molecules:
+            _start(molecule)
+            if len(running) >= n_workers:
+                yield _finish()
+        while running:
+            yield _finish()
+    finally:
+        # Stop children that are still running if the caller stops early
+        for smiles, title, process, receiver, stage, start in running:
+            process.terminate()
+            process.join()
+            receiver.close()
+
+
+def _fragment_parent_budgeted(oeb, options, collect_stats, max_memory, connection, stage):
+    """
+    Child process entry point for _imap_budgeted_parents. Sets the memory limit, fragments the parent and sends the
+    result back. The name of the current stage is written to the shared stage array so the parent can report where a
+    child that was terminated got to.
+    """
+    import pickle
+    if max_memory is not None:
+        try:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+        except (ImportError, ValueError) as e:
+            logger().warning('Could not set memory limit: {}'.format(e))
+
+    def on_stage(name):
+        stage.value = name.encode()[:63]
+
+    connection.send(_fragment_parent_diagnostics(from_oeb_bytes(oeb), pickle.loads(options), collect_stats,
+                                                 on_stage=on_stage))
+    connection.close()
+
+
+def _fragment_parent(molecule, generate_visualization=False, strict_stereo=False, combinatorial=True, MAX_ROTORS=2,
+                     remove_map=True, charge_cache=None, wbo_threshold=1.2, stats=None, conformer_budget=None,
+                     naming=None, render=None):
+    """
+    Fragment one parent molecule. See generate_fragments for a description of the options. stats is a
+    fragmenter.stats.ParentStats. If render is given, it is called with the charged molecule, the PDF file name and
+    the fragments instead of writing the PDF with ToPdf.
+
+    Returns
+    -------
+    parent_smiles, fragments: str, list
+        canonical isomeric SMILES of the parent and SMILES of its fragments. False if the molecule could not be
+        fragmented.
+    """
+    if stats is None:
+        stats = NULL_STATS
+    with stats.stage('normalize'):
+        molecule = _prepare_parent(molecule, remove_map, naming=naming)
+    frags = _generate_fragments(molecule, strict_stereo=strict_stereo, charge_cache=charge_cache,
+                                wbo_threshold=wbo_threshold, stats=stats, conformer_budget=conformer_budget,
+                                naming=naming)
+    if not frags:
+        logger().warning('Skipping {}, SMILES: {}'.format(molecule.GetTitle(), oechem.OECreateSmiString(molecule)))
+        return False
+    charged = frags[0]
+    frags = frags[-1]
+    frag_list = list(frags.values())
+    if combinatorial:
+        smiles = smiles_with_combined(frag_list, charged, MAX_ROTORS, stats=stats, return_records=True)
+    else:
+        with stats.stage('smiles'):
+            smiles = frag_to_smiles(frag_list, charged, stats=stats)
+
+    parent_smiles = mol_to_smiles(molecule, isomeric=True, explicit_hydrogen=False, mapped=False)
+    fragments = _fragment_smiles_list(smiles, molecule)
+
+    if generate_visualization:
+        name = molecule.GetTitle()
+        # Generated names (IUPAC names or hashes) make poor file names
+        if not name or molecule.HasData(oechem.OEGetTag('generated_title')):
+            name = make_python_identifier(oechem.OEMolToSmiles(molecule))[0]
+        oname = '{}.pdf'.format(name)
+        with stats.stage('visualization'):
+            if render is None:
+                ToPdf(charged, oname, frags)
+            else:
+                render(charged, oname, frags)
+    del charged, frags
+
+    return parent_smiles, fragments
+
+
+def _prepare_parent(molecule, remove_map=True, naming=None):
+    """
+    Normalize parent molecule and remove map indices if remove_map
+    """
+    # normalize molecule
+    molecule = normalize_molecule(molecule, molecule.GetTitle(), naming=naming)
+    if remove_map:
+        # Remove tags from smiles. This is done to make it easier to find duplicate fragments
+        for a in molecule.GetAtoms():
+            a.SetMapIdx(0)
+    return molecule
+
+
+def _fragment_smiles_list(smiles, molecule):
+    """
+    List of fragment SMILES from frag_to_smiles output
+    """
+    if smiles:
+        return list(smiles.keys())
+    # Add molecule where no fragments were found for terminal torsions and / or rings and non rotatable bonds
+    return [mol_to_smiles(molecule, isomeric=True, explicit_hydrogen=True, mapped=False)]
+
+
+def _generate_fragments(mol, strict_stereo=True, charge_cache=None, wbo_threshold=1.2, stats=None,
+                        conformer_budget=None, naming=None):
     """
     This function generates fragments from a molecule.
 
@@ -277,6 +847,16 @@ def _generate_fragments(mol, strict_stereo=True):
     mol: OEMol
     strict_stereo: bool
         If False, omega will generate conformer without the specific stereochemistry
+    charge_cache: fragmenter.cache.ResultCache, optional, default None
+        cache for partial charges and Wiberg bond orders
+    wbo_threshold: float, optional, default 1.2
+        Wiberg bond order above which bonds are not cut
+    stats: fragmenter.stats.ParentStats, optional, default None
+        If provided, time spent charging, tagging and growing fragments is recorded
+    conformer_budget: str, optional, default None
+        see chemi.get_charges
+    naming: str, optional, default None
+        see chemi.normalize_molecule
 
     Returns
     -------
@@ -284,8 +864,33 @@ def _generate_fragments(mol, strict_stereo=True):
     frags: dict of AtomBondSet mapped to rotatable bond index the fragment was built up from.
     """
 
+    if stats is None:
+        stats = NULL_STATS
+    charged = _charge_parent(mol, strict_stereo=strict_stereo, charge_cache=charge_cache, stats=stats,
+                             conformer_budget=conformer_budget, naming=naming)
+    if not charged:
+        return False
+
+    with stats.stage('tagging'):
+        tagged_rings, tagged_fgroups = tag_molecule(charged, wbo_threshold=wbo_threshold)
+    with stats.stage('growth'):
+        frags = _build_fragments(charged, MolArrays(charged), tagged_rings, tagged_fgroups, wbo_threshold)
+    if stats is not NULL_STATS:
+        # Fragments built on different rotors can be the same
+        stats.count('rotors', len(frags))
+        stats.count('base_fragments', len(set(FragmentRecord.from_atom_bond_set(frag) for frag in frags.values())))
+
+    return charged, frags
+
+
+def _charge_parent(mol, strict_stereo=True, charge_cache=None, stats=None, conformer_budget=None, naming=None):
+    """
+    Charge molecule and check that Wiberg bond orders were calculated. Returns False if the molecule cannot be
+    fragmented.
+    """
     try:
-        charged = get_charges(mol, keep_confs=1, strict_stereo=strict_stereo)
+        charged = get_charges(mol, keep_confs=1, strict_stereo=strict_stereo, cache=charge_cache, stats=stats,
+                              conformer_budget=conformer_budget, naming=naming)
     except RuntimeError:
         logger().warning("Could not charge molecule {} so no WBO were calculated. Cannot fragment molecule {}".format(mol.GetTitle(),
                                                                                                                       mol.GetTitle()))
@@ -299,18 +904,132 @@ def _generate_fragments(mol, strict_stereo=True):
         except ValueError:
             logger().warning("WBO were not calculate. Cannot fragment molecule {}".format(charged.GetTitle()))
             return False
+    return charged
+
 
-    tagged_rings, tagged_fgroups = tag_molecule(charged)
+def _build_fragments(charged, mol_arrays, tagged_rings, tagged_fgroups, wbo_threshold=1.2):
+    """
+    Build a fragment around every rotatable bond of a tagged, charged molecule.
+
+    Returns
+    -------
+    frags: dict of AtomBondSet mapped to rotatable bond index the fragment was built up from.
+    """
+    ring_substituents = RingSubstituents(mol_arrays, tagged_rings, tagged_fgroups)
 
     # Iterate over bonds
     frags = {}
     for bond in charged.GetBonds():
         if bond.IsRotor():
-            atoms, bonds = _build_frag(bond=bond, mol=charged, tagged_fgroups=tagged_fgroups, tagged_rings=tagged_rings)
+            atoms, bonds = _build_frag_from_arrays(bond.GetIdx(), mol_arrays, tagged_fgroups, tagged_rings,
+                                                   ring_substituents, wbo_threshold)
             atom_bond_set = _to_AtomBondSet(charged, atoms, bonds)
             frags[bond.GetIdx()] = atom_bond_set
+    return frags
 
-    return charged, frags
+
+def sweep_fragments(molecule, wbo_thresholds=(1.2,), MAX_ROTORS=(2,), strict_stereo=False, combinatorial=True,
+                    remove_map=True, charge_cache=None):
+    """
+    Generate fragments for a grid of Wiberg bond order thresholds and MAX_ROTORS values. Every parent is charged and
+    tagged once. Base fragments are built once per threshold and fragment combinations are enumerated once per
+    threshold for the largest MAX_ROTORS and filtered for the smaller values.
+
+    Parameters
+    ----------
+    molecule: OEMol or list of OEMols to fragment
+    wbo_thresholds: list of floats
+        Wiberg bond order thresholds. See generate_fragments
+    MAX_ROTORS: list of ints
+        rotor thresholds for combinatorial
+    strict_stereo, combinatorial, remove_map, charge_cache:
+        see generate_fragments
+
+    Returns
+    -------
+    fragments: dict
+        maps (wbo_threshold, MAX_ROTORS) to the mapping of parent SMILES to fragment SMILES that generate_fragments
+        returns for those parameters
+    """
+    try:
+        molecules = list(molecule)
+    except TypeError:
+        molecules = [molecule]
+
+    fragments = {(wbo_threshold, max_rotors): {} for wbo_threshold in wbo_thresholds for max_rotors in MAX_ROTORS}
+    for molecule in molecules:
+        molecule = _prepare_parent(molecule, remove_map)
+        charged = _charge_parent(molecule, strict_stereo=strict_stereo, charge_cache=charge_cache)
+        if not charged:
+            logger().warning('Skipping {}, SMILES: {}'.format(molecule.GetTitle(), oechem.OECreateSmiString(molecule)))
+            continue
+        parent_smiles = mol_to_smiles(molecule, isomeric=True, explicit_hydrogen=False, mapped=False)
+
+        # Functional group and ring tags do not depend on the threshold
+        tagged_fgroups = _tag_fgroups(charged)
+        tagged_rings = _tag_rings(charged)
+        mol_arrays = MolArrays(charged)
+        smiles_cache = {}
+        for wbo_threshold in wbo_thresholds:
+            merged_fgroups = _ring_fgroup_union(charged, tagged_rings, tagged_fgroups, wbo_threshold=wbo_threshold)
+            frag_list = list(_build_fragments(charged, mol_arrays, tagged_rings, merged_fgroups,
+                                              wbo_threshold).values())
+            base_records = [FragmentRecord.from_atom_bond_set(frag) for frag in frag_list]
+            if combinatorial:
+                comb_list = GetFragmentAtomBondSetCombinations(frag_list, MAX_ROTORS=max(MAX_ROTORS), mol=charged,
+                                                               return_records=True)
+            for max_rotors in MAX_ROTORS:
+                if combinatorial:
+                    records = [comb for comb in comb_list if comb.rotors <= max_rotors] + base_records
+                else:
+                    records = base_records
+                smiles = frag_to_smiles(records, charged, smiles_cache=smiles_cache)
+                fragments[(wbo_threshold, max_rotors)][parent_smiles] = _fragment_smiles_list(smiles, molecule)
+    return fragments
+
+
+# Default functional group SMARTS and compiled searches keyed by the contents of the SMARTS dictionary
+_FGROUP_SMARTS = None
+_FGROUP_SEARCHES = {}
+
+
+def load_fgroup_smarts():
+    """
+    Load the default functional group SMARTS from 'fgroup_smarts.yml'. The file is only read once per process.
+
+    Returns
+    -------
+    fgroups_smarts: dict
+        maps functional groups to their smarts pattern
+    """
+    global _FGROUP_SMARTS
+    if _FGROUP_SMARTS is None:
+        fn = resource_filename('fragmenter', os.path.join('data', 'fgroup_smarts.yml'))
+        with open(fn, 'r') as f:
+            _FGROUP_SMARTS = yaml.safe_load(f)
+    return _FGROUP_SMARTS
+
+
+def get_fgroup_searches(fgroups_smarts=None):
+    """
+    Compiled substructure searches for functional groups. Searches are cached by the contents of fgroups_smarts so
+    user generated dictionaries are only parsed once too.
+
+    Parameters
+    ----------
+    fgroups_smarts: dictionary of functional groups mapped to their smarts pattern.
+        Default is None. It uses 'fgroup_smarts.yaml'
+
+    Returns
+    -------
+    searches: list of (functional group, OESubSearch) tuples in the order of fgroups_smarts
+    """
+    if not fgroups_smarts:
+        fgroups_smarts = load_fgroup_smarts()
+    key = tuple(fgroups_smarts.items())
+    if key not in _FGROUP_SEARCHES:
+        _FGROUP_SEARCHES[key] = [(f_group, get_subsearch(smarts)) for f_group, smarts in key]
+    return _FGROUP_SEARCHES[key]
 
 
 def _tag_fgroups(mol, fgroups_smarts=None):
@@ -330,19 +1049,8 @@ def _tag_fgroups(mol, fgroups_smarts=None):
         a dictionary that maps indexed functional groups to corresponding atom and bond indices in mol
 
     """
-    if not fgroups_smarts:
-        # Load yaml file
-        fn = resource_filename('fragmenter', os.path.join('data', 'fgroup_smarts.yml'))
-        f = open(fn, 'r')
-        fgroups_smarts = yaml.safe_load(f)
-        f.close()
-
     fgroup_tagged = {}
-    for f_group in fgroups_smarts:
-        qmol = oechem.OEQMol()
-        if not oechem.OEParseSmarts(qmol, fgroups_smarts[f_group]):
-            print('OEParseSmarts failed')
-        ss = oechem.OESubSearch(qmol)
+    for f_group, ss in get_fgroup_searches(fgroups_smarts):
         oechem.OEPrepareSearch(mol, ss)
 
         for i, match in enumerate(ss.Match(mol, True)):
@@ -402,7 +1110,12 @@ def _tag_rings(mol):
 
 def _ring_fgroup_union(mol, tagged_rings, tagged_fgroups, wbo_threshold=1.2):
     """
-    This function combines rings and fgroups that are conjugated (the bond between them has a Wiberg bond order > 1.2)
+    This function combines rings and fgroups that are conjugated (the bond between them has a Wiberg bond order >
+    wbo_threshold)
+
+    Functional groups that share more than one atom are combined, and ring systems are combined with functional groups
+    they share more than one atom with or that they are bonded to with a conjugated or non-rotatable bond. Merging is
+    transitive: if A overlaps B and B overlaps C, A, B and C all map to the same atoms and bonds.
 
     Parameters
     ----------
@@ -411,55 +1124,76 @@ def _ring_fgroup_union(mol, tagged_rings, tagged_fgroups, wbo_threshold=1.2):
         map of ringsystem indices to ring atom and bond indices
     tagged_fgroup: dict
         map of fgroup to fgroup atom and bond indices
+    wbo_threshold: float, optional, default 1.2
+        Wiberg bond order above which the bond between a ring and a functional group is not cut
 
     Returns
     -------
     tagged_fgroup: dict
         updated tagged_fgroup mapping with rings that shouldn't be fragmented from fgroups
     """
-    ring_idxs = list(tagged_rings.keys())
-    fgroups = list(tagged_fgroups.keys())
-    tagged_fgroups = copy.deepcopy(tagged_fgroups)
-
-    # Check if fgroups are overlapping. If they are - combine them.
-    for func_group_1, func_group_2 in itertools.combinations(list(tagged_fgroups.keys()), 2):
-        atoms_intersection = tagged_fgroups[func_group_1][0].intersection(tagged_fgroups[func_group_2][0])
-        if len(atoms_intersection) > 1:
-            # Combine fgroups
-            atoms_union = tagged_fgroups[func_group_1][0].union(tagged_fgroups[func_group_2][0])
-            bonds_union = tagged_fgroups[func_group_1][-1].union(tagged_fgroups[func_group_2][-1])
-            tagged_fgroups[func_group_1] = (atoms_union, bonds_union)
-            tagged_fgroups[func_group_2] = (atoms_union, bonds_union)
-    for idx in ring_idxs:
-        for fgroup in fgroups:
-            atom_intersection = tagged_rings[idx][0].intersection(tagged_fgroups[fgroup][0])
-            if len(atom_intersection) > 1:
-                # Must include ring if including fgroup. Add ring atoms and bonds to fgroup
-                atoms_union = tagged_rings[idx][0].union(tagged_fgroups[fgroup][0])
-                bonds_union = tagged_rings[idx][-1].union(tagged_fgroups[fgroup][-1])
-                tagged_fgroups[fgroup] = (atoms_union, bonds_union)
-            elif len(atom_intersection) > 0:
-                # Check Wiberg bond order of bond
-                # First find bond connectiong fgroup and ring
-                atom = mol.GetAtom(oechem.OEHasAtomIdx(atom_intersection.pop()))
-                for a in atom.GetAtoms():
-                    if a.GetIdx() in tagged_fgroups[fgroup][0]:
-                        bond = mol.GetBond(a, atom)
-                        if bond.GetData('WibergBondOrder') > wbo_threshold:
-                            # Don't cut off ring.
-                            atoms_union = tagged_rings[idx][0].union(tagged_fgroups[fgroup][0])
-                            bonds_union = tagged_rings[idx][-1].union(tagged_fgroups[fgroup][-1])
-                            tagged_fgroups[fgroup] = (atoms_union, bonds_union)
-                        # Should I also combine non-rotatable rings? This will pick up the alkyn in ponatinib?
-                        if not bond.IsRotor():
-                            atoms_union = tagged_rings[idx][0].union(tagged_fgroups[fgroup][0])
-                            bonds_union = tagged_rings[idx][-1].union(tagged_fgroups[fgroup][-1])
-                            tagged_fgroups[fgroup] = (atoms_union, bonds_union)
-                        # Do something when it's neither for edge cases (Afatinib)?
-    return tagged_fgroups
-
-
-def tag_molecule(mol, func_group_smarts=None):
+    # Disjoint sets over functional groups and ring systems
+    parent = {}
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(node_1, node_2):
+        root_1, root_2 = find(node_1), find(node_2)
+        if root_1 != root_2:
+            parent[root_2] = root_1
+
+    # Which groups each atom is in
+    memberships = {}
+    for fgroup, (atoms, bonds) in tagged_fgroups.items():
+        parent[('fgroup', fgroup)] = ('fgroup', fgroup)
+        for a_idx in atoms:
+            memberships.setdefault(a_idx, []).append(('fgroup', fgroup))
+    for idx, (atoms, bonds) in tagged_rings.items():
+        parent[('ring', idx)] = ('ring', idx)
+        for a_idx in atoms:
+            if a_idx in memberships:
+                memberships[a_idx].append(('ring', idx))
+
+    # Count atoms shared by each pair of groups
+    shared = {}
+    for a_idx, nodes in memberships.items():
+        for node_1, node_2 in itertools.combinations(nodes, 2):
+            if node_1[0] == 'ring' and node_2[0] == 'ring':
+                continue
+            shared.setdefault((node_1, node_2), []).append(a_idx)
+
+    for (node_1, node_2), atoms in shared.items():
+        if len(atoms) > 1:
+            # Overlapping fgroups or must include ring if including fgroup.
+            union(node_1, node_2)
+        elif node_1[0] != node_2[0]:
+            # Check Wiberg bond order of bond connecting fgroup and ring
+            fgroup = node_1[1] if node_1[0] == 'fgroup' else node_2[1]
+            atom = mol.GetAtom(oechem.OEHasAtomIdx(atoms[0]))
+            for a in atom.GetAtoms():
+                if a.GetIdx() in tagged_fgroups[fgroup][0]:
+                    bond = mol.GetBond(a, atom)
+                    # Don't cut off ring if conjugated. Also combine non-rotatable rings (alkyn in ponatinib)
+                    if bond.GetData('WibergBondOrder') > wbo_threshold or not bond.IsRotor():
+                        union(node_1, node_2)
+
+    components = {}
+    for node in parent:
+        root = find(node)
+        if root not in components:
+            components[root] = (set(), set())
+        atoms, bonds = tagged_fgroups[node[1]] if node[0] == 'fgroup' else tagged_rings[node[1]]
+        components[root][0].update(atoms)
+        components[root][1].update(bonds)
+
+    return {fgroup: components[find(('fgroup', fgroup))] for fgroup in tagged_fgroups}
+
+
+def tag_molecule(mol, func_group_smarts=None, wbo_threshold=1.2):
     """
     Tags atoms and molecules in functional groups and ring systems. The molecule gets tagged and the function returns
     a 2 dictionaries that map
@@ -471,6 +1205,8 @@ def tag_molecule(mol, func_group_smarts=None):
     mol: OEMol
     func_group_smarts: dict
         dictionary mapping functional groups to SMARTS. Default is None and uses shipped yaml file.
+    wbo_threshold: float, optional, default 1.2
+        Wiberg bond order above which rings and functional groups are combined. See _ring_fgroup_union
 
     Returns
     -------
@@ -485,7 +1221,8 @@ def tag_molecule(mol, func_group_smarts=None):
     tagged_func_group = _tag_fgroups(mol, func_group_smarts)
     tagged_rings = _tag_rings(mol)
 
-    tagged_func_group = _ring_fgroup_union(mol=mol, tagged_fgroups=tagged_func_group, tagged_rings=tagged_rings)
+    tagged_func_group = _ring_fgroup_union(mol=mol, tagged_fgroups=tagged_func_group, tagged_rings=tagged_rings,
+                                           wbo_threshold=wbo_threshold)
 
     return tagged_rings, tagged_func_group
 
@@ -574,11 +1311,11 @@ def _is_ortho(bond, rot_bond, next_bond):
     return bool(intersection)
 
 
-def _build_frag(bond, mol, tagged_fgroups, tagged_rings):
+def _build_frag(bond, mol, tagged_fgroups, tagged_rings, wbo_threshold=1.2):
     """
     This functions builds a fragment around a rotatable bond. It grows out one bond in all directions
     If the next atoms is in a ring or functional group, it keeps that.
-    If the next bond has a Wiberg bond order > 1.2, grow another bond and check next bond's Wiberg bond order.
+    If the next bond has a Wiberg bond order > wbo_threshold, grow another bond and check next bond's Wiberg bond order.
 
     Parameters
     ----------
@@ -588,6 +1325,8 @@ def _build_frag(bond, mol, tagged_fgroups, tagged_rings):
         maps functional groups to atoms and bond indices on mol
     tagged_rings: dict
         maps ringsystem index to atom and bond indices in mol
+    wbo_threshold: float, optional, default 1.2
+        Wiberg bond order above which bonds are not cut
 
     Returns
     -------
@@ -605,23 +1344,23 @@ def _build_frag(bond, mol, tagged_fgroups, tagged_rings):
 
     atoms.add(beg_idx)
     atoms_nb, bonds_nb = iterate_nbratoms(mol=mol, rotor_bond=bond, atom=beg, pair=end, fgroup_tagged=tagged_fgroups,
-                                          tagged_rings=tagged_rings)
+                                          tagged_rings=tagged_rings, wbo_threshold=wbo_threshold)
     atoms = atoms.union(atoms_nb)
     bonds = bonds.union(bonds_nb)
 
     atoms.add(end_idx)
     atoms_nb, bonds_nb = iterate_nbratoms(mol=mol, rotor_bond=bond, atom=end, pair=beg, fgroup_tagged=tagged_fgroups,
-                                          tagged_rings=tagged_rings)
+                                          tagged_rings=tagged_rings, wbo_threshold=wbo_threshold)
     atoms = atoms.union(atoms_nb)
     bonds = bonds.union(bonds_nb)
 
     return atoms, bonds
 
 
-def iterate_nbratoms(mol, rotor_bond, atom, pair, fgroup_tagged, tagged_rings, i=0):
+def iterate_nbratoms(mol, rotor_bond, atom, pair, fgroup_tagged, tagged_rings, i=0, wbo_threshold=1.2):
     """
     This function iterates over neighboring atoms and checks if it's part of a functional group, ring, or if the next
-    bond has a Wiberg bond order > 1.2.
+    bond has a Wiberg bond order > wbo_threshold.
 
     Parameters
     ----------
@@ -636,6 +1375,8 @@ def iterate_nbratoms(mol, rotor_bond, atom, pair, fgroup_tagged, tagged_rings, i
         map of ringsystem index and atom and bond indices in mol
     rotor_bond: Openeye Bond base
         rotatable bond that the fragment is being built on
+    wbo_threshold: float, optional, default 1.2
+        Wiberg bond order above which bonds are not cut
 
     Returns
     -------
@@ -679,7 +1420,7 @@ def iterate_nbratoms(mol, rotor_bond, atom, pair, fgroup_tagged, tagged_rings, i
 
             if i > 0:
                 wiberg = next_bond.GetData('WibergBondOrder')
-                if wiberg < 1.2:
+                if wiberg < wbo_threshold:
                     #atoms_2.remove(a_idx)
                     continue
 
@@ -704,7 +1445,7 @@ def iterate_nbratoms(mol, rotor_bond, atom, pair, fgroup_tagged, tagged_rings, i
 
             for nb_a in a.GetAtoms():
                 nn_bond = mol.GetBond(a, nb_a)
-                if (nn_bond.GetData('WibergBondOrder') > 1.2) and (not nn_bond.IsInRing()) and (not nn_bond.GetIdx() in bonds_2):
+                if (nn_bond.GetData('WibergBondOrder') > wbo_threshold) and (not nn_bond.IsInRing()) and (not nn_bond.GetIdx() in bonds_2):
                     # Check the degree of the atoms in the bond
                     deg_1 = a.GetDegree()
                     deg_2 = nb_a.GetDegree()
@@ -719,6 +1460,313 @@ def iterate_nbratoms(mol, rotor_bond, atom, pair, fgroup_tagged, tagged_rings, i
     return _iterate_nbratoms(mol, rotor_bond, atom, pair, fgroup_tagged, tagged_rings, atoms_2=set(), bonds_2=set(), i=0)
 
 
+class MolArrays(object):
+    """
+    Per molecule arrays used to grow fragments without going through OpenEye atom and bond objects.
+
+    Attributes
+    ----------
+    bond_atoms: numpy array
+        (n_bonds, 2) begin and end atom index of each bond
+    wbo: numpy array
+        Wiberg bond order of each bond, indexed by bond index
+    bond_in_ring, atom_in_ring: numpy array of bool
+    rotor: numpy array of bool
+        True for rotatable bonds
+    ring_system: numpy array of int
+        ring system index of each atom (see _tag_rings). 0 if the atom is not in a ring
+    fgroup: list
+        functional group tag of each atom (see _tag_fgroups). None if the atom is not in a functional group
+    neighbors: list of tuples
+        (neighbor atom index, bond index) pairs of each atom in the same order as atom.GetAtoms()
+    """
+    __slots__ = ('bond_atoms', 'wbo', 'bond_in_ring', 'rotor', 'atom_in_ring', 'ring_system', 'fgroup', 'neighbors')
+
+    def __init__(self, mol):
+        """
+        Parameters
+        ----------
+        mol: charged OEMol tagged with tag_molecule
+        """
+        natoms = mol.GetMaxAtomIdx()
+        nbonds = mol.GetMaxBondIdx()
+        self.bond_atoms = np.zeros((nbonds, 2), dtype=int)
+        self.wbo = np.zeros(nbonds)
+        self.bond_in_ring = np.zeros(nbonds, dtype=bool)
+        self.rotor = np.zeros(nbonds, dtype=bool)
+        for bond in mol.GetBonds():
+            self.bond_atoms[bond.GetIdx()] = bond.GetBgnIdx(), bond.GetEndIdx()
+            self.wbo[bond.GetIdx()] = bond.GetData('WibergBondOrder')
+            self.bond_in_ring[bond.GetIdx()] = bond.IsInRing()
+            self.rotor[bond.GetIdx()] = bond.IsRotor()
+
+        self.atom_in_ring = np.zeros(natoms, dtype=bool)
+        self.ring_system = np.zeros(natoms, dtype=int)
+        self.fgroup = [None] * natoms
+        self.neighbors = [()] * natoms
+        for atom in mol.GetAtoms():
+            idx = atom.GetIdx()
+            self.atom_in_ring[idx] = atom.IsInRing()
+            if atom.HasData('ringsystem'):
+                self.ring_system[idx] = atom.GetData('ringsystem')
+            if atom.HasData('fgroup'):
+                self.fgroup[idx] = atom.GetData('fgroup')
+            self.neighbors[idx] = tuple((nbr.GetIdx(), mol.GetBond(atom, nbr).GetIdx()) for nbr in atom.GetAtoms())
+
+
+def _build_frag_from_arrays(bond_idx, mol_arrays, tagged_fgroups, tagged_rings, ring_substituents, wbo_threshold=1.2):
+    """
+    Array based version of _build_frag. Builds the fragment around a rotatable bond with grow_fragment.
+
+    Parameters
+    ----------
+    bond_idx: int
+        index of rotatable bond
+    mol_arrays: MolArrays
+    tagged_fgroups: dict
+        maps functional groups to atoms and bond indices on mol
+    tagged_rings: dict
+        maps ringsystem index to atom and bond indices in mol
+    ring_substituents: function
+        ring_substituents(bond_idx, rotor_bond_idx, ring_idx) returns the sets of atom and bond indices of ring
+        substituents that should be kept (see _ring_substiuents)
+    wbo_threshold: float, optional, default 1.2
+        Wiberg bond order above which bonds are not cut
+
+    Returns
+    -------
+    atoms, bonds: sets of atom and bond indices for fragment
+    """
+    beg_idx, end_idx = (int(idx) for idx in mol_arrays.bond_atoms[bond_idx])
+    atoms = {beg_idx, end_idx}
+    bonds = {bond_idx}
+    for atom, pair in ((beg_idx, end_idx), (end_idx, beg_idx)):
+        atoms_nb, bonds_nb = grow_fragment(mol_arrays, bond_idx, atom, pair, tagged_fgroups, tagged_rings,
+                                           ring_substituents, wbo_threshold)
+        atoms.update(atoms_nb)
+        bonds.update(bonds_nb)
+    return atoms, bonds
+
+
+def grow_fragment(mol_arrays, rotor_bond_idx, atom_idx, pair_idx, tagged_fgroups, tagged_rings, ring_substituents,
+                  wbo_threshold=1.2):
+    """
+    Iterative version of iterate_nbratoms. Grows a fragment out from atom_idx (away from pair_idx) with an explicit
+    stack instead of recursion, so long conjugated linkers do not run into the recursion limit.
+
+    The result is the same as iterate_nbratoms, including how it handles nested growth: atoms and bonds added directly
+    by a nested growth step are kept, but rings and functional groups that a nested step adds are local to that step.
+
+    Parameters
+    ----------
+    mol_arrays: MolArrays
+    rotor_bond_idx: int
+        rotatable bond that the fragment is being built on
+    atom_idx: int
+        atom that will be iterated over
+    pair_idx: int
+        atom that's bonded to this atom in rotor bond
+    tagged_fgroups: dict
+        map of functional group and atom and bond indices in mol
+    tagged_rings: dict
+        map of ringsystem index and atom and bond indices in mol
+    ring_substituents: function
+        see _build_frag_from_arrays
+    wbo_threshold: float, optional, default 1.2
+        Wiberg bond order above which bonds are not cut
+
+    Returns
+    -------
+    atoms, bonds: sets of atom and bond indices of the fragment
+    """
+    neighbors = mol_arrays.neighbors
+    wbo = mol_arrays.wbo
+    bond_in_ring = mol_arrays.bond_in_ring
+    atom_in_ring = mol_arrays.atom_in_ring
+    ring_system = mol_arrays.ring_system
+    fgroup = mol_arrays.fgroup
+
+    # Each frame is [atom, rotor bond, i, atoms, bonds, owns sets, outer position, current neighbor, inner position].
+    # A frame that does not own its sets shares them with the frame that started it until it adds a ring or
+    # functional group, then it works on a copy.
+    ATOM, ROTOR, I, ATOMS, BONDS, OWNS, OUTER, NBR, INNER = range(9)
+    stack = [[atom_idx, rotor_bond_idx, 0, set(), set(), True, 0, None, 0]]
+
+    def _union(frame, atoms, bonds):
+        if frame[OWNS]:
+            frame[ATOMS] |= atoms
+            frame[BONDS] |= bonds
+        else:
+            frame[ATOMS] = frame[ATOMS] | atoms
+            frame[BONDS] = frame[BONDS] | bonds
+            frame[OWNS] = True
+
+    while True:
+        frame = stack[-1]
+        if frame[NBR] is None:
+            atom_nbrs = neighbors[frame[ATOM]]
+            if frame[OUTER] == len(atom_nbrs):
+                stack.pop()
+                if not stack:
+                    return frame[ATOMS], frame[BONDS]
+                continue
+            a_idx, nb_idx = atom_nbrs[frame[OUTER]]
+            frame[OUTER] += 1
+            if a_idx == pair_idx:
+                continue
+            if nb_idx in frame[BONDS]:
+                if ring_system[a_idx] and fgroup[a_idx] is not None:
+                    ring_idx = int(ring_system[a_idx])
+                elif ring_system[frame[ATOM]] and fgroup[frame[ATOM]] is not None:
+                    ring_idx = int(ring_system[frame[ATOM]])
+                else:
+                    continue
+                # Add ring and continue
+                _union(frame, *tagged_rings[ring_idx])
+                _union(frame, *ring_substituents(nb_idx, frame[ROTOR], ring_idx))
+                continue
+
+            if frame[I] > 0 and wbo[nb_idx] < wbo_threshold:
+                continue
+
+            frame[ATOMS].add(a_idx)
+            frame[BONDS].add(nb_idx)
+            if atom_in_ring[a_idx]:
+                ring_idx = int(ring_system[a_idx])
+                _union(frame, *tagged_rings[ring_idx])
+                # Find non-rotatable sustituents
+                _union(frame, *ring_substituents(nb_idx, frame[ROTOR], ring_idx))
+            if fgroup[a_idx] is not None:
+                _union(frame, *tagged_fgroups[fgroup[a_idx]])
+            frame[NBR] = a_idx
+            frame[INNER] = 0
+            continue
+
+        a_idx = frame[NBR]
+        a_nbrs = neighbors[a_idx]
+        if frame[INNER] == len(a_nbrs):
+            frame[NBR] = None
+            continue
+        nb_a_idx, nn_idx = a_nbrs[frame[INNER]]
+        frame[INNER] += 1
+        if wbo[nn_idx] > wbo_threshold and not bond_in_ring[nn_idx] and nn_idx not in frame[BONDS]:
+            # Check the degree of the atoms in the bond
+            if len(a_nbrs) == 1 or len(neighbors[nb_a_idx]) == 1:
+                continue
+            frame[ATOMS].add(nb_a_idx)
+            frame[BONDS].add(nn_idx)
+            frame[I] += 1
+            stack.append([nb_a_idx, nn_idx, frame[I], frame[ATOMS], frame[BONDS], False, 0, None, 0])
+
+
+class RingSubstituents(object):
+    """
+    Memoized version of _ring_substiuents for one charged molecule.
+
+    The substituents of each ring system (bond to the substituent, functional group of the substituent and ring
+    systems bonded to the ring) do not depend on the rotatable bond, so they are found once per ring system and
+    reused for every rotor that reaches that ring. Only the ortho checks against the rotatable bond are done per call.
+
+    Instances are called like the ring_substituents function grow_fragment takes.
+    """
+    # Kinds of ring substituents
+    _KEEP, _ORTHO, _RING = range(3)
+
+    def __init__(self, mol_arrays, tagged_rings, tagged_fgroups):
+        """
+        Parameters
+        ----------
+        mol_arrays: MolArrays
+        tagged_rings: dict
+            mapping of ring index and atom and bonds indices
+        tagged_fgroups: dict
+            mapping of functional group and atom and bond indices
+        """
+        self.mol_arrays = mol_arrays
+        self.tagged_rings = tagged_rings
+        self.tagged_fgroups = tagged_fgroups
+        self._substituents = {}
+        self._attached_bonds = {}
+
+    def __call__(self, bond_idx, rotor_bond_idx, ring_idx):
+        """
+        Parameters
+        ----------
+        bond_idx: int
+            current bond that the iterator is looking at
+        rotor_bond_idx: int
+            rotatable bond that fragment is being grown on
+        ring_idx: int
+            ring index
+
+        Returns
+        -------
+        rs_atoms, rs_bonds: sets of ring substituents atoms and bonds indices
+        """
+        rs_atoms = set()
+        rs_bonds = set()
+        for a_idx, rs_bond_idx, kind, atoms, bonds in self.substituents(ring_idx):
+            if a_idx in rs_atoms:
+                continue
+            if kind != self._KEEP and not self._is_ortho(rs_bond_idx, rotor_bond_idx, bond_idx):
+                continue
+            if kind != self._RING:
+                rs_atoms.add(a_idx)
+            rs_bonds.add(rs_bond_idx)
+            rs_atoms |= atoms
+            rs_bonds |= bonds
+        return rs_atoms, rs_bonds
+
+    def substituents(self, ring_idx):
+        """
+        Substituents of a ring system in the order _ring_substiuents visits them.
+
+        Returns
+        -------
+        list of (atom index, bond index, kind, atoms, bonds) tuples. kind is _KEEP for substituents that are always
+        kept, _ORTHO for substituents bonded with a rotatable bond and _RING for other ring systems. atoms and bonds
+        are the functional group of the substituent or the atoms and bonds of the other ring system.
+        """
+        if ring_idx in self._substituents:
+            return self._substituents[ring_idx]
+
+        arrays = self.mol_arrays
+        substituents = []
+        r_atoms, r_bonds = self.tagged_rings[ring_idx]
+        for atom_idx in r_atoms:
+            for a_idx, rs_bond_idx in arrays.neighbors[atom_idx]:
+                if not arrays.atom_in_ring[a_idx]:
+                    kind = self._ORTHO if arrays.rotor[rs_bond_idx] else self._KEEP
+                    fgroup = arrays.fgroup[a_idx]
+                    atoms, bonds = self.tagged_fgroups[fgroup] if fgroup is not None else (set(), set())
+                else:
+                    r_idx2 = int(arrays.ring_system[a_idx])
+                    if r_idx2 == ring_idx:
+                        continue
+                    kind = self._RING
+                    atoms, bonds = self.tagged_rings[r_idx2]
+                substituents.append((a_idx, rs_bond_idx, kind, atoms, bonds))
+        self._substituents[ring_idx] = substituents
+        return substituents
+
+    def _attached(self, bond_idx):
+        # Bonds attached to either atom of bond_idx
+        if bond_idx not in self._attached_bonds:
+            neighbors = self.mol_arrays.neighbors
+            self._attached_bonds[bond_idx] = frozenset(b for atom_idx in self.mol_arrays.bond_atoms[bond_idx]
+                                                       for _, b in neighbors[atom_idx])
+        return self._attached_bonds[bond_idx]
+
+    def _is_ortho(self, bond_idx, rotor_bond_idx, next_bond_idx):
+        # Same as _is_ortho on bond indices
+        bond_attached = self._attached(bond_idx)
+        if bond_attached & self._attached(rotor_bond_idx):
+            return True
+        if not self.mol_arrays.bond_in_ring[next_bond_idx]:
+            return bool(bond_attached & self._attached(next_bond_idx))
+        return False
+
+
 def _ring_substiuents(mol, bond, rotor_bond, tagged_rings, ring_idx, fgroup_tagged):
     """
     This function finds ring substituents that shouldn't be cut off
@@ -781,15 +1829,21 @@ def _ring_substiuents(mol, bond, rotor_bond, tagged_rings, ring_idx, fgroup_tagg
     return rs_atoms, rs_bonds
 
 
-def frag_to_smiles(frags, mol):
+def frag_to_smiles(frags, mol, smiles_cache=None, stats=None):
     """
-    Convert fragments (AtomBondSet) to canonical isomeric SMILES string
+    Convert fragments (AtomBondSet) to canonical isomeric SMILES string. Fragments with the same atoms and bonds are
+    only converted once.
+
     Parameters
     ----------
     frags: list
+        list of OE AtomBondSet or FragmentRecord
     mol: OEMol
-    OESMILESFlag: str
-        Either 'ISOMERIC' or 'DEFAULT'. This flag determines which OE function to use to generate SMILES string
+    smiles_cache: dict, optional, default None
+        maps FragmentRecord to SMILES. Fragments in the cache are not converted again and new fragments are added to
+        it. Only share a cache between calls on the same molecule.
+    stats: fragmenter.stats.ParentStats, optional, default None
+        If provided, the number of fragments canonicalized is counted
 
     Returns
     -------
@@ -797,33 +1851,59 @@ def frag_to_smiles(frags, mol):
 
     """
 
-    smiles = {}
+    # Remove exact duplicates before subsetting the molecule and canonicalizing
+    unique_frags = {}
     for frag in frags:
-        fragatompred = oechem.OEIsAtomMember(frag.GetAtoms())
-        fragbondpred = oechem.OEIsBondMember(frag.GetBonds())
-
-        #fragment = oechem.OEGraphMol()
-        fragment = oechem.OEMol()
-        adjustHCount = True
-        oechem.OESubsetMol(fragment, mol, fragatompred, fragbondpred, adjustHCount)
-
-        oechem.OEPerceiveChiral(fragment)
-        # sanity check that all atoms are bonded
-        for atom in fragment.GetAtoms():
-            if not list(atom.GetBonds()):
-                raise Warning("Yikes!!! An atom that is not bonded to any other atom in the fragment. "
-                              "You probably ran into a bug. Please report the input molecule to the issue tracker")
-        #s = oechem.OEMolToSmiles(fragment)
-        #s2 = fragmenter.utils.create_mapped_smiles(fragment, tagged=False, explicit_hydrogen=False)
-        s = mol_to_smiles(fragment, mapped=False, explicit_hydrogen=True, isomeric=True)
+        record = frag if isinstance(frag, FragmentRecord) else FragmentRecord.from_atom_bond_set(frag)
+        if record not in unique_frags:
+            unique_frags[record] = []
+        unique_frags[record].append(frag)
+
+    smiles = {}
+    canonicalized = 0
+    for record, duplicates in unique_frags.items():
+        if smiles_cache is not None and record in smiles_cache:
+            s = smiles_cache[record]
+        else:
+            s = _fragment_to_smiles(duplicates[0], mol)
+            canonicalized += 1
+            if smiles_cache is not None:
+                smiles_cache[record] = s
 
         if s not in smiles:
             smiles[s] = []
-        smiles[s].append(frag)
+        smiles[s].extend(duplicates)
 
+    if stats is not None:
+        stats.count('smiles_canonicalized', canonicalized)
     return smiles
 
 
+def _fragment_to_smiles(frag, mol):
+    """
+    Canonical isomeric SMILES with explicit hydrogens of one fragment (AtomBondSet or FragmentRecord) of mol
+    """
+    if isinstance(frag, FragmentRecord):
+        frag = frag.to_atom_bond_set(mol)
+    fragatompred = oechem.OEIsAtomMember(frag.GetAtoms())
+    fragbondpred = oechem.OEIsBondMember(frag.GetBonds())
+
+    #fragment = oechem.OEGraphMol()
+    fragment = oechem.OEMol()
+    adjustHCount = True
+    oechem.OESubsetMol(fragment, mol, fragatompred, fragbondpred, adjustHCount)
+
+    oechem.OEPerceiveChiral(fragment)
+    # sanity check that all atoms are bonded
+    for atom in fragment.GetAtoms():
+        if not list(atom.GetBonds()):
+            raise Warning("Yikes!!! An atom that is not bonded to any other atom in the fragment. "
+                          "You probably ran into a bug. Please report the input molecule to the issue tracker")
+    #s = oechem.OEMolToSmiles(fragment)
+    #s2 = fragmenter.utils.create_mapped_smiles(fragment, tagged=False, explicit_hydrogen=False)
+    return mol_to_smiles(fragment, mapped=False, explicit_hydrogen=True, isomeric=True)
+
+
 def _sort_by_rotbond(ifs, outdir):
     """
 
@@ -852,7 +1932,7 @@ def _sort_by_rotbond(ifs, outdir):
         write_oedatabase(moldb, ofs, nrotors_map[nrotor], size)
 
 
-def smiles_with_combined(frag_list, mol, MAX_ROTORS=2):
+def smiles_with_combined(frag_list, mol, MAX_ROTORS=2, stats=None, return_records=False):
     """
     Generates Smiles:frags mapping for fragments and fragment combinations with less than MAX_ROTORS rotatable bonds
 
@@ -862,18 +1942,30 @@ def smiles_with_combined(frag_list, mol, MAX_ROTORS=2):
     mol: OpenEye Mol
     OESMILESFlag: str
         Either 'ISOMERIC' or 'DEFAULT'. This flag determines which OE function to use to generate SMILES string
+    stats: fragmenter.stats.ParentStats, optional, default None
+        If provided, time spent in the combinations and smiles stages is recorded
+    return_records: bool, optional, default False
+        If True, fragment combinations are returned as FragmentRecords instead of OE AtomBondSets
 
     Returns
     -------
-    smiles: dict of smiles sting to fragment
+    smiles: dict of smiles sting to fragments
 
     """
-    comb_list = GetFragmentAtomBondSetCombinations(frag_list, MAX_ROTORS=MAX_ROTORS)
+    if stats is None:
+        stats = NULL_STATS
+    with stats.stage('combinations'):
+        comb_list = GetFragmentAtomBondSetCombinations(frag_list, MAX_ROTORS=MAX_ROTORS, mol=mol, return_records=True,
+                                                       stats=stats)
 
     combined_list = comb_list + frag_list
 
-    smiles = frag_to_smiles(combined_list, mol)
+    with stats.stage('smiles'):
+        smiles = frag_to_smiles(combined_list, mol, stats=stats)
 
+    if not return_records:
+        smiles = {s: [frag.to_atom_bond_set(mol) if isinstance(frag, FragmentRecord) else frag for frag in frags]
+                  for s, frags in smiles.items()}
     return smiles
 
 
@@ -913,30 +2005,167 @@ def ToPdf(mol, oname, frags):#, fragcombs):
     #return 0
 
 
+def render_job(mol, oname, frags):
+    """
+    Serialize the arguments of ToPdf so the PDF can be rendered in another thread or process. Atoms and bonds of the
+    fragments are stored by their position in the molecule since OEB does not keep atom and bond indices.
+
+    Parameters
+    ----------
+    mol: charged OEMol
+    oname: str
+        Output file name
+    frags: dict
+        AtomBondSets of fragments mapped to the index of the bond the fragment was built from
+
+    Returns
+    -------
+    oeb: bytes
+        molecule serialized with chemi.to_oeb_bytes
+    frag_sets: list
+        (bond position, atom positions, bond positions) of every fragment
+    oname: str
+    """
+    atom_position = {atom.GetIdx(): i for i, atom in enumerate(mol.GetAtoms())}
+    bond_position = {bond.GetIdx(): i for i, bond in enumerate(mol.GetBonds())}
+    frag_sets = [(bond_position[bond_idx], sorted(atom_position[atom.GetIdx()] for atom in frag.GetAtoms()),
+                  sorted(bond_position[bond.GetIdx()] for bond in frag.GetBonds()))
+                 for bond_idx, frag in frags.items()]
+    return to_oeb_bytes(mol), frag_sets, oname
+
+
+def render_pdf(oeb, frag_sets, oname):
+    """
+    Render a job from render_job with ToPdf. The sha256 hash of the job is written next to the PDF (oname.sha256) and
+    the PDF is not rendered again if it exists and was rendered from the same molecule and fragments.
+
+    Returns
+    -------
+    rendered: bool
+        False if an up to date PDF already existed
+    """
+    digest = hashlib.sha256(oeb + json.dumps(frag_sets).encode('utf-8')).hexdigest()
+    hash_filename = oname + '.sha256'
+    if os.path.exists(oname) and os.path.exists(hash_filename):
+        with open(hash_filename) as f:
+            if f.read().strip() == digest:
+                return False
+
+    mol = from_oeb_bytes(oeb)
+    atoms = list(mol.GetAtoms())
+    bonds = list(mol.GetBonds())
+    frags = collections.OrderedDict()
+    for bond_position, atom_positions, bond_positions in frag_sets:
+        frags[bonds[bond_position].GetIdx()] = _to_AtomBondSet(mol, [atoms[i].GetIdx() for i in atom_positions],
+                                                               [bonds[i].GetIdx() for i in bond_positions])
+    if not ToPdf(mol, oname, frags):
+        raise RuntimeError('Could not write {}'.format(oname))
+    with open(hash_filename, 'w') as f:
+        f.write(digest)
+    return True
+
+
+class RenderQueue(object):
+
+    def __init__(self, n_workers=1, executor=None, processes=True):
+        """
+        Render fragment PDFs in the background so fragmentation does not wait for depiction.
+
+        Parameters
+        ----------
+        n_workers: int, optional, default 1
+            Number of threads or processes rendering PDFs
+        executor: concurrent.futures.Executor, optional, default None
+            If provided, jobs are submitted to this executor. The caller owns the executor and is responsible for
+            shutting it down.
+        processes: bool, optional, default True
+            If True (and no executor is given), render in a process pool. Otherwise use a thread pool.
+        """
+        self._owns_executor = executor is None
+        if executor is None:
+            from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+            executor = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(max_workers=n_workers)
+        self.executor = executor
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def submit(self, mol, oname, frags):
+        """
+        Queue a PDF of a charged molecule and its fragments. Takes the same arguments as ToPdf.
+
+        Returns
+        -------
+        future: concurrent.futures.Future
+            result is True if the PDF was rendered and False if it was up to date
+        """
+        return self.submit_job(*render_job(mol, oname, frags))
+
+    def submit_job(self, oeb, frag_sets, oname):
+        """
+        Queue a PDF serialized with render_job
+        """
+        future = self.executor.submit(render_pdf, oeb, frag_sets, oname)
+        self._futures.append((oname, future))
+        return future
+
+    def wait(self):
+        """
+        Wait for all queued PDFs.
+
+        Returns
+        -------
+        results: dict
+            maps file names to True if the PDF was rendered, False if it was up to date or None if rendering failed
+        """
+        results = {}
+        for oname, future in self._futures:
+            try:
+                results[oname] = future.result()
+            except Exception as e:
+                logger().warning('Could not render {}: {}: {}'.format(oname, type(e).__name__, e))
+                results[oname] = None
+        self._futures = []
+        return results
+
+    def close(self):
+        """
+        Wait for all queued PDFs and shut down the executor if it was created by this queue
+        """
+        results = self.wait()
+        if self._owns_executor:
+            self.executor.shutdown()
+        return results
+
+
 def OeMolToGraph(oemol):
     """
-    Convert charged molecule to networkX graph and add WiberBondOrder as edge weight
+    Convert charged molecule to arrays of bonds with WiberBondOrder as edge weight
 
     Parameters
     ----------
-    mol: charged OEMolGraph
+    mol: charged OEMolGraph. Functional groups should be tagged with _tag_fgroups
 
     Returns
     -------
-    G: NetworkX Graph of molecule
+    G: dict
+        n_atoms and arrays with one entry per bond: atoms (n_bonds, 2) atom indices, index (bond index), weight (Wiberg
+        bond order), aromatic, in_ring and fgroup (True if the bond is in a functional group)
 
     """
-    import networkx as nx
-    G = nx.Graph()
-    for atom in oemol.GetAtoms():
-        G.add_node(atom.GetIdx(), name=atom.GetName())
-    for bond in oemol.GetBonds():
-        try:
-            fgroup = bond.GetData('fgroup')
-        except:
-            fgroup = False
-        G.add_edge(bond.GetBgnIdx(), bond.GetEndIdx(), weight=bond.GetData("WibergBondOrder"), index=bond.GetIdx(),
-                   aromatic=bond.IsAromatic(), in_ring=bond.IsInRing(), fgroup=fgroup)
+    bonds = list(oemol.GetBonds())
+    G = {'n_atoms': oemol.GetMaxAtomIdx(),
+         'atoms': np.array([(bond.GetBgnIdx(), bond.GetEndIdx()) for bond in bonds], dtype=int).reshape(-1, 2),
+         'index': np.array([bond.GetIdx() for bond in bonds], dtype=int),
+         'weight': np.array([bond.GetData('WibergBondOrder') for bond in bonds], dtype=float),
+         'aromatic': np.array([bond.IsAromatic() for bond in bonds], dtype=bool),
+         'in_ring': np.array([bond.IsInRing() for bond in bonds], dtype=bool),
+         'fgroup': np.array([bond.HasData('fgroup') for bond in bonds], dtype=bool)}
     return G
 
 
@@ -946,29 +2175,69 @@ def FragGraph(G, bondOrderThreshold=1.2):
 
     Parameters
     ----------
-    G: NetworkX graph
-    bondOrderThreshold: int
+    G: dict
+        graph from OeMolToGraph
+    bondOrderThreshold: float
         thershold for fragmenting graph. Default 1.2
 
     Returns
     -------
-    subgraphs: list of subgraphs
+    subgraphs: list of (atoms, bonds) tuples of lists of atom and bond indices of each fragment
     """
-    import networkx as nx
+    return FragGraphs([G], bondOrderThreshold=bondOrderThreshold)[0]
+
+
+def FragGraphs(graphs, bondOrderThreshold=1.2):
+    """
+    Fragment a batch of molecule graphs at once. Bonds with Wiberg bond order less than threshold that are not aromatic,
+    not in a ring, not in a functional group and not to a terminal atom are cut.
+
+    Parameters
+    ----------
+    graphs: list of dicts
+        graphs from OeMolToGraph
+    bondOrderThreshold: float
+        thershold for fragmenting graph. Default 1.2
+
+    Returns
+    -------
+    subgraphs: list
+        For each graph, a list of (atoms, bonds) tuples of atom and bond indices of each fragment
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    if not graphs:
+        return []
+    # Stack all molecules into one block diagonal graph
+    n_atoms = np.array([G['n_atoms'] for G in graphs], dtype=int)
+    atom_offsets = np.concatenate(([0], np.cumsum(n_atoms)))
+    n_bonds = np.array([len(G['index']) for G in graphs], dtype=int)
+    bond_offsets = np.concatenate(([0], np.cumsum(n_bonds)))
+    atoms = np.concatenate([G['atoms'] + offset for G, offset in zip(graphs, atom_offsets)]).reshape(-1, 2)
+    index = np.concatenate([G['index'] for G in graphs])
+    weight = np.concatenate([G['weight'] for G in graphs])
+    keep_bond = np.concatenate([G['aromatic'] | G['in_ring'] | G['fgroup'] for G in graphs])
+
+    # Cut molecules
+    degree = np.bincount(atoms.ravel(), minlength=atom_offsets[-1])
+    cut = (weight < bondOrderThreshold) & ~keep_bond & (degree[atoms[:, 0]] > 1) & (degree[atoms[:, 1]] > 1)
+    kept = atoms[~cut]
+    adjacency = coo_matrix((np.ones(len(kept), dtype=bool), (kept[:, 0], kept[:, 1])),
+                           shape=(atom_offsets[-1], atom_offsets[-1]))
 
-    ebunch = []
-    for node in G.edge:
-        if G.degree(node) <= 1:
-            continue
-        for node2 in G.edge[node]:
-            if G.edge[node][node2]['weight'] < bondOrderThreshold and G.degree(node2) >1 \
-                    and not G.edge[node][node2]['aromatic'] and not G.edge[node][node2]['in_ring']\
-                    and not G.edge[node][node2]['fgroup']:
-                ebunch.append((node, node2))
-    # Cut molecule
-    G.remove_edges_from(ebunch)
     # Generate fragments
-    subgraphs = list(nx.connected_component_subgraphs(G))
+    n_components, labels = connected_components(adjacency, directed=False)
+    bond_labels = np.where(cut, -1, labels[atoms[:, 0]])
+
+    subgraphs = []
+    for i in range(len(graphs)):
+        mol_labels = labels[atom_offsets[i]:atom_offsets[i+1]]
+        mol_bond_labels = bond_labels[bond_offsets[i]:bond_offsets[i+1]]
+        mol_index = index[bond_offsets[i]:bond_offsets[i+1]]
+        # Components are labeled in order of their lowest atom index
+        subgraphs.append([(np.nonzero(mol_labels == label)[0].tolist(), mol_index[mol_bond_labels == label].tolist())
+                          for label in np.unique(mol_labels)])
     return subgraphs
 
 
@@ -978,58 +2247,68 @@ def subgraphToAtomBondSet(graph, subgraph, oemol):
 
     Parameters
     ----------
-    graph: NetworkX graph
-    subgraph: NetworkX subgraph
+    graph: dict
+        graph from OeMolToGraph
+    subgraph: tuple
+        atom and bond indices of fragment from FragGraph
     oemol: Openeye OEMolGraph
 
     Returns
     ------
     atomBondSet: Openeye oechem atomBondSet
     """
-    # Build openeye atombondset from subgraphs
-    atomBondSet = oechem.OEAtomBondSet()
-    for node in subgraph.node:
-        atomBondSet.AddAtom(oemol.GetAtom(oechem.OEHasAtomIdx(node)))
-    for node1, node2 in subgraph.edges():
-        index = graph.edge[node1][node2]['index']
-        atomBondSet.AddBond(oemol.GetBond(oechem.OEHasBondIdx(index)))
-    return atomBondSet
+    atoms, bonds = subgraph
+    return _to_AtomBondSet(oemol, atoms, bonds)
 
 
-def SmilesToFragments(smiles, fgroup_smarts, bondOrderThreshold=1.2, chargesMol=True):
+def SmilesToFragments(smiles, fgroup_smarts=None, bondOrderThreshold=1.2, chargesMol=True, charge_cache=None):
     """
     Fragment molecule at bonds below Bond Order Threshold
 
     Parameters
     ----------
-    smiles: str
-        smiles string of molecule to fragment
+    smiles: str or list of str
+        smiles string of molecule to fragment. If a list, all molecules are charged and then fragmented together
+    fgroup_smarts: dict, optional, default None
+        dictionary mapping functional groups to SMARTS. Default is None and uses shipped yaml file.
+    bondOrderThreshold: float
+        thershold for fragmenting. Default 1.2
+    chargesMol: bool
+        If True, also return the charged molecule
+    charge_cache: fragmenter.cache.ResultCache, optional, default None
+        cache for partial charges and Wiberg bond orders
 
     Returns
     -------
     frags: list of OE AtomBondSets
+    charged: charged OEMol if chargesMol is True
+        If smiles is a list, a list with one result per SMILES is returned.
 
     """
-    # Charge molecule
-    mol = oechem.OEGraphMol()
-    oemol = openeye.smiles_to_oemol(smiles)
-    charged = openeye.get_charges(oemol, keep_confs=1)
-
-    # Tag functional groups
-    _tag_fgroups(charged, fgroups_smarts=fgroup_smarts)
+    if isinstance(smiles, str):
+        return SmilesToFragments([smiles], fgroup_smarts, bondOrderThreshold, chargesMol, charge_cache)[0]
+
+    # Charge molecules
+    charged_mols = []
+    for smi in smiles:
+        oemol = smiles_to_oemol(smi)
+        charged = get_charges(oemol, keep_confs=1, cache=charge_cache)
+        # Tag functional groups
+        _tag_fgroups(charged, fgroups_smarts=fgroup_smarts)
+        charged_mols.append(charged)
 
     # Generate fragments
-    G = OeMolToGraph(charged)
-    subraphs = FragGraph(G, bondOrderThreshold=bondOrderThreshold)
-
-    frags = []
-    for subraph in subraphs:
-        frags.append(subgraphToAtomBondSet(G, subraph, charged))
-
-    if chargesMol:
-        return frags, charged
-    else:
-        return frags
+    graphs = [OeMolToGraph(charged) for charged in charged_mols]
+    subgraphs = FragGraphs(graphs, bondOrderThreshold=bondOrderThreshold)
+
+    results = []
+    for G, mol_subgraphs, charged in zip(graphs, subgraphs, charged_mols):
+        frags = [subgraphToAtomBondSet(G, subgraph, charged) for subgraph in mol_subgraphs]
+        if chargesMol:
+            results.append((frags, charged))
+        else:
+            results.append(frags)
+    return results
 
 
 def DepictMoleculeWithFragmentCombinations(report, mol, frags, opts): #fragcombs, opts):
@@ -1147,6 +2426,179 @@ class LabelBondOrder(oedepict.OEDisplayBondPropBase):
         copy = LabelBondOrder()
         return copy.__disown__()
 
+def get_atom_neighbor_masks(mol):
+    """
+    Build a bitmask of bonded neighbors for every atom from the bond list. Bit j of masks[i] is set if atom i and atom
+    j are bonded.
+
+    Parameters
+    ----------
+    mol: OEMolGraph
+
+    Returns
+    -------
+    masks: list of int
+        indexed by atom index
+    """
+    masks = [0] * mol.GetMaxAtomIdx()
+    for bond in mol.GetBonds():
+        bgn_idx = bond.GetBgnIdx()
+        end_idx = bond.GetEndIdx()
+        masks[bgn_idx] |= 1 << end_idx
+        masks[end_idx] |= 1 << bgn_idx
+    return masks
+
+
+def indices_to_mask(indices):
+    """
+    Convert atom or bond indices to a bitmask
+    """
+    mask = 0
+    for idx in indices:
+        mask |= 1 << idx
+    return mask
+
+
+def mask_to_indices(mask):
+    """
+    Convert a bitmask to sorted list of atom or bond indices
+    """
+    indices = []
+    idx = 0
+    while mask:
+        if mask & 1:
+            indices.append(idx)
+        mask >>= 1
+        idx += 1
+    return indices
+
+
+class FragmentRecord(object):
+    """
+    Lightweight, hashable fragment. Atoms and bonds are stored as bitmasks of atom and bond indices so two fragments
+    with the same atoms and bonds are equal and hash the same. This is used to remove duplicate fragments before
+    generating SMILES.
+    """
+    __slots__ = ('atoms', 'bonds', 'rotors')
+
+    def __init__(self, atoms, bonds, rotors=0):
+        """
+        Parameters
+        ----------
+        atoms: int
+            bitmask of atom indices
+        bonds: int
+            bitmask of bond indices
+        rotors: int
+            number of rotatable bonds in fragment
+        """
+        self.atoms = atoms
+        self.bonds = bonds
+        self.rotors = rotors
+
+    def __setattr__(self, key, value):
+        if hasattr(self, key):
+            raise AttributeError("FragmentRecord is immutable")
+        object.__setattr__(self, key, value)
+
+    def __eq__(self, other):
+        return isinstance(other, FragmentRecord) and self.atoms == other.atoms and self.bonds == other.bonds
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.atoms, self.bonds))
+
+    def __repr__(self):
+        return 'FragmentRecord(atoms={}, bonds={}, rotors={})'.format(self.atom_indices(), self.bond_indices(),
+                                                                      self.rotors)
+
+    def __getstate__(self):
+        return self.atoms, self.bonds, self.rotors
+
+    def __setstate__(self, state):
+        for key, value in zip(self.__slots__, state):
+            object.__setattr__(self, key, value)
+
+    @classmethod
+    def from_indices(cls, atoms, bonds, rotor_mask=0):
+        """
+        Generate record from atom and bond indices. rotor_mask is the bitmask of rotatable bond indices in the molecule
+        """
+        bond_mask = indices_to_mask(bonds)
+        return cls(indices_to_mask(atoms), bond_mask, bin(bond_mask & rotor_mask).count('1'))
+
+    @classmethod
+    def from_atom_bond_set(cls, atom_bond_set):
+        """
+        Generate record from OE AtomBondSet
+        """
+        bonds = list(atom_bond_set.GetBonds())
+        return cls(indices_to_mask(atom.GetIdx() for atom in atom_bond_set.GetAtoms()),
+                   indices_to_mask(bond.GetIdx() for bond in bonds), sum(bond.IsRotor() for bond in bonds))
+
+    def atom_indices(self):
+        return mask_to_indices(self.atoms)
+
+    def bond_indices(self):
+        return mask_to_indices(self.bonds)
+
+    def to_atom_bond_set(self, mol):
+        """
+        Generate OE AtomBondSet of fragment on mol
+        """
+        return _to_AtomBondSet(mol, self.atom_indices(), self.bond_indices())
+
+
+def get_rotor_mask(mol):
+    """
+    Bitmask of rotatable bond indices in mol
+    """
+    return indices_to_mask(bond.GetIdx() for bond in mol.GetBonds() if bond.IsRotor())
+
+
+def get_fragment_adjacency(mol, fraglist, neighbor_masks=None):
+    """
+    Generate the fragment adjacency matrix. Two fragments are adjacent if an atom in one fragment is bonded to an atom
+    in the other fragment (same as IsAdjacentAtomBondSets), which is a single AND of the fragment's neighbor mask with
+    the other fragment's atom mask.
+
+    Parameters
+    ----------
+    mol: OEMolGraph
+        molecule the fragments were generated from
+    fraglist: list of OE AtomBondSet
+    neighbor_masks: list of int, optional, default None
+        output of get_atom_neighbor_masks. If None, it will be generated from mol
+
+    Returns
+    -------
+    adjacency: numpy array of bool
+        len(fraglist) x len(fraglist). adjacency[i, j] is True if fraglist[i] and fraglist[j] are adjacent
+    """
+    if neighbor_masks is None:
+        neighbor_masks = get_atom_neighbor_masks(mol)
+    atom_masks = []
+    frag_neighbor_masks = []
+    for frag in fraglist:
+        atom_mask = 0
+        nbr_mask = 0
+        for atom in frag.GetAtoms():
+            idx = atom.GetIdx()
+            atom_mask |= 1 << idx
+            nbr_mask |= neighbor_masks[idx]
+        atom_masks.append(atom_mask)
+        frag_neighbor_masks.append(nbr_mask)
+
+    nrfrags = len(fraglist)
+    adjacency = np.zeros((nrfrags, nrfrags), dtype=bool)
+    for i, j in combinations(range(nrfrags), 2):
+        if frag_neighbor_masks[i] & atom_masks[j]:
+            adjacency[i, j] = adjacency[j, i] = True
+    return adjacency
+
+
 def IsAdjacentAtomBondSets(fragA, fragB):
     """
     This function was taken from Openeye cookbook
@@ -1230,37 +2682,148 @@ def CombineAndConnectAtomBondSets(fraglist):
     return combined
 
 
-def GetFragmentAtomBondSetCombinations(fraglist, MAX_ROTORS=2, MIN_ROTORS=1):
+def get_bond_lookup(mol):
     """
-    This function was taken from OpeneEye cookbook 
+    Build bond index lookup by atom pair from the bond table. bond_lookup[i][j] is the index of the bond between atoms
+    i and j. Iterating over bond_lookup[i] gives the bonded neighbors of atom i.
+
+    Parameters
+    ----------
+    mol: OEMolGraph
+
+    Returns
+    -------
+    bond_lookup: dict
+        maps atom index to dictionary that maps neighbor atom index to bond index
+    """
+    bond_lookup = {atom.GetIdx(): {} for atom in mol.GetAtoms()}
+    for bond in mol.GetBonds():
+        bgn_idx = bond.GetBgnIdx()
+        end_idx = bond.GetEndIdx()
+        bond_lookup[bgn_idx][end_idx] = bond.GetIdx()
+        bond_lookup[end_idx][bgn_idx] = bond.GetIdx()
+    return bond_lookup
+
+
+def CombineAndConnectAtomBondIndices(fraglist, bond_lookup):
+    """
+    Index based version of CombineAndConnectAtomBondSets. Combines atom and bond indices of fragments and adds the
+    bonds that connect atoms in the combination. Runs in time linear in the number of atoms (and their bonds) in the
+    combination.
+
+    Parameters
+    ----------
+    fraglist: list of tuples
+        (atom indices, bond indices) for each fragment
+    bond_lookup: dict
+        output of get_bond_lookup
+
+    Returns
+    -------
+    atoms, bonds: sets of atom and bond indices of combined fragment
+    """
+    atoms = set()
+    bonds = set()
+    for frag_atoms, frag_bonds in fraglist:
+        atoms.update(frag_atoms)
+        bonds.update(frag_bonds)
+    for atom_idx in atoms:
+        for nbr_idx, bond_idx in bond_lookup[atom_idx].items():
+            if nbr_idx in atoms:
+                bonds.add(bond_idx)
+    return atoms, bonds
+
+
+def GetFragmentAtomBondSetCombinations(fraglist, MAX_ROTORS=2, MIN_ROTORS=1, mol=None, return_records=False,
+                                       stats=None):
+    """
+    This function was adapted from OpeneEye cookbook
     https://docs.eyesopen.com/toolkits/cookbook/python/cheminfo/enumfrags.html
     Enumerate connected combinations from list of fragments
+
+    Instead of checking every subset of fragments for connectivity, connected combinations are grown one adjacent
+    fragment at a time over the fragment adjacency graph (ESU algorithm). Adding a fragment can only add rotors so a
+    combination is not grown any further once it has more than MAX_ROTORS rotors. The cost scales with the number of
+    connected combinations with at most MAX_ROTORS rotors instead of 2^len(fraglist).
+
     Parameters
     ----------
-    mol: OEMolGraph
     fraglist: list of OE AtomBondSet
     MAX_ROTORS: int
         min rotors in each fragment combination
     MIN_ROTORS: int
         max rotors in each fragment combination
+    mol: OEMolGraph, optional, default None
+        molecule the fragments were generated from. If provided, fragment adjacency is found with
+        get_fragment_adjacency and combinations are built on atom and bond indices with
+        CombineAndConnectAtomBondIndices. OE AtomBondSets are only generated for the combinations that are returned.
+    return_records: bool, optional, default False
+        If True, return FragmentRecords instead of OE AtomBondSets. mol must be provided.
+    stats: fragmenter.stats.ParentStats, optional, default None
+        If provided, the number of combinations examined and accepted is counted
 
     Returns
     -------
-    fragcombs: list of connected combinations (OE AtomBondSet)
+    fragcombs: list of connected combinations (OE AtomBondSet). Combinations are ordered by number of fragments and
+        then by fragment indices in fraglist.
     """
 
-    fragcombs = []
-
     nrfrags = len(fraglist)
-    for n in range(1, nrfrags):
-
-        for fragcomb in combinations(fraglist, n):
-
-            if IsAdjacentAtomBondSetCombination(fragcomb):
-
-                frag = CombineAndConnectAtomBondSets(fragcomb)
+    if mol is not None:
+        adjacency = get_fragment_adjacency(mol, fraglist)
+        neighbors = [set(np.nonzero(row)[0].tolist()) for row in adjacency]
+        bond_lookup = get_bond_lookup(mol)
+        rotor_mask = get_rotor_mask(mol)
+        rotors = set(mask_to_indices(rotor_mask))
+        frags = [(set(atom.GetIdx() for atom in frag.GetAtoms()), set(bond.GetIdx() for bond in frag.GetBonds()))
+                 for frag in fraglist]
+        combine = lambda fragments: CombineAndConnectAtomBondIndices(fragments, bond_lookup)
+        count_rotors = lambda fragment: len(fragment[-1] & rotors)
+        if return_records:
+            to_atom_bond_set = lambda fragment: FragmentRecord.from_indices(fragment[0], fragment[-1], rotor_mask)
+        else:
+            to_atom_bond_set = lambda fragment: _to_AtomBondSet(mol, fragment[0], fragment[-1])
+    elif return_records:
+        raise ValueError("mol must be provided to return FragmentRecords")
+    else:
+        neighbors = [set() for _ in range(nrfrags)]
+        for i, j in combinations(range(nrfrags), 2):
+            if IsAdjacentAtomBondSets(fraglist[i], fraglist[j]):
+                neighbors[i].add(j)
+                neighbors[j].add(i)
+        frags = fraglist
+        combine = CombineAndConnectAtomBondSets
+        count_rotors = CountRotorsInFragment
+        to_atom_bond_set = lambda fragment: fragment
+
+    fragcombs = {}
+    examined = [0]
+
+    def _extend(comb, frag, extension, comb_neighbors, root):
+        if len(comb) < nrfrags and count_rotors(frag) >= MIN_ROTORS:
+            fragcombs[comb] = frag
+        extension = set(extension)
+        while extension:
+            idx = min(extension)
+            extension.remove(idx)
+            new_frag = combine([frag, frags[idx]])
+            examined[0] += 1
+            if count_rotors(new_frag) > MAX_ROTORS:
+                continue
+            # Only add neighbors that are not already adjacent to the combination so every combination is found once
+            new_extension = extension.union(nbr for nbr in neighbors[idx] if nbr > root and nbr not in comb_neighbors)
+            _extend(tuple(sorted(comb + (idx,))), new_frag, new_extension, comb_neighbors | neighbors[idx], root)
+
+    for root in range(nrfrags):
+        frag = combine([frags[root]])
+        examined[0] += 1
+        if count_rotors(frag) > MAX_ROTORS:
+            continue
+        extension = set(nbr for nbr in neighbors[root] if nbr > root)
+        _extend((root,), frag, extension, neighbors[root] | {root}, root)
 
-                if (CountRotorsInFragment(frag) <= MAX_ROTORS) and (CountRotorsInFragment(frag) >= MIN_ROTORS):
-                    fragcombs.append(frag)
+    if stats is not None:
+        stats.count('combinations_examined', examined[0])
+        stats.count('combinations_accepted', len(fragcombs))
 
-    return fragcombs
+    return [to_atom_bond_set(fragcombs[comb]) for comb in sorted(fragcombs, key=lambda comb: (len(comb), comb))]
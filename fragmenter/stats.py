@@ -0,0 +1,179 @@
+"""
+Per stage timing and counters for fragmenting molecules. Stats are collected per parent molecule (in worker processes
+if fragmenting in parallel) and collected into FragmenterStats, which can also write every parent's record as a JSON
+line so slow molecules can be found while a large run is still going.
+"""
+
+import json
+import time
+
+
+class _Stage(object):
+    """
+    Context manager that adds the wall and CPU time spent in a block to a stage of ParentStats
+    """
+    __slots__ = ('stages', 'name', 'wall', 'cpu')
+
+    def __init__(self, parent_stats, name):
+        self.stages = parent_stats.stages
+        self.name = name
+        parent_stats.current_stage = name
+        if parent_stats.on_stage is not None:
+            parent_stats.on_stage(name)
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        stage = self.stages.get(self.name)
+        if stage is None:
+            stage = self.stages[self.name] = {'wall': 0.0, 'cpu': 0.0, 'calls': 0}
+        stage['wall'] += time.perf_counter() - self.wall
+        stage['cpu'] += time.process_time() - self.cpu
+        stage['calls'] += 1
+        return False
+
+
+class ParentStats(object):
+
+    def __init__(self, title='', smiles='', on_stage=None):
+        """
+        Timing and counters for one parent molecule.
+
+        Parameters
+        ----------
+        title: str, optional, default ''
+            title of the parent molecule
+        smiles: str, optional, default ''
+            SMILES of the parent molecule
+        on_stage: function, optional, default None
+            called with the name of every stage when it starts. Used to report progress out of a child process.
+        """
+        self.title = title
+        self.smiles = smiles
+        self.stages = {}
+        self.counters = {}
+        self.current_stage = None
+        self.on_stage = on_stage
+
+    def stage(self, name):
+        """
+        Time a stage. Use as a context manager: with stats.stage('omega'): ...
+        """
+        return _Stage(self, name)
+
+    def count(self, name, n=1):
+        """
+        Add n to counter name
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        return {'title': self.title, 'smiles': self.smiles, 'stages': self.stages, 'counters': self.counters}
+
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _NullStats(object):
+    """
+    Stand in for ParentStats when stats are not collected. Does nothing.
+    """
+    __slots__ = ()
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def count(self, name, n=1):
+        pass
+
+
+NULL_STATS = _NullStats()
+
+
+class FragmenterStats(object):
+
+    def __init__(self, events=None):
+        """
+        Collects per parent timing and counters from generate_fragments and iter_fragments.
+
+        Parameters
+        ----------
+        events: str or file like object, optional, default None
+            If provided, one JSON line is written and flushed for every parent when it is added. If a str, the file is
+            opened for writing and closed by close().
+        """
+        self.records = []
+        self._close_events = isinstance(events, str)
+        self._events = open(events, 'w') if self._close_events else events
+
+    def add(self, record):
+        """
+        Add the stats of one parent
+
+        Parameters
+        ----------
+        record: dict
+            ParentStats.to_dict() plus any extra fields (status, stage, wall_time)
+        """
+        self.records.append(record)
+        if self._events is not None:
+            self._events.write(json.dumps(record) + '\n')
+            self._events.flush()
+
+    def totals(self):
+        """
+        Sum of stage times and counters over all parents
+
+        Returns
+        -------
+        totals: dict
+            with 'stages' mapping stage names to wall, cpu and calls and 'counters' mapping counter names to counts
+        """
+        stages = {}
+        counters = {}
+        for record in self.records:
+            for name, stage in record['stages'].items():
+                total = stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+                for key in total:
+                    total[key] += stage[key]
+            for name, count in record['counters'].items():
+                counters[name] = counters.get(name, 0) + count
+        return {'stages': stages, 'counters': counters}
+
+    def slowest(self, n=10, stage=None):
+        """
+        Parents that took the longest
+
+        Parameters
+        ----------
+        n: int, optional, default 10
+            number of records to return
+        stage: str, optional, default None
+            If provided, sort by wall time spent in this stage. Otherwise sort by wall time of all stages or the
+            wall time of the parent if that is longer (parents that were terminated have no stage times).
+
+        Returns
+        -------
+        records: list of dicts
+        """
+        if stage is None:
+            key = lambda record: max(sum(s['wall'] for s in record['stages'].values()), record.get('wall_time', 0.0))
+        else:
+            key = lambda record: record['stages'].get(stage, {'wall': 0.0})['wall']
+        return sorted(self.records, key=key, reverse=True)[:n]
+
+    def close(self):
+        if self._close_events and self._events is not None:
+            self._events.close()
+            self._events = None
@@ -0,0 +1,58 @@
+"""Test result cache"""
+
+import pickle
+import pytest
+from fragmenter.cache import ResultCache, cache_key
+
+
+def test_cache_key_order():
+    """Test cache key does not depend on option order"""
+    assert cache_key('CCCC', {'a': 1, 'b': 2}) == cache_key('CCCC', {'b': 2, 'a': 1})
+    assert cache_key('CCCC', {'a': 1}) != cache_key('CCCC', {'a': 2})
+
+
+def test_memory_cache():
+    """Test in memory LRU tier"""
+    cache = ResultCache(max_memory_items=2)
+    cache.put('a', [1])
+    cache.put('b', [2])
+    assert cache.get('a') == [1]
+    cache.put('c', [3])
+    # b was least recently used
+    assert cache.get('b') is None
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 1
+
+
+def test_disk_cache(tmpdir):
+    """Test results persist between cache instances"""
+    filename = str(tmpdir.join('cache.sqlite'))
+    cache = ResultCache(filename)
+    cache.put('a', {'partial_charges': [0.1, -0.1]})
+    cache.close()
+
+    cache = ResultCache(filename)
+    assert cache.get('a') == {'partial_charges': [0.1, -0.1]}
+    assert cache.stats['disk_hits'] == 1
+    assert cache.get('a') == {'partial_charges': [0.1, -0.1]}
+    assert cache.stats['memory_hits'] == 1
+    assert cache.get_many(['a', 'b']) == {'a': {'partial_charges': [0.1, -0.1]}}
+
+
+def test_disk_eviction(tmpdir):
+    """Test size based eviction"""
+    cache = ResultCache(str(tmpdir.join('cache.sqlite')), max_memory_items=1, max_disk_bytes=50)
+    for i in range(10):
+        cache.put(str(i), 'x' * 10)
+    assert len(cache) < 10
+    assert cache.stats['evictions'] > 0
+    assert cache.get('9') == 'x' * 10
+
+
+def test_pickle_cache(tmpdir):
+    """Test cache can be sent to worker processes"""
+    filename = str(tmpdir.join('cache.sqlite'))
+    cache = ResultCache(filename)
+    cache.put('a', 1)
+    cache_2 = pickle.loads(pickle.dumps(cache))
+    assert cache_2.get('a') == 1
@@ -62,6 +62,34 @@ def test_to_mapped_xyz():
     xyz_2 = sorted(xyz_2.split('\n')[2:-1])
     assert xyz_1 == xyz_2
 
+@using_openeye
+def test_coordinates():
+    from openeye import oechem
+    mol = chemi.smiles_to_oemol('CCCC')
+    assert not chemi.has_conformer(mol)
+    mol = chemi.generate_conformers(mol, max_confs=5)
+    assert chemi.has_conformer(mol, check_two_dimension=True)
+
+    coordinates = chemi.get_coordinates(mol)
+    assert coordinates.shape == (mol.NumConfs(), mol.GetMaxAtomIdx(), 3)
+    for conf, frame in zip(mol.GetConfs(), coordinates):
+        for atom in conf.GetAtoms():
+            np.testing.assert_allclose(conf.GetCoords(atom), frame[atom.GetIdx()], atol=1e-5)
+
+    chemi.set_coordinates(mol, coordinates + 1.0)
+    np.testing.assert_allclose(chemi.get_coordinates(mol), coordinates + 1.0, atol=1e-5)
+    chemi.set_coordinates(mol, coordinates[:1], new_conformers=True)
+    assert mol.NumConfs() == 1
+    np.testing.assert_allclose(chemi.get_coordinates(mol), coordinates[:1], atol=1e-5)
+
+    flat = coordinates[:1].copy()
+    flat[:, :, 2] = 0.0
+    chemi.set_coordinates(mol, flat)
+    assert chemi.has_conformer(mol)
+    assert not chemi.has_conformer(mol, check_two_dimension=True)
+    with pytest.raises(ValueError):
+        chemi.set_coordinates(mol, coordinates)
+
 @using_openeye
 def teat_qcschema_to_xyz():
     smiles = 'HC(H)(C(H)(H)OH)OH'
@@ -80,6 +108,8 @@ def teat_qcschema_to_xyz():
 @using_openeye
 def test_grid_multi_conformers():
     "Test generating grid multiconformer"
+    import itertools
+    from openeye import oechem
     smiles = 'HC(H)(C(H)(H)OH)OH'
     mapped_smiles = '[H:5][C:1]([H:6])([C:2]([H:7])([H:8])[O:4][H:10])[O:3][H:9]'
     mol = cmiles.utils.load_molecule(smiles)
@@ -97,6 +127,42 @@ def test_grid_multi_conformers():
     mult_conf = chemi.generate_grid_conformers(mapped_mol, dihedrals, intervals)
     assert mult_conf.GetMaxConfIdx() == 64
 
+    conf_mol, coordinates = chemi.generate_grid_conformers(mapped_mol, dihedrals, intervals, return_coordinates=True)
+    assert conf_mol.NumConfs() == 1
+    assert coordinates.shape == (64, conf_mol.GetMaxAtomIdx(), 3)
+    np.testing.assert_allclose(chemi.get_coordinates(mult_conf), coordinates, atol=1e-4)
+
+    from fragmenter import torsions
+    atom_dihedrals = [[conf_mol.GetAtom(oechem.OEHasMapIdx(i+1)).GetIdx() for i in dih] for dih in dihedrals]
+    angles = torsions.measure_dihedral_angles(atom_dihedrals, coordinates, bohr=False)
+    expected = np.array(list(itertools.product(range(5, 365, 90), repeat=3)))
+    np.testing.assert_allclose((angles - expected + 180) % 360 - 180, 0, atol=1e-6)
+
+    filtered = chemi.generate_grid_conformers(mapped_mol, dihedrals, intervals, clash_threshold=1.5)
+    assert filtered.NumConfs() <= 64
+    coordinates = chemi.get_coordinates(filtered)
+    bonds = [(bond.GetBgnIdx(), bond.GetEndIdx()) for bond in filtered.GetBonds()]
+    assert (chemi.min_pair_distances(coordinates, chemi.nonbonded_pairs(filtered.GetMaxAtomIdx(), bonds)) > 1.0).all()
+
+@using_openeye
+def test_grid_ring_torsions():
+    """Test ring torsions found by find_torsions(restricted=True) are kept fixed on the grid"""
+    from openeye import oechem
+    from fragmenter import torsions
+    mapped_smiles = cmiles.utils.mol_to_smiles(chemi.smiles_to_oemol('CCc1ccccc1'), mapped=True)
+    mapped_mol = chemi.smiles_to_oemol(mapped_smiles)
+    needed_torsions = torsions.find_torsions(mapped_mol, restricted=True)
+    assert needed_torsions['restricted']
+    dihedrals = [tor for torsion_type in needed_torsions for tor in needed_torsions[torsion_type].values()]
+
+    conf_mol, coordinates = chemi.generate_grid_conformers(mapped_mol, dihedrals, [180]*len(dihedrals),
+                                                           return_coordinates=True)
+    assert len(coordinates) == 2**len(dihedrals)
+    ring = [[conf_mol.GetAtom(oechem.OEHasMapIdx(i+1)).GetIdx() for i in dih]
+            for dih in needed_torsions['restricted'].values()]
+    angles = torsions.measure_dihedral_angles(ring, coordinates, bohr=False)
+    np.testing.assert_allclose(angles, angles[0], atol=1e-6)
+
 @using_openeye
 def test_remove_atom_map():
     from openeye import oechem
@@ -112,8 +178,91 @@ def test_remove_atom_map():
 
 @using_openeye
 def test_remove_clashes():
-    pass
+    """Test conformers are resolved the same way in worker processes and only flagged conformers reach Szybki"""
+    from openeye import oechem
+    tag = 'MM Szybki Single Point Energy'
+    mol = chemi.generate_conformers(chemi.smiles_to_oemol('CCCCCC'), max_confs=2, strict_stereo=False)
+    coordinates = chemi.get_coordinates(mol)
+    terminal = [a.GetIdx() for a in mol.GetAtoms() if a.IsCarbon() and a.GetHvyDegree() == 1]
+    clashing = coordinates[:1].copy()
+    clashing[0, terminal[1]] = clashing[0, terminal[0]] + np.array([1.0, 0.0, 0.0])
+    chemi.set_coordinates(mol, np.concatenate([coordinates, clashing]), new_conformers=True)
+    flagged = chemi.find_clashes(mol)
+    assert flagged[-1] and not flagged[:-1].any()
+
+    serial = chemi.remove_clash(mol, in_place=False)
+    parallel = chemi.remove_clash(mol, in_place=False, n_workers=2)
+    assert serial.NumConfs() == parallel.NumConfs()
+    np.testing.assert_allclose(chemi.get_coordinates(serial), chemi.get_coordinates(parallel), atol=1e-4)
+    assert ([oechem.OEGetSDData(conf, tag) for conf in serial.GetConfs()]
+            == [oechem.OEGetSDData(conf, tag) for conf in parallel.GetConfs()])
+
+    filtered = chemi.remove_clash(mol, in_place=False, prefilter=True, n_workers=2)
+    assert filtered.NumConfs() == mol.NumConfs()
+    assert [oechem.OEHasSDData(conf, tag) for conf in filtered.GetConfs()] == list(flagged)
+    np.testing.assert_allclose(chemi.get_coordinates(filtered)[~flagged], coordinates)
 
 @using_openeye
 def test_resolve_clashes():
-    pass
\ No newline at end of file
+    """Test conformers are only skipped when the prefilter is requested"""
+    from openeye import oechem
+    mol = chemi.generate_conformers(chemi.smiles_to_oemol('CCCC'), max_confs=1, strict_stereo=False)
+    assert chemi.resolve_clashes(mol, prefilter=True)
+    assert not oechem.OEHasSDData(mol, 'MM Szybki Single Point Energy')
+    assert chemi.resolve_clashes(mol)
+    assert oechem.OEHasSDData(mol, 'MM Szybki Single Point Energy')
+
+@using_openeye
+def test_find_clashes():
+    """Test vectorized prefilter flags only conformers with overlapping atoms"""
+    mol = chemi.smiles_to_oemol('CCCC')
+    mol = chemi.generate_conformers(mol, max_confs=1, strict_stereo=False)
+    assert not chemi.find_clashes(mol).any()
+
+    coordinates = chemi.get_coordinates(mol)
+    terminal = [a.GetIdx() for a in mol.GetAtoms() if a.IsCarbon() and a.GetHvyDegree() == 1]
+    clashing = coordinates.copy()
+    clashing[0, terminal[1]] = clashing[0, terminal[0]] + np.array([0.5, 0.0, 0.0])
+    coordinates = np.concatenate([coordinates, clashing])
+    chemi.set_coordinates(mol, coordinates, new_conformers=True)
+    assert list(chemi.find_clashes(mol)) == [False, True]
+    assert list(chemi.pair_clashes(coordinates, [terminal], 1.0)) == [False, True]
+
+@using_openeye
+def test_conformer_budget():
+    from openeye import oechem
+    rigid = chemi.smiles_to_oemol('c1ccccc1')
+    flexible = chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2')
+    assert chemi.scaled_conformer_budget(rigid) == 10
+    assert chemi.scaled_conformer_budget(rigid) < chemi.scaled_conformer_budget(flexible) <= 800
+    assert chemi.scaled_conformer_budget(flexible, max_confs=50) == 50
+
+    charged = chemi.get_charges(flexible, keep_confs=1, conformer_budget='scale')
+    n_confs = charged.GetData(oechem.OEGetTag('n_charge_conformers'))
+    assert 0 < n_confs <= chemi.scaled_conformer_budget(flexible)
+
+    charged = chemi.get_charges(flexible, keep_confs=1, conformer_budget='converge', wbo_tolerance=0.05)
+    assert charged.GetData(oechem.OEGetTag('n_charge_conformers')) <= 800
+    with pytest.raises(ValueError):
+        chemi.get_charges(flexible, conformer_budget='all')
+
+@using_openeye
+def test_naming_policy():
+    from openeye import oechem, oeiupac
+    smiles = 'CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2'
+    assert chemi.smiles_to_oemol(smiles, naming='none').GetTitle() == ''
+    hashed = chemi.smiles_to_oemol(smiles, naming='hash').GetTitle()
+    assert hashed.startswith('mol_')
+    assert chemi.smiles_to_oemol(smiles, naming='hash').GetTitle() == hashed
+    iupac = chemi.smiles_to_oemol(smiles, naming='iupac')
+    assert iupac.GetTitle() == oeiupac.OECreateIUPACName(iupac)
+    assert iupac.HasData(oechem.OEGetTag('generated_title'))
+    assert chemi.smiles_to_oemol(smiles, name='parent', naming='iupac').GetTitle() == 'parent'
+
+    previous = chemi.set_naming_policy('none')
+    try:
+        assert chemi.smiles_to_oemol(smiles).GetTitle() == ''
+    finally:
+        chemi.set_naming_policy(previous)
+    with pytest.raises(ValueError):
+        chemi.set_naming_policy('cas')
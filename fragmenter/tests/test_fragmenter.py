@@ -98,5 +98,328 @@ class TestFragment(unittest.TestCase):
         self.assertEqual(len(intersection), len(stereoisomers_2))
         self.assertEqual(len(stereoisomers_1), len(stereoisomers_2))
 
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_expand_states_parallel(self):
+        """Test states are the same when enumerated in parallel and enumeration stops at max_states"""
+        from openeye import oechem
+        smiles = 'CN(C)C/C=C/C(=O)NC1=C(C=C2C(=C1)C(=NC=N2)NC3=CC(=C(C=C3)F)Cl)O[C@H]4CCOC4'
+        states = fragmenter.fragment.expand_states(chemi.smiles_to_oemol(smiles))
+        self.assertEqual(fragmenter.fragment.expand_states(chemi.smiles_to_oemol(smiles), n_workers=2), states)
+
+        molecules = fragmenter.fragment.expand_states(chemi.smiles_to_oemol(smiles), return_molecules=True)
+        keys = [oechem.OEMolToSmiles(mol) for mol in molecules]
+        self.assertEqual(len(keys), len(set(keys)))
+
+        limited = fragmenter.fragment.expand_states(chemi.smiles_to_oemol(smiles), max_states=3, return_molecules=True)
+        self.assertEqual(len(limited), 3)
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_expand_states_cache(self):
+        """Test enumerated states are cached by molecule and options"""
+        from fragmenter.cache import ResultCache
+        cache = ResultCache(namespace='states')
+        smiles = ['CN(C)C/C=C/C(=O)NC1=C(C=C2C(=C1)C(=NC=N2)NC3=CC(=C(C=C3)F)Cl)O[C@H]4CCOC4', 'c1ccc2c(c1)cccc2O']
+        states = fragmenter.fragment.expand_states(chemi.smiles_to_oemol(smiles[0]), cache=cache)
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(fragmenter.fragment.expand_states(chemi.smiles_to_oemol(smiles[0]), cache=cache), states)
+        self.assertEqual(cache.stats['hits'], 1)
+        fragmenter.fragment.expand_states(chemi.smiles_to_oemol(smiles[0]), tautomers=True, cache=cache)
+        self.assertEqual(cache.stats['misses'], 2)
+
+        many = fragmenter.fragment.expand_states_many([chemi.smiles_to_oemol(smi) for smi in smiles], cache=cache)
+        self.assertEqual(many[0], states)
+        self.assertEqual(many[1], fragmenter.fragment.expand_states(chemi.smiles_to_oemol(smiles[1])))
+        self.assertEqual(len(cache), 3)
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_parallel_fragments(self):
+        """Test process pool fragmentation gives the same fragments as serial fragmentation"""
+        smiles = ['CCCCCC', 'CCOc1ccccc1']
+        molecules = [chemi.smiles_to_oemol(smi) for smi in smiles]
+        serial = fragmenter.fragment.generate_fragments(molecules)
+        parallel = fragmenter.fragment.generate_fragments(molecules, n_workers=2)
+        self.assertEqual(list(serial.keys()), list(parallel.keys()))
+        for parent in serial:
+            self.assertEqual(set(serial[parent]), set(parallel[parent]))
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_oeb_round_trip(self):
+        """Test serializing molecule to OEB bytes"""
+        from openeye import oechem
+        mol = chemi.smiles_to_oemol('CCCC', name='butane')
+        mol_2 = chemi.from_oeb_bytes(chemi.to_oeb_bytes(mol))
+        self.assertEqual(oechem.OEMolToSmiles(mol), oechem.OEMolToSmiles(mol_2))
+        self.assertEqual(mol_2.GetTitle(), 'butane')
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_connected_combinations(self):
+        """Test enumerating connected fragment combinations matches checking all subsets"""
+        from itertools import combinations
+        from fragmenter import fragment
+        mol = chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2')
+        charged, frags = fragment._generate_fragments(mol)
+        fraglist = list(frags.values())
+        expected = []
+        for n in range(1, len(fraglist)):
+            for fragcomb in combinations(fraglist, n):
+                if fragment.IsAdjacentAtomBondSetCombination(fragcomb):
+                    frag = fragment.CombineAndConnectAtomBondSets(fragcomb)
+                    if 1 <= fragment.CountRotorsInFragment(frag) <= 3:
+                        expected.append(frag)
+        fragcombs = fragment.GetFragmentAtomBondSetCombinations(fraglist, MAX_ROTORS=3)
+        self.assertEqual(set(fragment.frag_to_smiles(expected, charged)),
+                         set(fragment.frag_to_smiles(fragcombs, charged)))
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_fragment_adjacency(self):
+        """Test bitmask fragment adjacency matches comparing atom pairs"""
+        from fragmenter import fragment
+        mol = chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2')
+        charged, frags = fragment._generate_fragments(mol)
+        fraglist = list(frags.values())
+        adjacency = fragment.get_fragment_adjacency(charged, fraglist)
+        for i, frag_1 in enumerate(fraglist):
+            for j, frag_2 in enumerate(fraglist):
+                if i != j:
+                    self.assertEqual(adjacency[i, j], fragment.IsAdjacentAtomBondSets(frag_1, frag_2))
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_combine_atom_bond_indices(self):
+        """Test index based fragment combination matches combining AtomBondSets"""
+        from itertools import combinations
+        from fragmenter import fragment
+        mol = chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2')
+        charged, frags = fragment._generate_fragments(mol)
+        fraglist = list(frags.values())
+        bond_lookup = fragment.get_bond_lookup(charged)
+        for frag_1, frag_2 in combinations(fraglist, 2):
+            combined = fragment.CombineAndConnectAtomBondSets([frag_1, frag_2])
+            atoms, bonds = fragment.CombineAndConnectAtomBondIndices(
+                [(set(a.GetIdx() for a in frag.GetAtoms()), set(b.GetIdx() for b in frag.GetBonds()))
+                 for frag in (frag_1, frag_2)], bond_lookup)
+            self.assertEqual(atoms, set(a.GetIdx() for a in combined.GetAtoms()))
+            self.assertEqual(bonds, set(b.GetIdx() for b in combined.GetBonds()))
+
+    def test_fragment_record(self):
+        """Test fragment records with the same atoms and bonds are equal"""
+        from fragmenter.fragment import FragmentRecord
+        frag_1 = FragmentRecord.from_indices([0, 1, 5], [0, 3], rotor_mask=0b1000)
+        frag_2 = FragmentRecord.from_indices({5, 1, 0}, {3, 0}, rotor_mask=0b1000)
+        frag_3 = FragmentRecord.from_indices([0, 1], [0], rotor_mask=0b1000)
+        self.assertEqual(frag_1, frag_2)
+        self.assertEqual(len({frag_1, frag_2, frag_3}), 2)
+        self.assertEqual(frag_1.rotors, 1)
+        self.assertEqual(frag_3.rotors, 0)
+        self.assertEqual(frag_1.atom_indices(), [0, 1, 5])
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_frag_to_smiles_duplicates(self):
+        """Test duplicate fragments are grouped under one SMILES"""
+        from fragmenter import fragment
+        mol = chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2')
+        charged, frags = fragment._generate_fragments(mol)
+        fraglist = list(frags.values())
+        smiles = fragment.frag_to_smiles(fraglist + fraglist, charged)
+        self.assertEqual(sum(len(v) for v in smiles.values()), 2*len(fraglist))
+        self.assertEqual(set(smiles), set(fragment.frag_to_smiles(fraglist, charged)))
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_smiles_with_combined(self):
+        """Test combined fragments are returned as AtomBondSets unless records are requested"""
+        from fragmenter import fragment
+        from openeye import oechem
+        mol = chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2')
+        charged, frags = fragment._generate_fragments(mol)
+        fraglist = list(frags.values())
+        smiles = fragment.smiles_with_combined(fraglist, charged)
+        for frag in (frag for frags in smiles.values() for frag in frags):
+            self.assertIsInstance(frag, oechem.OEAtomBondSet)
+        records = fragment.smiles_with_combined(fraglist, charged, return_records=True)
+        self.assertEqual(set(records), set(smiles))
+        self.assertTrue(any(isinstance(frag, fragment.FragmentRecord) for frags in records.values() for frag in frags))
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_grow_fragment(self):
+        """Test array based fragment growth matches _build_frag"""
+        from fragmenter import fragment
+        from openeye import oechem
+        mol = chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)NC=CC=Cc2ccc(cc2)c3ccccc3')
+        charged = chemi.get_charges(mol, keep_confs=1)
+        tagged_rings, tagged_fgroups = fragment.tag_molecule(charged)
+        mol_arrays = fragment.MolArrays(charged)
+
+        def ring_substituents(bond_idx, rotor_bond_idx, ring_idx):
+            return fragment._ring_substiuents(charged, charged.GetBond(oechem.OEHasBondIdx(bond_idx)),
+                                              charged.GetBond(oechem.OEHasBondIdx(rotor_bond_idx)), tagged_rings,
+                                              ring_idx, tagged_fgroups)
+
+        for bond in charged.GetBonds():
+            if bond.IsRotor():
+                self.assertEqual(fragment._build_frag(bond, charged, tagged_fgroups, tagged_rings),
+                                 fragment._build_frag_from_arrays(bond.GetIdx(), mol_arrays, tagged_fgroups,
+                                                                  tagged_rings, ring_substituents))
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_ring_substituents(self):
+        """Test memoized ring substituents match _ring_substiuents"""
+        from fragmenter import fragment
+        mol = chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)Nc2ccc(cc2C)c3ccc(cc3)N(=O)=O')
+        charged = chemi.get_charges(mol, keep_confs=1)
+        tagged_rings, tagged_fgroups = fragment.tag_molecule(charged)
+        ring_substituents = fragment.RingSubstituents(fragment.MolArrays(charged), tagged_rings, tagged_fgroups)
+        rotors = [bond for bond in charged.GetBonds() if bond.IsRotor()]
+        for ring_idx in tagged_rings:
+            for rotor in rotors:
+                for bond in charged.GetBonds():
+                    self.assertEqual(fragment._ring_substiuents(charged, bond, rotor, tagged_rings, ring_idx,
+                                                                tagged_fgroups),
+                                     ring_substituents(bond.GetIdx(), rotor.GetIdx(), ring_idx))
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_fgroup_searches_cached(self):
+        """Test functional group SMARTS are only compiled once"""
+        from fragmenter import fragment
+        searches = fragment.get_fgroup_searches()
+        self.assertIs(searches, fragment.get_fgroup_searches())
+        self.assertEqual([f_group for f_group, ss in searches], list(fragment.load_fgroup_smarts()))
+        user_smarts = {'amide': '[NX3][CX3](=[OX1])[#6]'}
+        user_searches = fragment.get_fgroup_searches(user_smarts)
+        self.assertIs(user_searches, fragment.get_fgroup_searches(dict(user_smarts)))
+        self.assertIs(user_searches[0][1], chemi.get_subsearch(user_smarts['amide']))
+
+        mol = chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2')
+        self.assertEqual(set(fragment._tag_fgroups(mol, user_smarts)), {'amide_0'})
+
+    def test_ring_fgroup_union_transitive(self):
+        """Test overlapping functional groups are merged transitively"""
+        from fragmenter import fragment
+        tagged_fgroups = {'a_0': ({0, 1, 2}, {0, 1}), 'b_0': ({1, 2, 3}, {1, 2}), 'c_0': ({3, 4, 5}, {3, 4}),
+                          'd_0': ({2, 3, 4}, {2, 3}), 'e_0': ({7, 8}, {7})}
+        tagged = fragment._ring_fgroup_union(None, {}, tagged_fgroups)
+        for fgroup in ('a_0', 'b_0', 'c_0', 'd_0'):
+            self.assertEqual(tagged[fgroup], ({0, 1, 2, 3, 4, 5}, {0, 1, 2, 3, 4}))
+        self.assertEqual(tagged['e_0'], ({7, 8}, {7}))
+        # Input is not changed
+        self.assertEqual(tagged_fgroups['a_0'], ({0, 1, 2}, {0, 1}))
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_iter_fragments(self):
+        """Test streaming fragments to a JSON Lines sink"""
+        import io
+        import json
+        from fragmenter import fragment
+        smiles = ['CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2', 'CCCCCC']
+        molecules = (chemi.smiles_to_oemol(smi) for smi in smiles)
+        sink = io.StringIO()
+        results = list(fragment.iter_fragments(molecules, sink=sink))
+        self.assertEqual(len(results), 2)
+        records = [json.loads(line) for line in sink.getvalue().splitlines()]
+        self.assertEqual([record['parent'] for record in records], [result[0] for result in results])
+        for parent_smiles, fragments, diagnostics in results:
+            self.assertEqual(diagnostics['status'], 'fragmented')
+            self.assertEqual(diagnostics['n_fragments'], len(fragments))
+
+        expected = fragment.generate_fragments([chemi.smiles_to_oemol(smi) for smi in smiles])
+        self.assertEqual(expected, {parent: frags for parent, frags, diagnostics in results})
 
+    def test_frag_graphs_batch(self):
+        """Test graph fragmenter cuts single bonds and fragments batches like single molecules"""
+        import numpy as np
+        from fragmenter import fragment
+        # Butane with a conjugated bond between atoms 2 and 3 and pentane with one aromatic bond
+        butane = {'n_atoms': 4, 'atoms': np.array([[0, 1], [1, 2], [2, 3]]), 'index': np.array([0, 1, 2]),
+                  'weight': np.array([1.0, 1.0, 1.5]), 'aromatic': np.zeros(3, dtype=bool),
+                  'in_ring': np.zeros(3, dtype=bool), 'fgroup': np.zeros(3, dtype=bool)}
+        pentane = {'n_atoms': 5, 'atoms': np.array([[0, 1], [1, 2], [2, 3], [3, 4]]), 'index': np.array([0, 1, 2, 3]),
+                   'weight': np.ones(4), 'aromatic': np.array([False, True, False, False]),
+                   'in_ring': np.zeros(4, dtype=bool), 'fgroup': np.zeros(4, dtype=bool)}
+        self.assertEqual(fragment.FragGraph(butane), [([0, 1], [0]), ([2, 3], [2])])
+        self.assertEqual(fragment.FragGraph(pentane), [([0, 1, 2], [0, 1]), ([3, 4], [3])])
+        self.assertEqual(fragment.FragGraphs([butane, pentane]),
+                         [fragment.FragGraph(butane), fragment.FragGraph(pentane)])
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_smiles_to_fragments(self):
+        """Test graph fragmenter on charged molecules"""
+        from fragmenter import fragment
+        smiles = ['CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2', 'CCCCCC']
+        results = fragment.SmilesToFragments(smiles)
+        self.assertEqual(len(results), 2)
+        for smi, (frags, charged) in zip(smiles, results):
+            single, _ = fragment.SmilesToFragments(smi)
+            self.assertEqual(len(frags), len(single))
+            self.assertEqual(sum(frag.NumAtoms() for frag in frags), charged.NumAtoms())
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_sweep_fragments(self):
+        """Test parameter sweep matches generating fragments for each parameter"""
+        from fragmenter import fragment
+        smiles = 'CCCCc1ccc(cc1)OCC(=O)NC=CC=Cc2ccc(cc2)c3ccccc3'
+        sweep = fragment.sweep_fragments(chemi.smiles_to_oemol(smiles), wbo_thresholds=[1.0, 1.2, 1.4],
+                                         MAX_ROTORS=[1, 2, 3])
+        self.assertEqual(len(sweep), 9)
+        for (wbo_threshold, max_rotors), fragments in sweep.items():
+            expected = fragment.generate_fragments(chemi.smiles_to_oemol(smiles), wbo_threshold=wbo_threshold,
+                                                   MAX_ROTORS=max_rotors)
+            self.assertEqual({parent: set(frags) for parent, frags in fragments.items()},
+                             {parent: set(frags) for parent, frags in expected.items()})
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_fragment_stats(self):
+        """Test stage times and counters are recorded for every parent"""
+        from fragmenter import fragment
+        from fragmenter.stats import FragmenterStats
+        stats = FragmenterStats()
+        fragments = fragment.generate_fragments(chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2'), stats=stats)
+        self.assertEqual(len(stats.records), 1)
+        record = stats.records[0]
+        self.assertEqual(record['status'], 'fragmented')
+        for stage in ('normalize', 'omega', 'am1bcc', 'tagging', 'growth', 'combinations', 'smiles'):
+            self.assertIn(stage, record['stages'])
+        self.assertGreater(record['counters']['rotors'], 0)
+        self.assertGreaterEqual(record['counters']['combinations_examined'],
+                                record['counters']['combinations_accepted'])
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_fragment_budget(self):
+        """Test parents over the time budget are skipped and still recorded in stats"""
+        from fragmenter import fragment
+        from fragmenter.stats import FragmenterStats
+        molecules = [chemi.smiles_to_oemol('CCCCCC'), chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2')]
+        stats = FragmenterStats()
+        results = list(fragment.iter_fragments(molecules, timeout=0.01, stats=stats))
+        self.assertEqual(len(results), 2)
+        for parent_smiles, fragments, diagnostics in results:
+            self.assertEqual(diagnostics['status'], 'timeout')
+            self.assertEqual(fragments, [])
+        self.assertEqual([record['status'] for record in stats.records], ['timeout', 'timeout'])
+        self.assertEqual([record['stage'] for record in stats.records], [d['stage'] for p, f, d in results])
+
+        results = list(fragment.iter_fragments(molecules, timeout=600, n_workers=2))
+        expected = fragment.generate_fragments(molecules)
+        self.assertEqual({parent: frags for parent, frags, diagnostics in results}, expected)
+        with self.assertRaises(ValueError):
+            list(fragment.iter_fragments(molecules, timeout=10, executor=object()))
+
+    @unittest.skipUnless(has_openeye, 'Cannot test without OpenEye')
+    def test_render_queue(self):
+        """Test PDFs are rendered in the background and not rendered again if they are up to date"""
+        import os
+        import tempfile
+        from fragmenter import fragment
+        mol = chemi.smiles_to_oemol('CCCCc1ccc(cc1)OCC(=O)NCCc2ccccc2', name='butylphenoxy')
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                fragments = fragment.generate_fragments(mol, generate_visualization=True)
+                self.assertEqual(fragments, fragment.generate_fragments(mol))
+                self.assertTrue(os.path.exists('butylphenoxy.pdf'))
+                self.assertTrue(os.path.exists('butylphenoxy.pdf.sha256'))
 
+                charged, frags = fragment._generate_fragments(fragment._prepare_parent(mol))
+                with fragment.RenderQueue(processes=False) as renderer:
+                    self.assertTrue(renderer.submit(charged, 'queued.pdf', frags).result())
+                    self.assertFalse(renderer.submit(charged, 'queued.pdf', frags).result())
+            finally:
+                os.chdir(cwd)
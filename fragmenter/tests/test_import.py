@@ -0,0 +1,28 @@
+"""Test importing fragmenter does not import submodules or toolkits"""
+
+import subprocess
+import sys
+
+
+def _modules_after(statement):
+    code = '{}; import sys; print(" ".join(sys.modules))'.format(statement)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return set(output.decode().split())
+
+
+def test_import_is_lazy():
+    """Test import fragmenter only loads the package"""
+    modules = _modules_after('import fragmenter')
+    for heavy in ('openeye', 'rdkit', 'cmiles', 'qcfractal', 'numpy', 'yaml', 'fragmenter.fragment',
+                  'fragmenter.workflow_api', 'fragmenter._version'):
+        assert heavy not in modules
+
+
+def test_submodule_on_access():
+    """Test submodules load on first attribute access"""
+    modules = _modules_after('import fragmenter; fragmenter.stats')
+    assert 'fragmenter.stats' in modules
+    assert 'fragmenter.fragment' not in modules
+    import fragmenter
+    assert fragmenter.__version__
+    assert 'stats' in dir(fragmenter)
@@ -0,0 +1,47 @@
+"""Test fragmenter stats"""
+
+import io
+import json
+from fragmenter.stats import ParentStats, FragmenterStats, NULL_STATS
+
+
+def test_parent_stats():
+    """Test stage times and counters accumulate"""
+    stats = ParentStats('butane', 'CCCC')
+    for _ in range(2):
+        with stats.stage('growth'):
+            pass
+    stats.count('rotors', 2)
+    stats.count('rotors')
+    record = stats.to_dict()
+    assert record['stages']['growth']['calls'] == 2
+    assert record['stages']['growth']['wall'] >= 0
+    assert record['counters'] == {'rotors': 3}
+
+
+def test_fragmenter_stats_events():
+    """Test records are written as JSON lines and summed"""
+    events = io.StringIO()
+    stats = FragmenterStats(events=events)
+    for title, wall in (('a', 1.0), ('b', 3.0)):
+        stats.add({'title': title, 'smiles': 'C', 'stages': {'omega': {'wall': wall, 'cpu': wall, 'calls': 1}},
+                   'counters': {'rotors': 1}})
+    assert [json.loads(line)['title'] for line in events.getvalue().splitlines()] == ['a', 'b']
+    totals = stats.totals()
+    assert totals['stages']['omega'] == {'wall': 4.0, 'cpu': 4.0, 'calls': 2}
+    assert totals['counters'] == {'rotors': 2}
+    assert stats.slowest(1)[0]['title'] == 'b'
+    assert stats.slowest(1, stage='am1bcc')[0]['title'] == 'a'
+
+    # Parents that were terminated have no stage times
+    stats.add({'title': 'c', 'smiles': 'C', 'stages': {}, 'counters': {}, 'status': 'timeout', 'stage': 'omega',
+               'wall_time': 10.0})
+    assert stats.slowest(1)[0]['title'] == 'c'
+    assert stats.totals()['stages']['omega']['calls'] == 2
+
+
+def test_null_stats():
+    """Test disabled stats do nothing"""
+    with NULL_STATS.stage('omega'):
+        pass
+    NULL_STATS.count('rotors')
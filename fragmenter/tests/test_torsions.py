@@ -180,3 +180,24 @@ def test_all_equivelant_torsions():
                 (0, 2): [(4, 0, 2, 8), (5, 0, 2, 8), (1, 0, 2, 8)]}
     eq_torsions = torsions.find_equivelant_torsions(oemol)
     assert eq_torsions == expected
+
+
+def test_measure_dihedral_angles():
+    """Test batch dihedral angles match measure_dihedral_angle"""
+    import numpy as np
+    rng = np.random.RandomState(0)
+    coords = rng.normal(size=(5, 10, 3)) * 3
+    dihedrals = [(0, 1, 2, 3), (3, 2, 1, 0), (4, 5, 6, 7), (9, 1, 4, 2)]
+    angles = torsions.measure_dihedral_angles(dihedrals, coords)
+    assert angles.shape == (5, 4)
+    for conf, conf_angles in zip(coords, angles):
+        for dihedral, angle in zip(dihedrals, conf_angles):
+            assert angle == pytest.approx(torsions.measure_dihedral_angle(dihedral, conf.ravel()))
+    np.testing.assert_allclose(torsions.measure_dihedral_angles(dihedrals, coords[0].ravel()), angles[:1])
+    # Known angles and sign convention
+    theta = np.radians([60, -120, 180])
+    known = [[[1, 0, 0], [0, 0, 0], [0, 0, 1], [np.cos(t), np.sin(t), 1]] for t in theta]
+    np.testing.assert_allclose(torsions.measure_dihedral_angles([(0, 1, 2, 3)], known, bohr=False)[:, 0],
+                               [60, -120, 180])
+    # Reversing a dihedral does not change its sign
+    np.testing.assert_allclose(angles[:, 0], angles[:, 1])
@@ -104,10 +104,7 @@ def _find_torsions_from_smarts(molecule, smarts):
     """
 
     #ToDO use MDL aromaticity model
-    qmol=oechem.OEQMol()
-    if not oechem.OEParseSmarts(qmol, smarts):
-        utils.logger().warning('OEParseSmarts failed')
-    ss = oechem.OESubSearch(qmol)
+    ss = chemi.get_subsearch(smarts)
     tors = []
     oechem.OEPrepareSearch(molecule, ss)
     unique = True
@@ -346,15 +343,10 @@ def generate_constraint_opt_input(qc_molecule, dihedrals, maximum_rotation=30, i
 
     # convert coord to Angstrom
     coords = coords * BOHR_2_ANGSTROM
+    chemi.set_coordinates(mol, coords.reshape(1, -1, 3))
     conf = mol.GetConfs().next()
-    conf.SetCoords(oechem.OEFloatArray(coords))
-
-    # new molecule for setting dihedral angles
-    mol_2 = oechem.OEMol(mol)
-    conf_2 = mol_2.GetConfs().next()
-    coords_2 = oechem.OEFloatArray(conf_2.GetMaxAtomIdx()*3)
-    conf.GetCoords(coords_2)
-    mol_2.DeleteConfs()
+    # starting coordinates of the conformers for setting dihedral angles
+    coords_2 = chemi.to_float_array(coords)
 
     interval = radians(interval)
     max_rot = radians(maximum_rotation)
@@ -428,6 +420,44 @@ def measure_dihedral_angle(dihedral, coords):
     return degree
 
 
+def measure_dihedral_angles(dihedrals, coords, bohr=True):
+    """
+    Calculate many dihedral angles in degrees for many conformers at once
+
+    Parameters
+    ----------
+    dihedrals: array-like
+        (n_dihedrals, 4) atom indices
+    coords: array-like
+        (n_confs, n_atoms, 3) coordinates. A single conformer can be given as (n_atoms, 3) or as a flat geometry like
+        measure_dihedral_angle takes.
+    bohr: bool, optional, default True
+        Whether coords are in Bohr (like qcschema geometries and measure_dihedral_angle) or Angstrom. Kept for
+        consistency with measure_dihedral_angle. Angles do not depend on units so coords are never converted.
+
+    Returns
+    -------
+    degrees: np.ndarray
+        (n_confs, n_dihedrals) dihedral angles in degrees between -180 and 180
+    """
+    coords = np.asarray(coords, dtype=float)
+    if coords.ndim == 1:
+        coords = coords.reshape(1, -1, 3)
+    elif coords.ndim == 2:
+        coords = coords[np.newaxis]
+    dihedrals = np.asarray(dihedrals, dtype=int).reshape(-1, 4)
+
+    # (n_confs, n_dihedrals, 3) bond vectors
+    points = coords[:, dihedrals]
+    v1 = points[:, :, 1] - points[:, :, 0]
+    v2 = points[:, :, 2] - points[:, :, 1]
+    v3 = points[:, :, 3] - points[:, :, 2]
+    n2 = np.cross(v2, v3)
+    t1 = np.linalg.norm(v2, axis=-1) * np.einsum('ijk,ijk->ij', v1, n2)
+    t2 = np.einsum('ijk,ijk->ij', np.cross(v1, v2), n2)
+    return np.degrees(np.arctan2(t1, t2))
+
+
 def find_equivelant_torsions(mapped_mol, restricted=False, central_bonds=None):
     """
     Final all torsions around a given central bond
@@ -18,13 +18,16 @@ except ImportError:
 
 class WorkFlow(object):
 
-    def __init__(self, workflow_id, client, workflow_json=None, verbose=False):
+    def __init__(self, workflow_id, client, workflow_json=None, verbose=False, state_cache=None):
         """
 
         Parameters
         ----------
         id
         client
+        state_cache: fragmenter.cache.ResultCache, optional, default None
+            Cache for enumerated states. If provided, molecules that were already enumerated with the same options are
+            not enumerated again.
 
         Returns
         -------
@@ -32,6 +35,7 @@ class WorkFlow(object):
         """
         self.workflow_id = workflow_id
         self.verbose = verbose
+        self.state_cache = state_cache
 
         if workflow_json is not None:
             with open(workflow_json) as file:
@@ -89,7 +93,7 @@ class WorkFlow(object):
 
         molecule = chemi.standardize_molecule(molecule, title=title)
         can_iso_smiles = mol_to_smiles(molecule, isomeric=True, mapped=False, explicit_hydrogen=False)
-        states = fragment.expand_states(molecule, **options)
+        states = fragment.expand_states(molecule, cache=self.state_cache, **options)
 
         provenance['routine']['enumerate_states']['parent_molecule'] = can_iso_smiles
         provenance['routine']['enumerate_states']['parent_molecule_name'] = molecule.GetTitle()